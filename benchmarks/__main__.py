@@ -0,0 +1,133 @@
+"""
+Run every benchmark, write the results as JSON and compare them with a baseline
+
+python -m benchmarks --output results.json
+python -m benchmarks --output results.json --baseline baseline.json --tolerance 0.2
+
+The exit status is 1 when a result is worse than the baseline by more than the
+tolerance. Latencies (us) regress when they grow, throughputs (ops/s) when they drop
+"""
+import argparse
+import json
+import platform
+import sys
+from datetime import datetime, timezone
+from importlib import metadata
+
+from benchmarks import bench_keys, bench_mime, bench_states
+
+SUITES = {
+    "keys": lambda quick: bench_keys.run(number=5 if quick else 20),
+    "states": lambda quick: bench_states.run(number=200 if quick else 2_000),
+    "mime": lambda quick: bench_mime.run(number=100 if quick else 500),
+}
+
+
+def _unit(name: str) -> str:
+    return "ops/s" if name.endswith("ops_per_s") else "us"
+
+
+def _flatten(prefix: str, results: dict, flat: dict):
+    for name, value in results.items():
+        if isinstance(value, dict):
+            _flatten(f"{prefix}/{name}", value, flat)
+        else:
+            flat[f"{prefix}/{name}"] = {"value": value, "unit": _unit(name)}
+
+
+def _version() -> str:
+    try:
+        return metadata.version("my-mimic")
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def run(suites: list[str], quick: bool = False) -> dict:
+    """
+    Run the suites
+    :param suites: list[str]. Names in SUITES
+    :param quick: bool. Fewer calls per measure
+    :return: dict. The environment and the results by "<suite>/<case>/<metric>"
+    """
+    results = {}
+    for suite in suites:
+        _flatten(suite, SUITES[suite](quick), results)
+    return {
+        "environment": {
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "my_mimic": _version(),
+            "quick": quick,
+        },
+        "results": results,
+    }
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list[dict]:
+    """
+    Compare the results present in both runs
+    :param current: dict. Output of run
+    :param baseline: dict. Output of run
+    :param tolerance: float. Accepted relative change, 0.2 is 20%
+    :return: list[dict]. One row per result with its relative change, regressions
+    flagged
+    """
+    rows = []
+    for name, result in current["results"].items():
+        if (base := baseline["results"].get(name)) is None or not base["value"]:
+            continue
+        change = (result["value"] - base["value"]) / base["value"]
+        worse = -change if result["unit"] == "ops/s" else change
+        rows.append(
+            {
+                "name": name,
+                "unit": result["unit"],
+                "baseline": base["value"],
+                "current": result["value"],
+                "change": change,
+                "regression": worse > tolerance,
+            }
+        )
+    return rows
+
+
+def main(argv: list[str] = None) -> int:
+    """
+    Command line entry point
+    :param argv: list[str]
+    :return: int. Exit status
+    """
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    parser.add_argument("--suite", action="append", choices=sorted(SUITES))
+    parser.add_argument("--quick", action="store_true")
+    parser.add_argument("--output", help="JSON file to write the results to")
+    parser.add_argument("--baseline", help="JSON file written by a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    current = run(suites=args.suite or list(SUITES), quick=args.quick)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(current, file, indent=2)
+    if not args.baseline:
+        for name, result in current["results"].items():
+            print(f"{name:<60} {result['value']:>14.2f} {result['unit']}")
+        return 0
+
+    with open(args.baseline, encoding="utf-8") as file:
+        baseline = json.load(file)
+    rows = compare(current, baseline, args.tolerance)
+    for row in rows:
+        flag = "REGRESSION" if row["regression"] else ""
+        print(
+            f"{row['name']:<60} {row['baseline']:>14.2f} {row['current']:>14.2f}"
+            f" {row['unit']:<6} {row['change']:>+8.1%} {flag}"
+        )
+    return 1 if any(row["regression"] for row in rows) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
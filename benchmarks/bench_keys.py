@@ -0,0 +1,72 @@
+"""
+Key derivation benchmark, compares mr.keys.hash_args with the former str()+sha256 key
+
+python -m benchmarks.bench_keys
+"""
+import hashlib
+import itertools
+import timeit
+from array import array
+
+from mr.keys import hash_args
+
+
+def legacy_hash_args(func_name: str, args: tuple, kwargs: dict) -> str:
+    """
+    Key derivation used up to 0.4.2
+    """
+    hash_instance = "".join(
+        str(item)
+        for item in itertools.chain(
+            [func_name], args, [i[1] for i in sorted(kwargs.items())]
+        )
+    )
+    return hashlib.sha256(hash_instance.encode()).hexdigest()
+
+
+SHAPES = {
+    "scalars": ((1, "user", 2.5), {"flag": True}),
+    "kwargs_8": ((), {f"param_{i}": i for i in range(8)}),
+    "small_list": (([1, 2, 3],), {}),
+    "list_100": ((list(range(100)),), {}),
+    "list_10k": ((list(range(10_000)),), {}),
+    "nested_100": (([{"id": i, "tags": ["a", "b"]} for i in range(100)],), {}),
+    "dict_10": (({str(i): i for i in range(10)},), {}),
+    "dict_1k": (({str(i): i for i in range(1_000)},), {}),
+    "bytes_1kb": ((b"x" * 1_000,), {}),
+    "bytes_1mb": ((b"x" * 1_000_000,), {}),
+    "array_100k": ((array("d", range(100_000)),), {}),
+}
+
+
+def run(number: int = 20) -> dict[str, dict[str, float]]:
+    """
+    Time both implementations for every argument shape
+    :param number: int. Calls per measure
+    :return: dict. Microseconds per call
+    """
+    results = {}
+    for name, (args, kwargs) in SHAPES.items():
+        results[name] = {
+            implementation.__name__: min(
+                timeit.repeat(
+                    lambda impl=implementation, args=args, kwargs=kwargs: impl(
+                        "func", args, kwargs
+                    ),
+                    number=number,
+                    repeat=3,
+                )
+            )
+            / number
+            * 1_000_000
+            for implementation in (legacy_hash_args, hash_args)
+        }
+    return results
+
+
+if __name__ == "__main__":
+    for shape, timings in run().items():
+        print(
+            f"{shape:<12} legacy {timings['legacy_hash_args']:>12.2f}us"
+            f"  hash_args {timings['hash_args']:>12.2f}us"
+        )
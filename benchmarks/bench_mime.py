@@ -0,0 +1,188 @@
+"""
+Decorator benchmark, hit and miss latency and hit throughput of sync_mimic and
+async_mimic on MemoryState, TempFileState and RedisState, at several value sizes and
+concurrency levels. RedisState uses REDIS_URL when it is set, fakeredis otherwise and
+is skipped when neither is available
+
+REDIS_URL=redis:// python -m benchmarks.bench_mime
+"""
+import asyncio
+import itertools
+import os
+import tempfile
+import threading
+import time
+import timeit
+from contextlib import contextmanager
+from typing import Optional
+
+from mr import Config, Mime
+from mr.states import MemoryState, TempFileState
+
+VALUE_SIZES = {"64b": 64, "4kb": 4 * 1024, "256kb": 256 * 1024}
+CONCURRENCY = (1, 8, 32)
+
+
+def _redis_kwargs(async_mode: bool) -> Optional[dict]:
+    if redis_url := os.environ.get("REDIS_URL"):
+        return {"REDIS_URL": redis_url}
+    try:
+        # pylint: disable=C0415
+        import fakeredis
+        import fakeredis.aioredis
+    except ImportError:
+        return None
+    connection_class = (
+        fakeredis.aioredis.FakeConnection if async_mode else fakeredis.FakeConnection
+    )
+    return {
+        "REDIS_URL": "redis://localhost",
+        "CONNECTION_KWARGS": {
+            "connection_class": connection_class,
+            "server": fakeredis.FakeServer(),
+        },
+    }
+
+
+def _configs(directory: str, async_mode: bool) -> dict[str, Config]:
+    configs = {
+        "MemoryState": Config(state=MemoryState),
+        "TempFileState": Config(
+            state=TempFileState, state_kwargs={"BASE_PATH": directory}
+        ),
+    }
+    if (redis_kwargs := _redis_kwargs(async_mode)) is not None:
+        # pylint: disable=C0415
+        from mr.states import RedisState
+
+        configs["RedisState"] = Config(state=RedisState, state_kwargs=redis_kwargs)
+    return configs
+
+
+@contextmanager
+def _using(config: Config):
+    previous = Mime._config  # pylint: disable=W0212
+    Mime.set_config(config)
+    try:
+        yield
+    finally:
+        Mime.set_config(previous)
+
+
+def _per_call_us(seconds: float, calls: int) -> float:
+    return seconds / calls * 1_000_000
+
+
+def _sync_case(case: str, value: bytes, number: int) -> dict[str, float]:
+    misses = itertools.count()
+
+    # Each case has a namespace of its own, or its misses would hit the keys
+    # stored by the previous cases
+    @Mime(ttl=3600, version=case)
+    def cached_callback(param_a: int):
+        return value
+
+    cached_callback(-1)
+    results = {
+        "hit_us": _per_call_us(
+            min(timeit.repeat(lambda: cached_callback(-1), number=number, repeat=3)),
+            number,
+        ),
+        "miss_us": _per_call_us(
+            min(
+                timeit.repeat(
+                    lambda: cached_callback(next(misses)), number=number, repeat=3
+                )
+            ),
+            number,
+        ),
+    }
+    for concurrency in CONCURRENCY:
+        calls = max(number // concurrency, 1)
+        barrier = threading.Barrier(concurrency + 1)
+
+        def worker(calls=calls, barrier=barrier):
+            barrier.wait()
+            for _ in range(calls):
+                cached_callback(-1)
+
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        barrier.wait()
+        started = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        results[f"c{concurrency}_ops_per_s"] = (calls * concurrency) / (
+            time.perf_counter() - started
+        )
+    return results
+
+
+async def _async_case(case: str, value: bytes, number: int) -> dict[str, float]:
+    misses = itertools.count()
+
+    @Mime(ttl=3600, version=case)
+    async def cached_callback(param_a: int):
+        return value
+
+    async def timed(make_param) -> float:
+        started = time.perf_counter()
+        for _ in range(number):
+            await cached_callback(make_param())
+        return time.perf_counter() - started
+
+    await cached_callback(-1)
+    results = {
+        "hit_us": _per_call_us(
+            min([await timed(lambda: -1) for _ in range(3)]), number
+        ),
+        "miss_us": _per_call_us(
+            min([await timed(lambda: next(misses)) for _ in range(3)]), number
+        ),
+    }
+    for concurrency in CONCURRENCY:
+        calls = max(number // concurrency, 1)
+
+        async def worker(calls=calls):
+            for _ in range(calls):
+                await cached_callback(-1)
+
+        started = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        results[f"c{concurrency}_ops_per_s"] = (calls * concurrency) / (
+            time.perf_counter() - started
+        )
+    return results
+
+
+def run(number: int = 500) -> dict[str, dict[str, dict[str, float]]]:
+    """
+    Time every state, value size and concurrency level, sync and async
+    :param number: int. Calls per measure
+    :return: dict. By "<state>/<sync|async>/<value size>", the hit and miss
+    microseconds per call and the hit throughput in calls per second for each
+    concurrency level
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for async_mode in (False, True):
+            mode = "async" if async_mode else "sync"
+            for state_name, config in _configs(directory, async_mode).items():
+                with _using(config):
+                    for size_name, size in VALUE_SIZES.items():
+                        value = b"x" * size
+                        case = f"{state_name}/{mode}/{size_name}"
+                        results[case] = (
+                            asyncio.run(_async_case(case, value, number))
+                            if async_mode
+                            else _sync_case(case, value, number)
+                        )
+    return results
+
+
+if __name__ == "__main__":
+    for case, timings in run().items():
+        print(case)
+        for name, timing in timings.items():
+            print(f"  {name:<16} {timing:>14.2f}")
@@ -0,0 +1,80 @@
+"""
+State hit benchmark, compares SharedMemoryState with MemoryState, SQLiteState,
+TempFileState and RedisState (when REDIS_URL is set)
+
+REDIS_URL=redis:// python -m benchmarks.bench_states
+"""
+import os
+import tempfile
+import timeit
+import uuid
+
+from mr.states import MemoryState, SQLiteState, SharedMemoryState, TempFileState
+
+VALUES = {
+    "int": 42,
+    "dict_100": {str(i): i for i in range(100)},
+    "bytes_1kb": b"x" * 1024,
+}
+
+
+def _states(directory: str) -> dict:
+    states = {
+        "MemoryState": MemoryState(),
+        "SharedMemoryState": SharedMemoryState(
+            NAME=f"mr-bench-{uuid.uuid4().hex[:8]}", SLOTS=1024
+        ),
+        "SharedMemoryState(ZERO_COPY)": SharedMemoryState(
+            NAME=f"mr-bench-{uuid.uuid4().hex[:8]}", SLOTS=1024, ZERO_COPY=True
+        ),
+        "SQLiteState": SQLiteState(PATH=os.path.join(directory, "bench.sqlite3")),
+        "TempFileState": TempFileState(BASE_PATH=directory),
+    }
+    if redis_url := os.environ.get("REDIS_URL"):
+        # pylint: disable=C0415
+        from mr.states import RedisState
+
+        states["RedisState"] = RedisState(REDIS_URL=redis_url)
+    return states
+
+
+def run(number: int = 2_000) -> dict[str, dict[str, float]]:
+    """
+    Time a hit of every value on every state
+    :param number: int. Gets per measure
+    :return: dict. Microseconds per get
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        states = _states(directory)
+        try:
+            for value_name, value in VALUES.items():
+                results[value_name] = {}
+                for state_name, state in states.items():
+                    key = f"bench-{value_name}"
+                    state.sync_set(key, value)
+                    results[value_name][state_name] = (
+                        min(
+                            timeit.repeat(
+                                lambda state=state, key=key: state.sync_get(key),
+                                number=number,
+                                repeat=3,
+                            )
+                        )
+                        / number
+                        * 1_000_000
+                    )
+        finally:
+            for state in states.values():
+                if isinstance(state, SharedMemoryState):
+                    state.unlink()
+                elif isinstance(state, SQLiteState):
+                    state.close()
+    return results
+
+
+if __name__ == "__main__":
+    for shape, timings in run().items():
+        print(shape)
+        for implementation, timing in timings.items():
+            print(f"  {implementation:<30} {timing:>10.2f}us")
@@ -4,10 +4,11 @@ Hi I Mr Mime, go do mimic
 
 from .mime import Mime
 from .config import Config
-from .states.interface import IState
+from .states.interface import IState, MISS
 
 __all__ = [
     "Mime",
     "Config",
     "IState",
+    "MISS",
 ]
@@ -0,0 +1,124 @@
+"""
+Single-flight helpers. Concurrent misses for the same key share one computation
+"""
+import asyncio
+import threading
+from typing import Awaitable, Callable, TypeVar
+
+T = TypeVar("T")
+
+
+class _Call:  # pylint: disable=R0903
+    """
+    In-flight sync computation
+    """
+
+    __slots__ = ("event", "value", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:  # pylint: disable=R0903
+    """
+    Coalesce concurrent sync calls (threads) for the same key into a single execution
+    """
+
+    _lock: threading.Lock
+    _calls: dict[str, _Call]
+    coalesced: int
+
+    __slots__ = ("_lock", "_calls", "coalesced")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0
+
+    def do(self, key: str, func: Callable[[], T]) -> T:  # pylint: disable=C0103
+        """
+        Run func once for all concurrent callers of the same key. Errors are
+        raised to every waiter
+        :param key: str
+        :param func: Callable without arguments
+        :return: func result
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+        try:
+            call.value = func()
+            return call.value
+        except BaseException as exception:
+            call.error = exception
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+
+class AsyncSingleFlight:  # pylint: disable=R0903
+    """
+    Coalesce concurrent coroutines for the same key into a single awaited future
+    """
+
+    _calls: dict[tuple, asyncio.Future]
+    coalesced: int
+
+    __slots__ = ("_calls", "coalesced")
+
+    def __init__(self):
+        self._calls = {}
+        self.coalesced = 0
+
+    async def do(  # pylint: disable=C0103
+        self, key: str, func: Callable[[], Awaitable[T]]
+    ) -> T:
+        """
+        Await func once for all concurrent callers of the same key in the running
+        event loop. Errors are raised to every waiter. When the leader is cancelled
+        the waiters are not, the first one to resume runs func again
+        :param key: str
+        :param func: Coroutine function without arguments
+        :return: func result
+        """
+        loop = asyncio.get_running_loop()
+        flight_key = (loop, key)
+        if (future := self._calls.get(flight_key)) is not None:
+            self.coalesced += 1
+        while future is not None:
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # Only the waiter itself being cancelled leaves the future pending
+                if not future.cancelled():
+                    raise
+            future = self._calls.get(flight_key)
+        future = self._calls[flight_key] = loop.create_future()
+        # Mark the exception as retrieved when nobody was waiting for it
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        try:
+            value = await func()
+            future.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as exception:
+            future.set_exception(exception)
+            raise
+        finally:
+            del self._calls[flight_key]
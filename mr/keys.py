@@ -0,0 +1,321 @@
+"""
+Cache key derivation. Plain arguments are keyed by marshal, buffers by structure
+"""
+import hashlib
+import inspect
+import marshal
+from inspect import _empty
+from typing import Callable, Iterable, Optional
+
+_SCALARS = frozenset({int, float, str, bool, type(None)})
+# Bigger bytes are hashed from their buffer instead of being copied by marshal
+_PLAIN_MAX_BYTES = 1024
+# Format 0 has no references and no interned strings, equal values give equal bytes
+_MARSHAL_VERSION = 0
+
+
+class _NotPlain(Exception):
+    """
+    The argument can't be keyed by marshal
+    """
+
+
+def _plain(obj: any) -> any:
+    """
+    Equivalent of the argument made of marshal types only: dicts become
+    (Ellipsis, "dict", sorted keys, values), sets (Ellipsis, "set", sorted items) and other
+    objects (Ellipsis, type name, str()). Ellipsis itself is not a scalar, so the
+    markers can't be forged
+    :raise _NotPlain: for buffers, big bytes and unsortable dicts and sets
+    """
+    # pylint: disable=R0911
+    obj_type = type(obj)
+    if obj_type in _SCALARS:
+        return obj
+    if obj_type is tuple or obj_type is list:
+        if _SCALARS.issuperset(map(type, obj)):
+            return obj
+        return obj_type(map(_plain, obj))
+    if isinstance(obj, dict):
+        return _plain_dict(obj)
+    if isinstance(obj, (set, frozenset)):
+        if not _SCALARS.issuperset(map(type, obj)):
+            raise _NotPlain()
+        try:
+            return ..., "set", sorted(obj)
+        except TypeError as exception:
+            raise _NotPlain() from exception
+    if obj_type is bytes or obj_type is bytearray:
+        if len(obj) > _PLAIN_MAX_BYTES:
+            raise _NotPlain()
+        return bytes(obj)
+    try:
+        memoryview(obj).release()
+    except TypeError:
+        return ..., obj_type.__qualname__, str(obj)
+    raise _NotPlain()
+
+
+def _plain_dict(obj: dict) -> tuple:
+    """
+    The keys and values in key order, so the order of the items doesn't matter
+    """
+    if not _SCALARS.issuperset(map(type, obj)):
+        raise _NotPlain()
+    try:
+        keys = sorted(obj)
+    except TypeError as exception:
+        raise _NotPlain() from exception
+    values = map(obj.__getitem__, keys)
+    if not _SCALARS.issuperset(map(type, obj.values())):
+        values = map(_plain, values)
+    return ..., "dict", keys, list(values)
+
+
+def _update(hasher, tag: bytes, data) -> None:
+    hasher.update(tag + len(data).to_bytes(8, "little"))
+    hasher.update(data)
+
+
+def _digest(obj: any) -> bytes:
+    hasher = hashlib.blake2b(digest_size=16)
+    _feed(hasher, obj)
+    return hasher.digest()
+
+
+def _ordered(items) -> list:
+    """
+    Dict keys or set items in a stable order. Only scalars are sorted by value,
+    the others by their digest
+    """
+    if _SCALARS.issuperset(map(type, items)):
+        try:
+            return sorted(items)
+        except TypeError:
+            pass
+    return sorted(items, key=_digest)
+
+
+def _feed(hasher, obj: any) -> None:
+    # pylint: disable=R0911
+    obj_type = type(obj)
+    if obj_type in _SCALARS:
+        _update(hasher, b"v", repr(obj).encode())
+        return
+    if obj_type is bytes or obj_type is bytearray:
+        _update(hasher, b"b", memoryview(obj))
+        return
+    if obj_type is tuple or obj_type is list:
+        # repr() of scalar only containers is unambiguous and runs in C
+        if _SCALARS.issuperset(map(type, obj)):
+            _update(hasher, b"L" if obj_type is list else b"T", repr(obj).encode())
+            return
+        hasher.update(
+            (b"l" if obj_type is list else b"t") + len(obj).to_bytes(8, "little")
+        )
+        for item in obj:
+            _feed(hasher, item)
+        return
+    if isinstance(obj, dict):
+        hasher.update(b"d" + len(obj).to_bytes(8, "little"))
+        for key in _ordered(obj):
+            _feed(hasher, key)
+            _feed(hasher, obj[key])
+        return
+    if isinstance(obj, (set, frozenset)):
+        hasher.update(b"s" + len(obj).to_bytes(8, "little"))
+        for item in _ordered(obj):
+            _feed(hasher, item)
+        return
+    try:
+        view = memoryview(obj)
+    except TypeError:
+        # Like the former str() keys, objects are keyed by their content
+        _update(hasher, b"o", f"{obj_type.__qualname__}:{obj}".encode())
+        return
+    with view:
+        header = f"{obj_type.__qualname__}:{view.format}:{view.shape}"
+        _update(hasher, b"m", header.encode())
+        data = view.tobytes() if not view.c_contiguous else view
+        _update(hasher, b"", data)
+
+
+def hash_args(func_name: str, args: tuple, kwargs: dict, digest_size: int = 16) -> str:
+    """
+    Create a key for the function call. The kwargs`s order doesn't have influence.
+    Calls made of scalars, small bytes and containers of them are keyed by one
+    marshal.dumps() in C, buffers and big bytes are hashed by structure from their
+    buffer without copies. Other objects are keyed by their type and str()
+    :param func_name: str
+    :param args: tuple
+    :param kwargs: dict
+    :param digest_size: int. blake2b digest size in bytes, from 1 to 64
+    :return: str. Hex digest
+    """
+    try:
+        if not _SCALARS.issuperset(map(type, args)):
+            args = tuple(map(_plain, args))
+        names = values = None
+        if kwargs:
+            # Keyword names are always str, only the values are checked
+            names = sorted(kwargs)
+            values = list(map(kwargs.__getitem__, names))
+            if not _SCALARS.issuperset(map(type, values)):
+                values = list(map(_plain, values))
+        data = marshal.dumps((func_name, args, names, values), _MARSHAL_VERSION)
+    except _NotPlain:
+        hasher = hashlib.blake2b(b"s", digest_size=digest_size)
+        _feed(hasher, func_name)
+        _feed(hasher, args)
+        _feed(hasher, kwargs)
+        return hasher.hexdigest()
+    return hashlib.blake2b(b"r" + data, digest_size=digest_size).hexdigest()
+
+
+def namespace(qualified_name: str, version: Optional[str] = None) -> str:
+    """
+    Namespace of a function keys, so functions with the same name in different
+    modules don't collide and a new version starts with no keys
+    :param qualified_name: str. Module and qualname of the function
+    :param version: Optional[str]
+    :return: str. Hex digest
+    """
+    if version is not None:
+        qualified_name = f"{qualified_name}@{version}"
+    return hashlib.blake2b(qualified_name.encode(), digest_size=8).hexdigest()
+
+
+def untyped(obj: any) -> any:
+    """
+    The value with equal numbers made the same type, so 1, 1.0 and True share a key
+    like in functools.lru_cache(typed=False)
+    :param obj: Any
+    :return: Any
+    """
+    obj_type = type(obj)
+    if obj_type is bool:
+        return int(obj)
+    if obj_type is float:
+        return int(obj) if obj.is_integer() else obj
+    if obj_type in (tuple, list):
+        return obj_type(map(untyped, obj))
+    if obj_type is dict:
+        return {key: untyped(value) for key, value in obj.items()}
+    if obj_type in (set, frozenset):
+        return obj_type(map(untyped, obj))
+    return obj
+
+
+class CallKey:  # pylint: disable=R0902,R0903
+    """
+    Turns the args and kwargs of a call into the hashed ones. Keyword arguments of
+    positional parameters become positional and missing defaults are filled, so
+    f(1), f(1, 2) and f(a=1, b=2) share a key when b defaults to 2. Ignored
+    arguments are dropped, the instance (first argument) may be replaced by one of
+    its attributes and numbers may be untyped. The signature is read once
+    """
+
+    _names: tuple[str, ...]
+    _keywords: frozenset[str]
+    _defaults: tuple
+    _keyword_defaults: dict[str, any]
+    _ignored_positions: frozenset[int]
+    _ignored_names: frozenset[str]
+    _self_key: Optional[str]
+    _typed: bool
+
+    __slots__ = (
+        "_names",
+        "_keywords",
+        "_defaults",
+        "_keyword_defaults",
+        "_ignored_positions",
+        "_ignored_names",
+        "_self_key",
+        "_typed",
+    )
+
+    def __init__(
+        self,
+        func: Callable,
+        ignore: Iterable[str] = (),
+        self_key: Optional[str] = None,
+        typed: bool = True,
+    ):
+        """
+        :param func: Callable. The decorated function
+        :param ignore: Iterable[str]. Names of the parameters left out of the key
+        :param self_key: Optional[str]. Attribute of the first argument used instead
+        of it
+        :param typed: bool. When False equal numbers of different types share a key
+        """
+        try:
+            parameters = list(inspect.signature(func).parameters.values())
+        except (TypeError, ValueError):
+            parameters = []
+        positional = [
+            parameter
+            for parameter in parameters
+            if parameter.kind
+            in (parameter.POSITIONAL_ONLY, parameter.POSITIONAL_OR_KEYWORD)
+        ]
+        self._names = tuple(parameter.name for parameter in positional)
+        self._keywords = frozenset(
+            parameter.name
+            for parameter in positional
+            if parameter.kind is parameter.POSITIONAL_OR_KEYWORD
+        )
+        self._defaults = tuple(parameter.default for parameter in positional)
+        self._keyword_defaults = {
+            parameter.name: parameter.default
+            for parameter in parameters
+            if parameter.kind is parameter.KEYWORD_ONLY
+            and parameter.default is not _empty
+        }
+        ignore = frozenset(ignore)
+        if unknown := ignore.difference(parameter.name for parameter in parameters):
+            raise ValueError(
+                f"{func.__qualname__} has no parameters named {sorted(unknown)}"
+            )
+        self._ignored_positions = frozenset(
+            index for index, name in enumerate(self._names) if name in ignore
+        )
+        self._ignored_names = ignore
+        self._self_key = self_key
+        self._typed = typed
+
+    def __call__(self, args: tuple, kwargs: dict) -> tuple[tuple, dict]:
+        """
+        :param args: tuple
+        :param kwargs: dict
+        :return: tuple[tuple, dict]. The args and kwargs to hash
+        """
+        if len(args) < len(self._names):
+            given = len(args)
+            args, kwargs = list(args), dict(kwargs)
+            for name, default in zip(self._names[given:], self._defaults[given:]):
+                if name in kwargs and name in self._keywords:
+                    args.append(kwargs.pop(name))
+                elif default is not _empty:
+                    args.append(default)
+                else:
+                    break
+            args = tuple(args)
+        if self._keyword_defaults:
+            kwargs = self._keyword_defaults | kwargs
+        if self._self_key is not None and args:
+            args = (getattr(args[0], self._self_key),) + args[1:]
+        if self._ignored_names:
+            args = tuple(
+                arg
+                for index, arg in enumerate(args)
+                if index not in self._ignored_positions
+            )
+            kwargs = {
+                name: value
+                for name, value in kwargs.items()
+                if name not in self._ignored_names
+            }
+        if not self._typed:
+            args, kwargs = untyped(args), untyped(kwargs)
+        return args, kwargs
@@ -0,0 +1,257 @@
+"""
+Per-function cache metrics. Counters and latency histograms of the decorated
+functions, kept in a global registry that can be read in process or exported
+through hooks
+"""
+import bisect
+import threading
+from typing import Callable, Optional
+
+# Upper bounds in seconds, the last bucket counts everything above
+LATENCY_BUCKETS = (
+    0.000001,
+    0.000005,
+    0.00001,
+    0.00005,
+    0.0001,
+    0.0005,
+    0.001,
+    0.005,
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1.0,
+    5.0,
+)
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets
+    """
+
+    bounds: tuple[float, ...]
+    buckets: list[int]
+    count: int
+    total: float
+
+    __slots__ = ("bounds", "buckets", "count", "total")
+
+    def __init__(self, bounds: tuple[float, ...] = LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds: float):
+        """
+        Count a duration
+        :param seconds: float
+        :return:
+        """
+        self.buckets[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def snapshot(self) -> dict:
+        """
+        The histogram as a dict
+        :return: dict. count, sum and the cumulative count by upper bound ("+Inf"
+        for the last one), as Prometheus does
+        """
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.bounds + ("+Inf",), self.buckets):
+            cumulative += count
+            buckets[bound] = cumulative
+        return {"count": self.count, "sum": self.total, "buckets": buckets}
+
+
+class FunctionMetrics:  # pylint: disable=R0902
+    """
+    Metrics of a decorated function. They are updated without locks, under heavy
+    threading a few increments may be lost
+    """
+
+    name: str
+    hits: int
+    misses: int
+    sets: int
+    errors: int
+    key_hash: Histogram
+    state_get: Histogram
+    state_set: Histogram
+    compute: Histogram
+    _flight: any
+    _refresher: any
+
+    __slots__ = (
+        "name",
+        "hits",
+        "misses",
+        "sets",
+        "errors",
+        "key_hash",
+        "state_get",
+        "state_set",
+        "compute",
+        "_flight",
+        "_refresher",
+    )
+
+    def __init__(self, name: str, flight: any = None, refresher: any = None):
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.errors = 0
+        self.key_hash = Histogram()
+        self.state_get = Histogram()
+        self.state_set = Histogram()
+        self.compute = Histogram()
+        self._flight = flight
+        self._refresher = refresher
+
+    def observe_get(self, seconds: float, hits: int, misses: int):
+        """
+        Count a state get or multi-get
+        :param seconds: float
+        :param hits: int
+        :param misses: int
+        :return:
+        """
+        self.state_get.observe(seconds)
+        self.hits += hits
+        self.misses += misses
+
+    def observe_set(self, seconds: float, sets: int):
+        """
+        Count a state set or the multi-sets of a batch
+        :param seconds: float
+        :param sets: int. Values stored
+        :return:
+        """
+        self.state_set.observe(seconds)
+        self.sets += sets
+
+    @property
+    def coalesced(self) -> int:
+        """
+        Calls that waited for the single-flight computation of another one
+        """
+        return 0 if self._flight is None else self._flight.coalesced
+
+    @property
+    def refreshes(self) -> int:
+        """
+        Background refreshes started
+        """
+        return 0 if self._refresher is None else self._refresher.refreshes
+
+    def snapshot(self) -> dict:
+        """
+        The metrics as a dict
+        :return: dict
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "sets": self.sets,
+            "errors": self.errors,
+            "coalesced": self.coalesced,
+            "refreshes": self.refreshes,
+            "key_hash": self.key_hash.snapshot(),
+            "state_get": self.state_get.snapshot(),
+            "state_set": self.state_set.snapshot(),
+            "compute": self.compute.snapshot(),
+        }
+
+
+class MetricsRegistry:
+    """
+    Metrics of every function decorated with metrics=True, by module and qualname
+    """
+
+    _lock: threading.Lock
+    _functions: dict[str, FunctionMetrics]
+    _hooks: list[Callable[[dict], None]]
+
+    __slots__ = ("_lock", "_functions", "_hooks")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._functions = {}
+        self._hooks = []
+
+    def register(
+        self, name: str, flight: any = None, refresher: any = None
+    ) -> FunctionMetrics:
+        """
+        Create the metrics of a function. Decorating a function with the same name
+        again replaces them
+        :param name: str
+        :param flight: SingleFlight or AsyncSingleFlight. Source of the coalesced calls
+        :param refresher: Refresher. Source of the background refreshes
+        :return: FunctionMetrics
+        """
+        metrics = FunctionMetrics(name=name, flight=flight, refresher=refresher)
+        with self._lock:
+            self._functions[name] = metrics
+        return metrics
+
+    def get(self, name: str) -> Optional[FunctionMetrics]:
+        """
+        :param name: str. Module and qualname of the function
+        :return: Optional[FunctionMetrics]
+        """
+        return self._functions.get(name)
+
+    def snapshot(self) -> dict[str, dict]:
+        """
+        :return: dict. The metrics of every function by name
+        """
+        with self._lock:
+            functions = list(self._functions.values())
+        return {metrics.name: metrics.snapshot() for metrics in functions}
+
+    def add_hook(self, hook: Callable[[dict], None]):
+        """
+        Add an exporter called by export with the snapshot
+        :param hook: Callable receiving the snapshot
+        :return:
+        """
+        with self._lock:
+            self._hooks.append(hook)
+
+    def remove_hook(self, hook: Callable[[dict], None]):
+        """
+        :param hook: Callable added with add_hook
+        :return:
+        """
+        with self._lock:
+            self._hooks.remove(hook)
+
+    def export(self) -> dict[str, dict]:
+        """
+        Take a snapshot and call every hook with it
+        :return: dict. The snapshot
+        """
+        snapshot = self.snapshot()
+        with self._lock:
+            hooks = list(self._hooks)
+        for hook in hooks:
+            hook(snapshot)
+        return snapshot
+
+    def clear(self):
+        """
+        Forget every function and hook
+        :return:
+        """
+        with self._lock:
+            self._functions.clear()
+            self._hooks.clear()
+
+
+registry = MetricsRegistry()
@@ -1,30 +1,38 @@
 """
 Mr Mime is a function decorator for cache/memoization
 """
+import asyncio
 import functools
-import hashlib
 import inspect
-import itertools
+import math
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from inspect import _empty
-from typing import TypeVar
-
-import meeseeks
+from typing import Callable, Hashable, Iterable, Optional, TypeVar
 
 from mr.config import Config
+from mr.flight import AsyncSingleFlight, SingleFlight
+from mr.keys import CallKey, hash_args, namespace
+from mr.metrics import FunctionMetrics, registry
+from mr.refresh import Refresher, pack, unpack
 from mr.states.implementations.memory import MemoryState
+from mr.states.interface import IState, MISS, NAMESPACE_SEPARATOR
+from mr.write_behind import SYNC, WriteBehind, discard_namespace
 
 T = TypeVar("T")
 
-singleton_container = meeseeks.OnlyOne(by_args_hash=True)
+DEFAULT_CONCURRENCY = 8
 
 
-@singleton_container
-class Mime:
+class Mime:  # pylint: disable=R0902
     """
     Decorator to aplay cache/memoization on your functions
     """
 
     _config: Config = Config(state=MemoryState)
+    _namespaces_by_tag: dict[str, set[str]] = {}
 
     @classmethod
     def set_config(cls, config: Config):
@@ -36,21 +44,276 @@ class Mime:
         """
         cls._config = config
 
-    def __init__(self, ttl: int = _empty):
+    @classmethod
+    def _tagged_namespaces(cls, tags: tuple[str, ...]) -> set[str]:
+        return set().union(*(cls._namespaces_by_tag.get(tag, ()) for tag in tags))
+
+    @classmethod
+    def invalidate_tags(cls, *tags: str):
+        """
+        Clear the keys of every function decorated with one of the tags
+
+        :param tags: str
+        :return: None
+        """
+        with cls._config.sync_acquire_state() as state:
+            for tagged in cls._tagged_namespaces(tags):
+                discard_namespace(namespace=tagged)
+                state.sync_clear_namespace(namespace=tagged)
+
+    @classmethod
+    async def async_invalidate_tags(cls, *tags: str):
+        """
+        Clear the keys of every function decorated with one of the tags
+
+        :param tags: str
+        :return: None
+        """
+        async with cls._config.async_acquire_state() as state:
+            for tagged in cls._tagged_namespaces(tags):
+                discard_namespace(namespace=tagged)
+                await state.async_clear_namespace(namespace=tagged)
+
+    def __init__(  # pylint: disable=R0913,R0914
+        self,
+        ttl: int = _empty,
+        single_flight: bool = False,
+        key_digest_size: int = 16,
+        none_ttl: int = _empty,
+        stale_ttl: int = _empty,
+        early_refresh: bool = False,
+        early_refresh_beta: float = 1.0,
+        metrics: bool = False,
+        version: str = None,
+        tags: Iterable[str] = (),
+        write_behind: bool = False,
+        write_behind_queue: int = 10_000,
+        write_behind_batch: int = 256,
+        write_behind_policy: str = SYNC,
+        key: Callable[..., Hashable] = None,
+        ignore: Iterable[str] = (),
+        self_key: str = None,
+        typed: bool = True,
+    ):
+        """
+        :param ttl: int. Seconds that the cache will have to live
+        :param single_flight: bool. When True concurrent misses for the same key
+        share a single in-flight computation, across processes too when the state
+        implements the lock
+        :param key_digest_size: int. Key digest size in bytes, from 1 to 64
+        :param none_ttl: int. Seconds that a None result (negative cache) will have
+        to live. Default ttl
+        :param stale_ttl: int. Seconds after the ttl that the expired value is still
+        returned while a single background call refreshes it
+        :param early_refresh: bool. When True a hit may start a background refresh
+        before the ttl (XFetch), more likely as the expiry approaches and the longer
+        the function takes, so keys set together don't expire together
+        :param early_refresh_beta: float. Above 1 refreshes earlier, below 1 later
+        :param metrics: bool. When True the function counts hits, misses, sets,
+        errors and the key hash, state get/set and compute latencies in
+        mr.metrics.registry
+        :param version: str. Part of the key namespace, a new version starts with no
+        keys
+        :param tags: Iterable[str]. Tags to clear the keys of the function with
+        Mime.invalidate_tags
+        :param write_behind: bool. When True the computed values are queued and a
+        background thread stores them in batches, so the call doesn't wait for the
+        state set. With single_flight the value is still stored before the lock is
+        released
+        :param write_behind_queue: int. Queued values before the policy applies
+        :param write_behind_batch: int. Values stored by each multi-set round
+        :param write_behind_policy: str. When the queue is full, SYNC stores the value
+        in the call, DROP doesn't store it and BLOCK waits for room in the queue
+        :param key: Callable. Called with the args and kwargs of each call, its
+        result is hashed instead of them
+        :param ignore: Iterable[str]. Names of the parameters left out of the key,
+        like request ids or loggers
+        :param self_key: str. Attribute of the instance used in the key of a method
+        instead of str(self), which usually holds its id
+        :param typed: bool. When False equal numbers of different types, like 1 and
+        1.0, share a key
+        """
         self._ttl = ttl
+        self._single_flight = single_flight
+        self._key_digest_size = key_digest_size
+        self._none_ttl = none_ttl
+        self._stale_ttl = stale_ttl
+        self._early_refresh = early_refresh
+        self._early_refresh_beta = early_refresh_beta
+        self._metrics = metrics
+        self._version = version
+        self._tags = tuple(tags)
+        self._write_behind = write_behind
+        self._write_behind_queue = write_behind_queue
+        self._write_behind_batch = write_behind_batch
+        self._write_behind_policy = write_behind_policy
+        self._key = key
+        self._ignore = tuple(ignore)
+        self._self_key = self_key
+        self._typed = typed
+        if stale_ttl is not _empty and ttl in (_empty, None):
+            raise ValueError("The stale_ttl needs a ttl")
+        if early_refresh and ttl in (_empty, None):
+            raise ValueError("The early_refresh needs a ttl")
+        if key is not None and (self._ignore or self_key is not None or not typed):
+            raise ValueError(
+                "The key function can't be combined with ignore, self_key or typed"
+            )
+
+    def _ttl_for(self, value: any) -> int:
+        """
+        The ttl used to store the value
+        """
+        if value is None and self._none_ttl is not _empty:
+            return self._none_ttl
+        return self._ttl
+
+    @property
+    def _envelope(self) -> bool:
+        """
+        The values are stored with their creation time and compute duration
+        """
+        return self._stale_ttl is not _empty or self._early_refresh
+
+    def _store_ttl(self, value: any) -> int:
+        """
+        The ttl of the state, the stale window included
+        """
+        ttl = self._ttl_for(value)
+        if self._stale_ttl is not _empty and ttl not in (_empty, None):
+            return ttl + self._stale_ttl
+        return ttl
+
+    def _pack(self, value: any, delta: float) -> any:
+        """
+        The value stored in the state
+        """
+        if not self._envelope:
+            return value
+        return pack(value, datetime.utcnow().timestamp(), delta)
+
+    def _unpack(self, cached_value: any) -> tuple[any, bool]:
+        """
+        The cached value and whether it must be refreshed
+        """
+        if not self._envelope or (entry := unpack(cached_value)) is None:
+            return cached_value, False
+        value, created_at, delta = entry
+        ttl = self._ttl_for(value)
+        if ttl in (_empty, None):
+            return value, False
+        age = datetime.utcnow().timestamp() - created_at
+        if age > ttl:
+            return value, True
+        if not self._early_refresh:
+            return value, False
+        # XFetch: -log(u) is exponential, so the refresh gets likely when the time
+        # left is a few compute durations
+        gap = -delta * self._early_refresh_beta * math.log(1.0 - random.random())
+        return value, age + gap >= ttl
+
+    def _group_by_ttl(
+        self, computed: dict[str, tuple[any, float]]
+    ) -> dict[int, dict[str, any]]:
+        """
+        Split the computed (value, delta) by the ttl used to store them
+        """
+        groups = {}
+        for key, (value, delta) in computed.items():
+            groups.setdefault(self._store_ttl(value), {})[key] = self._pack(
+                value, delta
+            )
+        return groups
+
+    def _writer(self) -> Optional[WriteBehind]:
+        """
+        The write-behind queue of the function, None when disabled
+        """
+        if not self._write_behind:
+            return None
+        return WriteBehind(
+            # Late bound, the config may be replaced after the decoration
+            acquire=lambda: self._config.sync_acquire_state(),  # pylint: disable=W0108
+            max_queue=self._write_behind_queue,
+            batch_size=self._write_behind_batch,
+            policy=self._write_behind_policy,
+        )
+
+    @staticmethod
+    def _sync_write_behind(
+        writer: WriteBehind, groups: dict[int, dict[str, any]]
+    ) -> dict[int, dict[str, any]]:
+        """
+        Queue the grouped values, the ones left to store in the call are returned
+        """
+        left = {}
+        for ttl, group in groups.items():
+            for key, value in group.items():
+                if not writer.sync_put(key=key, value=value, ttl=ttl):
+                    left.setdefault(ttl, {})[key] = value
+        return left
 
     @staticmethod
-    def _hash_args(func_name: str, args: tuple, kwargs: dict) -> str:
+    async def _async_write_behind(
+        writer: WriteBehind, groups: dict[int, dict[str, any]]
+    ) -> dict[int, dict[str, any]]:
+        """
+        Queue the grouped values, the ones left to store in the call are returned
+        """
+        left = {}
+        for ttl, group in groups.items():
+            for key, value in group.items():
+                if not await writer.async_put(key=key, value=value, ttl=ttl):
+                    left.setdefault(ttl, {})[key] = value
+        return left
+
+    def _namespace(self, callable_obj: T) -> str:
         """
-        Created for each arg + kwargs hash. The kwargs`s order doesn't have influence
+        The key namespace of the function, registered under its tags
         """
-        hash_instance = "".join(
-            str(item)
-            for item in itertools.chain(
-                [func_name], args, [i[1] for i in sorted(kwargs.items())]
+        function_namespace = namespace(
+            qualified_name=f"{callable_obj.__module__}.{callable_obj.__qualname__}",
+            version=self._version,
+        )
+        for tag in self._tags:
+            self._namespaces_by_tag.setdefault(tag, set()).add(function_namespace)
+        return function_namespace
+
+    def _hash_args(self, func_namespace: str, args: tuple, kwargs: dict) -> str:
+        """
+        Created for each arg + kwargs hash, prefixed by the function namespace. The
+        kwargs`s order doesn't have influence
+        """
+        return (
+            func_namespace
+            + NAMESPACE_SEPARATOR
+            + hash_args(
+                func_name=func_namespace,
+                args=args,
+                kwargs=kwargs,
+                digest_size=self._key_digest_size,
+            )
+        )
+
+    def _key_of(
+        self, callable_obj: T, func_namespace: str
+    ) -> Callable[[tuple, dict], str]:
+        """
+        The key of a call of the function
+        """
+        if (key := self._key) is not None:
+            return lambda args, kwargs: self._hash_args(
+                func_namespace=func_namespace, args=(key(*args, **kwargs),), kwargs={}
             )
+        call_key = CallKey(
+            func=callable_obj,
+            ignore=self._ignore,
+            self_key=self._self_key,
+            typed=self._typed,
+        )
+        return lambda args, kwargs: self._hash_args(
+            func_namespace, *call_key(args, kwargs)
         )
-        return hashlib.sha256(hash_instance.encode()).hexdigest()
 
     def __call__(self, callable_obj: T) -> T:
         _is_class = inspect.isclass(callable_obj)
@@ -60,31 +323,419 @@ class Mime:
                 "link: https://pypi.org/project/meeseeks-singleton/"
             )
         if inspect.iscoroutinefunction(callable_obj):
+            return self._async_decorator(callable_obj)
+        return self._sync_decorator(callable_obj)
+
+    def _register_metrics(
+        self, callable_obj: T, flight: any, refresher: Optional[Refresher]
+    ) -> Optional[FunctionMetrics]:
+        """
+        The metrics of the function in the global registry, None when disabled
+        """
+        if not self._metrics:
+            return None
+        return registry.register(
+            name=f"{callable_obj.__module__}.{callable_obj.__qualname__}",
+            flight=flight,
+            refresher=refresher,
+        )
+
+    def _async_decorator(self, callable_obj: T) -> T:  # pylint: disable=R0914,R0915
+        """
+        Wrap a coroutine function
+        """
+        refresher = Refresher() if self._envelope else None
+        async_flight = AsyncSingleFlight() if self._single_flight else None
+        metrics = self._register_metrics(callable_obj, async_flight, refresher)
+        func_namespace = self._namespace(callable_obj)
+        key_of = self._key_of(callable_obj, func_namespace)
+        writer = self._writer()
+        clock = time.perf_counter
+
+        async def timed_call(args: tuple, kwargs: dict) -> tuple[any, float]:
+            started = clock()
+            value = await callable_obj(*args, **kwargs)
+            delta = clock() - started
+            if metrics is not None:
+                metrics.compute.observe(delta)
+            return value, delta
 
-            @functools.wraps(callable_obj)
-            async def async_mimic(*args, **kwargs):
-                args_hash = self._hash_args(
-                    func_name=callable_obj.__name__, args=args, kwargs=kwargs
-                )
+        async def store(  # pylint: disable=R0913
+            state: IState,
+            key: str,
+            value: any,
+            delta: float,
+            inline: bool = False,
+            replace: bool = False,
+        ):
+            started = clock()
+            packed, ttl = self._pack(value, delta), self._store_ttl(value)
+            if replace:
+                # A refresh overwrites the stale value still cached
+                if writer is not None:
+                    writer.discard(key=key)
+                await state.async_replace(key=key, value=packed, ttl=ttl)
+            elif writer is None:
+                await state.async_set(key=key, value=packed, ttl=ttl)
+            elif inline or not await writer.async_put(key=key, value=packed, ttl=ttl):
+                writer.discard(key=key)
+                await state.async_set(key=key, value=packed, ttl=ttl)
+            if metrics is not None:
+                metrics.observe_set(clock() - started, sets=1)
+
+        async def refresh(args_hash: str, args: tuple, kwargs: dict):
+            value, delta = await timed_call(args, kwargs)
+            async with self._config.async_acquire_state() as state:
+                await store(state, args_hash, value, delta, replace=True)
+
+        @functools.wraps(callable_obj)
+        async def async_mimic(*args, **kwargs):
+            if metrics is not None:
+                started = clock()
+            args_hash = key_of(args, kwargs)
+            if metrics is not None:
+                metrics.key_hash.observe(clock() - started)
+                started = clock()
+            try:
                 async with self._config.async_acquire_state() as state:
-                    if cached_value := await state.async_get(key=args_hash):
-                        return cached_value
-                    value = await callable_obj(*args, **kwargs)
-                    await state.async_set(key=args_hash, value=value, ttl=self._ttl)
-                    return value
+                    cached_value = await state.async_get(key=args_hash)
+                    if cached_value is MISS and writer is not None:
+                        cached_value = writer.pending(key=args_hash)
+                    if metrics is not None:
+                        hit = cached_value is not MISS
+                        metrics.observe_get(
+                            clock() - started, hits=int(hit), misses=int(not hit)
+                        )
+                    if cached_value is not MISS:
+                        value, expired = self._unpack(cached_value)
+                        if expired:
+                            refresher.async_refresh(
+                                key=args_hash,
+                                func=functools.partial(
+                                    refresh, args_hash, args, kwargs
+                                ),
+                            )
+                        return value
+
+                    async def compute(inline: bool = False):
+                        value, delta = await timed_call(args, kwargs)
+                        await store(state, args_hash, value, delta, inline=inline)
+                        return value
+
+                    if async_flight is None:
+                        return await compute()
+
+                    async def locked_compute():
+                        async with state.async_lock(key=args_hash) as locked_value:
+                            if locked_value is not MISS:
+                                return self._unpack(locked_value)[0]
+                            return await compute(inline=True)
 
-            return async_mimic
+                    return await async_flight.do(key=args_hash, func=locked_compute)
+            except Exception:
+                if metrics is not None:
+                    metrics.errors += 1
+                raise
+
+        async def async_map(  # pylint: disable=R0914
+            iterable_of_args: Iterable[tuple],
+            concurrency: int = DEFAULT_CONCURRENCY,
+        ) -> list:
+            """
+            Call the function for each args tuple (like itertools.starmap) with a
+            single multi-get, computing only the misses, at most concurrency at a
+            time, and a single multi-set
+            """
+            calls = [tuple(args) for args in iterable_of_args]
+            started = clock()
+            keys = [key_of(args, {}) for args in calls]
+            if metrics is not None:
+                metrics.key_hash.observe(clock() - started)
+            try:
+                async with self._config.async_acquire_state() as state:
+                    started = clock()
+                    values = await state.async_get_many(keys=keys)
+                    if writer is not None:
+                        values = [
+                            writer.pending(key=key) if value is MISS else value
+                            for key, value in zip(keys, values)
+                        ]
+                    misses = {}
+                    for index, (key, args, cached_value) in enumerate(
+                        zip(keys, calls, values)
+                    ):
+                        if cached_value is MISS:
+                            misses[key] = args
+                            continue
+                        values[index], expired = self._unpack(cached_value)
+                        if expired:
+                            refresher.async_refresh(
+                                key=key, func=functools.partial(refresh, key, args, {})
+                            )
+                    if metrics is not None:
+                        metrics.observe_get(
+                            clock() - started,
+                            hits=len(keys) - len(misses),
+                            misses=len(misses),
+                        )
+                    computed = {}
+                    if misses:
+                        semaphore = asyncio.Semaphore(concurrency)
+
+                        async def compute(args: tuple):
+                            async with semaphore:
+                                return await timed_call(args, {})
+
+                        computed = dict(
+                            zip(
+                                misses,
+                                await asyncio.gather(
+                                    *[compute(args) for args in misses.values()]
+                                ),
+                            )
+                        )
+                        started = clock()
+                        groups = self._group_by_ttl(computed)
+                        if writer is not None:
+                            groups = await self._async_write_behind(writer, groups)
+                        for ttl, group in groups.items():
+                            await state.async_set_many(values=group, ttl=ttl)
+                        if metrics is not None:
+                            metrics.observe_set(clock() - started, sets=len(computed))
+                    return [
+                        computed[key][0] if value is MISS else value
+                        for key, value in zip(keys, values)
+                    ]
+            except Exception:
+                if metrics is not None:
+                    metrics.errors += 1
+                raise
+
+        async def invalidate(*args, **kwargs):
+            """
+            Delete the cached result of the call
+            """
+            key = key_of(args, kwargs)
+            if writer is not None:
+                writer.discard(key=key)
+            async with self._config.async_acquire_state() as state:
+                await state.async_delete(key=key)
+
+        async def clear():
+            """
+            Delete every cached result of the function
+            """
+            if writer is not None:
+                writer.discard_namespace(namespace=func_namespace)
+            async with self._config.async_acquire_state() as state:
+                await state.async_clear_namespace(namespace=func_namespace)
+
+        async_mimic.single_flight = async_flight
+        async_mimic.refresher = refresher
+        async_mimic.metrics = metrics
+        async_mimic.map = async_map
+        async_mimic.namespace = func_namespace
+        async_mimic.tags = self._tags
+        async_mimic.invalidate = invalidate
+        async_mimic.clear = clear
+        async_mimic.write_behind = writer
+        return async_mimic
+
+    def _sync_decorator(self, callable_obj: T) -> T:  # pylint: disable=R0914,R0915
+        """
+        Wrap a function
+        """
+        refresher = Refresher() if self._envelope else None
+        sync_flight = SingleFlight() if self._single_flight else None
+        metrics = self._register_metrics(callable_obj, sync_flight, refresher)
+        func_namespace = self._namespace(callable_obj)
+        key_of = self._key_of(callable_obj, func_namespace)
+        writer = self._writer()
+        clock = time.perf_counter
+
+        def sync_timed_call(args: tuple, kwargs: dict) -> tuple[any, float]:
+            started = clock()
+            value = callable_obj(*args, **kwargs)
+            delta = clock() - started
+            if metrics is not None:
+                metrics.compute.observe(delta)
+            return value, delta
+
+        def sync_store(  # pylint: disable=R0913
+            state: IState,
+            key: str,
+            value: any,
+            delta: float,
+            inline: bool = False,
+            replace: bool = False,
+        ):
+            started = clock()
+            packed, ttl = self._pack(value, delta), self._store_ttl(value)
+            if replace:
+                # A refresh overwrites the stale value still cached
+                if writer is not None:
+                    writer.discard(key=key)
+                state.sync_replace(key=key, value=packed, ttl=ttl)
+            elif writer is None:
+                state.sync_set(key=key, value=packed, ttl=ttl)
+            elif inline or not writer.sync_put(key=key, value=packed, ttl=ttl):
+                writer.discard(key=key)
+                state.sync_set(key=key, value=packed, ttl=ttl)
+            if metrics is not None:
+                metrics.observe_set(clock() - started, sets=1)
+
+        def sync_refresh(args_hash: str, args: tuple, kwargs: dict):
+            value, delta = sync_timed_call(args, kwargs)
+            with self._config.sync_acquire_state() as state:
+                sync_store(state, args_hash, value, delta, replace=True)
 
         @functools.wraps(callable_obj)
         def sync_mimic(*args, **kwargs):
-            args_hash = self._hash_args(
-                func_name=callable_obj.__name__, args=args, kwargs=kwargs
-            )
+            if metrics is not None:
+                started = clock()
+            args_hash = key_of(args, kwargs)
+            if metrics is not None:
+                metrics.key_hash.observe(clock() - started)
+                started = clock()
+            try:
+                with self._config.sync_acquire_state() as state:
+                    cached_value = state.sync_get(key=args_hash)
+                    if cached_value is MISS and writer is not None:
+                        cached_value = writer.pending(key=args_hash)
+                    if metrics is not None:
+                        hit = cached_value is not MISS
+                        metrics.observe_get(
+                            clock() - started, hits=int(hit), misses=int(not hit)
+                        )
+                    if cached_value is not MISS:
+                        value, expired = self._unpack(cached_value)
+                        if expired:
+                            refresher.sync_refresh(
+                                key=args_hash,
+                                func=functools.partial(
+                                    sync_refresh, args_hash, args, kwargs
+                                ),
+                            )
+                        return value
+
+                    def compute(inline: bool = False):
+                        value, delta = sync_timed_call(args, kwargs)
+                        sync_store(state, args_hash, value, delta, inline=inline)
+                        return value
+
+                    if sync_flight is None:
+                        return compute()
+
+                    def locked_compute():
+                        with state.sync_lock(key=args_hash) as locked_value:
+                            if locked_value is not MISS:
+                                return self._unpack(locked_value)[0]
+                            return compute(inline=True)
+
+                    return sync_flight.do(key=args_hash, func=locked_compute)
+            except Exception:
+                if metrics is not None:
+                    metrics.errors += 1
+                raise
+
+        def sync_map(  # pylint: disable=R0914
+            iterable_of_args: Iterable[tuple], concurrency: int = DEFAULT_CONCURRENCY
+        ) -> list:
+            """
+            Call the function for each args tuple (like itertools.starmap) with a
+            single multi-get, computing only the misses on a thread pool of
+            concurrency workers, and a single multi-set
+            """
+            calls = [tuple(args) for args in iterable_of_args]
+            started = clock()
+            keys = [key_of(args, {}) for args in calls]
+            if metrics is not None:
+                metrics.key_hash.observe(clock() - started)
+            try:
+                with self._config.sync_acquire_state() as state:
+                    started = clock()
+                    values = state.sync_get_many(keys=keys)
+                    if writer is not None:
+                        values = [
+                            writer.pending(key=key) if value is MISS else value
+                            for key, value in zip(keys, values)
+                        ]
+                    misses = {}
+                    for index, (key, args, cached_value) in enumerate(
+                        zip(keys, calls, values)
+                    ):
+                        if cached_value is MISS:
+                            misses[key] = args
+                            continue
+                        values[index], expired = self._unpack(cached_value)
+                        if expired:
+                            refresher.sync_refresh(
+                                key=key,
+                                func=functools.partial(sync_refresh, key, args, {}),
+                            )
+                    if metrics is not None:
+                        metrics.observe_get(
+                            clock() - started,
+                            hits=len(keys) - len(misses),
+                            misses=len(misses),
+                        )
+                    computed = {}
+                    if misses:
+                        with ThreadPoolExecutor(
+                            max_workers=min(concurrency, len(misses))
+                        ) as executor:
+                            computed = dict(
+                                zip(
+                                    misses,
+                                    executor.map(
+                                        lambda args: sync_timed_call(args, {}),
+                                        misses.values(),
+                                    ),
+                                )
+                            )
+                        started = clock()
+                        groups = self._group_by_ttl(computed)
+                        if writer is not None:
+                            groups = self._sync_write_behind(writer, groups)
+                        for ttl, group in groups.items():
+                            state.sync_set_many(values=group, ttl=ttl)
+                        if metrics is not None:
+                            metrics.observe_set(clock() - started, sets=len(computed))
+                    return [
+                        computed[key][0] if value is MISS else value
+                        for key, value in zip(keys, values)
+                    ]
+            except Exception:
+                if metrics is not None:
+                    metrics.errors += 1
+                raise
+
+        def sync_invalidate(*args, **kwargs):
+            """
+            Delete the cached result of the call
+            """
+            key = key_of(args, kwargs)
+            if writer is not None:
+                writer.discard(key=key)
+            with self._config.sync_acquire_state() as state:
+                state.sync_delete(key=key)
+
+        def sync_clear():
+            """
+            Delete every cached result of the function
+            """
+            if writer is not None:
+                writer.discard_namespace(namespace=func_namespace)
             with self._config.sync_acquire_state() as state:
-                if cached_value := state.sync_get(key=args_hash):
-                    return cached_value
-                value = callable_obj(*args, **kwargs)
-                state.sync_set(key=args_hash, value=value, ttl=self._ttl)
-                return value
+                state.sync_clear_namespace(namespace=func_namespace)
 
+        sync_mimic.single_flight = sync_flight
+        sync_mimic.refresher = refresher
+        sync_mimic.metrics = metrics
+        sync_mimic.map = sync_map
+        sync_mimic.namespace = func_namespace
+        sync_mimic.tags = self._tags
+        sync_mimic.invalidate = sync_invalidate
+        sync_mimic.clear = sync_clear
+        sync_mimic.write_behind = writer
         return sync_mimic
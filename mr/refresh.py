@@ -0,0 +1,128 @@
+"""
+Background refresh of cached values. Used by the stale-while-revalidate and the early
+refresh modes, the entries are stored in an envelope with their creation time and
+compute duration
+"""
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Optional
+
+# A plain tuple, so every serializer (pickle, marshal and json) can store it
+ENTRY_TAG = "mr.entry"
+REFRESH_WORKERS = 8
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def pack(value: any, created_at: float, delta: float) -> tuple:
+    """
+    Envelope stored in the states
+    :param value: Any. The function result
+    :param created_at: float. Timestamp of the computation end
+    :param delta: float. Seconds the computation took
+    :return: tuple
+    """
+    return (ENTRY_TAG, value, created_at, delta)
+
+
+def unpack(cached: any) -> Optional[tuple]:
+    """
+    Value, created_at and delta of an envelope, None when it is not an envelope
+    :param cached: Any. Value returned by a state
+    :return: Optional[tuple]
+    """
+    if (
+        isinstance(cached, (tuple, list))
+        and len(cached) == 4
+        and cached[0] == ENTRY_TAG
+    ):
+        return cached[1], cached[2], cached[3]
+    return None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor  # pylint: disable=W0603
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=REFRESH_WORKERS, thread_name_prefix="mr-refresh"
+            )
+        return _executor
+
+
+class Refresher:
+    """
+    Runs at most one background refresh per key. Sync refreshes run on a shared
+    thread pool and async ones as tasks of the running event loop. A failed refresh
+    keeps the cached value, the next call tries again
+    """
+
+    _lock: threading.Lock
+    _keys: set
+    _tasks: set[asyncio.Task]
+    refreshes: int
+
+    __slots__ = ("_lock", "_keys", "_tasks", "refreshes")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = set()
+        self._tasks = set()
+        self.refreshes = 0
+
+    def _claim(self, key: str) -> bool:
+        with self._lock:
+            if key in self._keys:
+                return False
+            self._keys.add(key)
+            self.refreshes += 1
+            return True
+
+    def _release(self, key: str):
+        with self._lock:
+            self._keys.discard(key)
+
+    def sync_refresh(self, key: str, func: Callable[[], any]) -> bool:
+        """
+        Schedule func on the thread pool unless the key is already refreshing
+        :param key: str
+        :param func: Callable without arguments
+        :return: bool. True when scheduled
+        """
+        if not self._claim(key):
+            return False
+        _get_executor().submit(self._run, key, func)
+        return True
+
+    def _run(self, key: str, func: Callable[[], any]):
+        try:
+            func()
+        except Exception:  # pylint: disable=W0718
+            pass
+        finally:
+            self._release(key)
+
+    def async_refresh(self, key: str, func: Callable[[], Awaitable]) -> bool:
+        """
+        Schedule func as a task unless the key is already refreshing
+        :param key: str
+        :param func: Coroutine function without arguments
+        :return: bool. True when scheduled
+        """
+        if not self._claim(key):
+            return False
+        task = asyncio.get_running_loop().create_task(self._async_run(key, func))
+        # The loop only keeps weak references to the tasks
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    async def _async_run(self, key: str, func: Callable[[], Awaitable]):
+        try:
+            await func()
+        except Exception:  # pylint: disable=W0718
+            pass
+        finally:
+            self._release(key)
@@ -2,15 +2,25 @@
 Import of  default state and extras
 """
 from mr.states.implementations.memory import MemoryState
+from mr.states.implementations.sqlite import SQLiteState
+from mr.states.implementations.tiered import TieredState
 
-__all__ = ["MemoryState"]
+__all__ = ["MemoryState", "SQLiteState", "TieredState"]
+
+# Shared memory state, needs fcntl (POSIX)
+try:
+    from .implementations.shared_memory import SharedMemoryState
+
+    __all__ += ["SharedMemoryState"]
+except ImportError as error:  # pragma: no cover
+    pass
 
 # Redis edition extra
 try:
     import redis.asyncio as redis
     from .implementations.redis import RedisState
 
-    __all__ += "RedisState"
+    __all__ += ["RedisState"]
 except ImportError as error:  # pragma: no cover
     pass
 
@@ -19,6 +29,6 @@ try:
     from aiofile import async_open
     from .implementations.temp import TempFileState
 
-    __all__ += "TempFileState"
+    __all__ += ["TempFileState"]
 except ImportError as error:  # pragma: no cover
     pass
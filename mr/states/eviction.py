@@ -0,0 +1,244 @@
+"""
+Eviction policies used by bounded states. Every operation is O(1) amortized
+"""
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Hashable
+
+
+class IEvictionPolicy(ABC):
+    """
+    Eviction policy interface. The policy only tracks keys, the state owns the values
+    """
+
+    @abstractmethod
+    def insert(self, key: Hashable):
+        """
+        A new key was stored
+        :param key: Hashable
+        :return:
+        """
+
+    @abstractmethod
+    def access(self, key: Hashable, hit: bool):
+        """
+        A key was requested
+        :param key: Hashable
+        :param hit: bool. False when the key is not stored
+        :return:
+        """
+
+    @abstractmethod
+    def remove(self, key: Hashable):
+        """
+        A key was removed by the state (expired, invalidated)
+        :param key: Hashable
+        :return:
+        """
+
+    @abstractmethod
+    def victim(self) -> Hashable:
+        """
+        Choose and forget the next key to be evicted
+        :return: Hashable
+        """
+
+    @abstractmethod
+    def __iter__(self):
+        """
+        Iterate over the tracked keys, most valuable first
+        """
+
+
+class LRUPolicy(IEvictionPolicy):
+    """
+    Least recently used
+    """
+
+    __slots__ = ("_order",)
+
+    def __init__(self, **_):
+        self._order = OrderedDict()
+
+    def insert(self, key: Hashable):
+        self._order[key] = None
+
+    def access(self, key: Hashable, hit: bool):
+        if hit:
+            self._order.move_to_end(key)
+
+    def remove(self, key: Hashable):
+        self._order.pop(key, None)
+
+    def victim(self) -> Hashable:
+        return self._order.popitem(last=False)[0]
+
+    def __iter__(self):
+        return reversed(self._order)
+
+
+class LFUPolicy(IEvictionPolicy):
+    """
+    Least frequently used, ties are broken by recency
+    """
+
+    __slots__ = ("_frequency", "_buckets", "_min_frequency")
+
+    def __init__(self, **_):
+        self._frequency: dict[Hashable, int] = {}
+        self._buckets: dict[int, OrderedDict] = {}
+        self._min_frequency = 0
+
+    def insert(self, key: Hashable):
+        self._frequency[key] = 1
+        self._buckets.setdefault(1, OrderedDict())[key] = None
+        self._min_frequency = 1
+
+    def access(self, key: Hashable, hit: bool):
+        if not hit:
+            return
+        frequency = self._frequency[key]
+        self._unlink(key, frequency)
+        self._frequency[key] = frequency + 1
+        self._buckets.setdefault(frequency + 1, OrderedDict())[key] = None
+
+    def remove(self, key: Hashable):
+        if (frequency := self._frequency.pop(key, None)) is not None:
+            self._unlink(key, frequency)
+
+    def victim(self) -> Hashable:
+        if self._min_frequency not in self._buckets:
+            self._min_frequency = min(self._buckets)
+        bucket = self._buckets[self._min_frequency]
+        key = bucket.popitem(last=False)[0]
+        if not bucket:
+            del self._buckets[self._min_frequency]
+        del self._frequency[key]
+        return key
+
+    def _unlink(self, key: Hashable, frequency: int):
+        bucket = self._buckets[frequency]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[frequency]
+            if self._min_frequency == frequency:
+                self._min_frequency = frequency + 1
+
+    def __iter__(self):
+        for frequency in sorted(self._buckets, reverse=True):
+            yield from reversed(self._buckets[frequency])
+
+
+class CountMinSketch:
+    """
+    4 bit count-min sketch with periodic aging, used to estimate access frequency
+    """
+
+    _depth = 4
+    _max_count = 15
+
+    __slots__ = ("_rows", "_mask", "_additions", "_sample_size")
+
+    def __init__(self, width: int):
+        width = 1 << max(width - 1, 1).bit_length()
+        self._rows = [bytearray(width) for _ in range(self._depth)]
+        self._mask = width - 1
+        self._additions = 0
+        self._sample_size = width * 10
+
+    def _indexes(self, key: Hashable):
+        key_hash = hash(key)
+        for seed in (0x9E3779B1, 0x85EBCA77, 0xC2B2AE3D, 0x27D4EB2F):
+            key_hash = (key_hash * seed + (key_hash >> 16)) & 0xFFFFFFFFFFFF
+            yield (key_hash >> 8) & self._mask
+
+    def add(self, key: Hashable):
+        """
+        Increment key frequency
+        :param key: Hashable
+        :return:
+        """
+        for row, index in zip(self._rows, self._indexes(key)):
+            if row[index] < self._max_count:
+                row[index] += 1
+        self._additions += 1
+        if self._additions >= self._sample_size:
+            self._reset()
+
+    def estimate(self, key: Hashable) -> int:
+        """
+        Estimated key frequency
+        :param key: Hashable
+        :return: int
+        """
+        return min(row[index] for row, index in zip(self._rows, self._indexes(key)))
+
+    def _reset(self):
+        self._additions //= 2
+        for row in self._rows:
+            row[:] = bytes(count >> 1 for count in row)
+
+
+class TinyLFUPolicy(IEvictionPolicy):
+    """
+    W-TinyLFU style policy. New keys land on a small LRU window, keys leaving the
+    window only replace the main LRU victim when the sketch says they are more
+    frequently requested
+    """
+
+    __slots__ = ("_window", "_main", "_sketch", "_window_ratio")
+
+    def __init__(self, sketch_width: int = 4096, window_ratio: float = 0.01, **_):
+        self._window = OrderedDict()
+        self._main = OrderedDict()
+        self._sketch = CountMinSketch(width=sketch_width)
+        self._window_ratio = window_ratio
+
+    def insert(self, key: Hashable):
+        self._sketch.add(key)
+        self._window[key] = None
+        window_limit = max(
+            1, int((len(self._window) + len(self._main)) * self._window_ratio)
+        )
+        if len(self._window) > window_limit:
+            self._main[self._window.popitem(last=False)[0]] = None
+
+    def access(self, key: Hashable, hit: bool):
+        self._sketch.add(key)
+        if not hit:
+            return
+        if key in self._window:
+            self._window.move_to_end(key)
+        else:
+            self._main.move_to_end(key)
+
+    def remove(self, key: Hashable):
+        if key in self._window:
+            del self._window[key]
+        else:
+            self._main.pop(key, None)
+
+    def victim(self) -> Hashable:
+        if not self._main:
+            return self._window.popitem(last=False)[0]
+        if not self._window:
+            return self._main.popitem(last=False)[0]
+        candidate = next(iter(self._window))
+        victim = next(iter(self._main))
+        del self._window[candidate]
+        if self._sketch.estimate(candidate) > self._sketch.estimate(victim):
+            del self._main[victim]
+            self._main[candidate] = None
+            return victim
+        return candidate
+
+    def __iter__(self):
+        yield from reversed(self._window)
+        yield from reversed(self._main)
+
+
+POLICIES: dict[str, type[IEvictionPolicy]] = {
+    "LRU": LRUPolicy,
+    "LFU": LFUPolicy,
+    "TINYLFU": TinyLFUPolicy,
+}
@@ -1,44 +1,491 @@
 """
 Memory state implementation
 """
+import atexit
+import heapq
+import itertools
+import os
+import pickle
+import sys
+import threading
+import weakref
 from datetime import datetime
 from inspect import _empty
+from pathlib import Path
+from typing import Callable, Optional
 
-from mr.states.interface import IState
+from mr.states.eviction import IEvictionPolicy, POLICIES
+from mr.states.interface import IState, MISS, namespace_of
 
+SNAPSHOT_HEADER = "mr.snapshot"
+SNAPSHOT_VERSION = 1
 
-class MemoryState(IState):
+
+class MemoryState(IState):  # pylint: disable=R0902
     """
     State that use hash table to save cached returns
     """
 
     _state: dict[int, any]
     _kwargs: dict[str, any]
+    _lock: threading.RLock
+    _max_entries: Optional[int]
+    _max_bytes: Optional[int]
+    _size_of: Callable[[any], int]
+    _sizes: dict[int, int]
+    _bytes: int
+    _policy: Optional[IEvictionPolicy]
+    _expiry: list[tuple[float, int, any]]
+    _expiry_counter: itertools.count
+    _expire_step: int
+    _sweeper: Optional[threading.Thread]
+    _snapshotter: Optional[threading.Thread]
+    _snapshot_path: Optional[str]
+    _stop: threading.Event
+    _generations: dict[str, int]
+    evictions: int
+    expirations: int
 
-    __slots__ = ("_state", "_kwargs")
+    __slots__ = (
+        "_state",
+        "_kwargs",
+        "_lock",
+        "_max_entries",
+        "_max_bytes",
+        "_size_of",
+        "_sizes",
+        "_bytes",
+        "_policy",
+        "_expiry",
+        "_expiry_counter",
+        "_expire_step",
+        "_sweeper",
+        "_snapshotter",
+        "_snapshot_path",
+        "_stop",
+        "_generations",
+        "evictions",
+        "expirations",
+    )
 
     def __init__(self, **kwargs):
         self._kwargs = kwargs
         self._state = {}
+        self._lock = threading.RLock()
+        self._max_entries = kwargs.get("MAX_ENTRIES")
+        self._max_bytes = kwargs.get("MAX_BYTES")
+        self._size_of = kwargs.get("SIZE_OF", sys.getsizeof)
+        self._sizes = {}
+        self._bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._expiry = []
+        self._expiry_counter = itertools.count()
+        self._expire_step = kwargs.get("EXPIRE_STEP", 16)
+        self._sweeper = None
+        self._snapshotter = None
+        self._stop = threading.Event()
+        self._generations = {}
+        if (sweep_interval := kwargs.get("SWEEP_INTERVAL")) is not None:
+            self._sweeper = threading.Thread(
+                target=self._sweep,
+                args=(weakref.ref(self), sweep_interval, self._stop),
+                name="mr-memory-sweeper",
+                daemon=True,
+            )
+            self._sweeper.start()
+        self._policy = None
+        if self._max_entries is not None or self._max_bytes is not None:
+            policy_name = kwargs.get("EVICTION_POLICY", "LRU")
+            try:
+                policy_class = POLICIES[policy_name.upper()]
+            except (KeyError, AttributeError) as exception:
+                raise KeyError(
+                    f"The config value EVICTION_POLICY must be one of {list(POLICIES)}"
+                ) from exception
+            self._policy = policy_class(**kwargs.get("EVICTION_POLICY_KWARGS", {}))
+        self._snapshot_path = kwargs.get("SNAPSHOT_PATH")
+        if self._snapshot_path is not None:
+            if os.path.exists(self._snapshot_path):
+                self.load_snapshot(max_entries=kwargs.get("SNAPSHOT_LOAD_MAX_ENTRIES"))
+            if (snapshot_interval := kwargs.get("SNAPSHOT_INTERVAL")) is not None:
+                self._snapshotter = threading.Thread(
+                    target=self._snapshot_forever,
+                    args=(weakref.ref(self), snapshot_interval, self._stop),
+                    name="mr-memory-snapshot",
+                    daemon=True,
+                )
+                self._snapshotter.start()
+            atexit.register(self._snapshot_at_exit, weakref.ref(self))
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """
+        State counters, useful to size the cache
+        @return:
+        """
+        return {
+            "entries": len(self._state),
+            "bytes": self._bytes,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+    @staticmethod
+    def _deadline(register: dict) -> Optional[float]:
+        _ttl = register.get("ttl")
+        if _ttl in (_empty, None):
+            return None
+        return register.get("created_at") + _ttl
+
+    def purge_expired(self, max_entries: Optional[int] = None) -> int:
+        """
+        Remove expired entries in deadline order. The work is bounded by max_entries
+        so a purge step never holds the state for long
+        @param max_entries: int. Default EXPIRE_STEP
+        @return: int. Removed entries
+        """
+        max_entries = self._expire_step if max_entries is None else max_entries
+        now_timestamp = datetime.utcnow().timestamp()
+        purged = 0
+        with self._lock:
+            while self._expiry and purged < max_entries:
+                deadline, _, key = self._expiry[0]
+                if deadline >= now_timestamp:
+                    break
+                heapq.heappop(self._expiry)
+                purged += 1
+                register = self._state.get(key)
+                # The key may have been overwritten with a new deadline
+                if register is not None and self._deadline(register) == deadline:
+                    self._remove(key)
+                    self.expirations += 1
+        return purged
+
+    def close(self):
+        """
+        Stop the background threads and write the snapshot when SNAPSHOT_PATH is set
+        @return:
+        """
+        self._stop.set()
+        if self._snapshot_path is not None:
+            self.snapshot()
+
+    def _live_registers(self) -> list[tuple[any, dict]]:
+        """
+        The entries most valuable first for the eviction policy, else the most
+        recently stored first. Only the references are copied under the lock
+        """
+        with self._lock:
+            keys = reversed(self._state) if self._policy is None else self._policy
+            return [
+                (key, register)
+                for key in keys
+                if (register := self._state.get(key)) is not None
+            ]
+
+    def snapshot(self, path: Optional[str] = None) -> int:
+        """
+        Write the live entries with their remaining ttl to a file, most valuable
+        first. The file is replaced atomically and the values that can't be pickled
+        are skipped
+        @param path: str. Default SNAPSHOT_PATH
+        @return: int. Written entries
+        """
+        path = Path(path or self._snapshot_path)
+        now_timestamp = datetime.utcnow().timestamp()
+        temporary = path.with_name(
+            f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+        )
+        written = 0
+        try:
+            with open(temporary, "wb") as file:
+                file.write(
+                    pickle.dumps(
+                        (SNAPSHOT_HEADER, SNAPSHOT_VERSION, now_timestamp),
+                        protocol=pickle.HIGHEST_PROTOCOL,
+                    )
+                )
+                for key, register in self._live_registers():
+                    deadline = self._deadline(register)
+                    if not self._current(register) or (
+                        deadline is not None and deadline < now_timestamp
+                    ):
+                        continue
+                    remaining = None if deadline is None else deadline - now_timestamp
+                    try:
+                        record = pickle.dumps(
+                            (key, register["value"], remaining),
+                            protocol=pickle.HIGHEST_PROTOCOL,
+                        )
+                    except (pickle.PicklingError, TypeError, AttributeError):
+                        continue
+                    file.write(record)
+                    written += 1
+            os.replace(temporary, path)
+        finally:
+            temporary.unlink(missing_ok=True)
+        return written
+
+    def load_snapshot(
+        self, path: Optional[str] = None, max_entries: Optional[int] = None
+    ) -> int:
+        """
+        Load the entries of a snapshot one at a time, so it is never fully in memory.
+        The time since the snapshot was written is taken from the remaining ttl
+        @param path: str. Default SNAPSHOT_PATH
+        @param max_entries: int. Load only the first (most valuable) entries
+        @return: int. Loaded entries
+        """
+        now_timestamp = datetime.utcnow().timestamp()
+        loaded = []
+        with open(path or self._snapshot_path, "rb") as file:
+            unpickler = pickle.Unpickler(file)
+            try:
+                header, version, created_at = unpickler.load()
+            except (EOFError, pickle.UnpicklingError, TypeError, ValueError):
+                header, version, created_at = None, None, None
+            if header != SNAPSHOT_HEADER or version != SNAPSHOT_VERSION:
+                raise ValueError(f"{file.name} is not a MemoryState snapshot")
+            elapsed = now_timestamp - created_at
+            while max_entries is None or len(loaded) < max_entries:
+                try:
+                    key, value, remaining = unpickler.load()
+                except (EOFError, pickle.UnpicklingError):
+                    # The end of the file, or a truncated one
+                    break
+                if remaining is not None and (remaining := remaining - elapsed) <= 0:
+                    continue
+                with self._lock:
+                    self._set(
+                        key=key,
+                        value=value,
+                        ttl=_empty if remaining is None else remaining,
+                        created_at=now_timestamp,
+                    )
+                    # The next entries are less valuable, stop at the state budget
+                    if self._policy is not None and self._over_budget():
+                        self._remove(key)
+                        break
+                loaded.append(key)
+        with self._lock:
+            # Store or touch the most valuable keys last so they are evicted last,
+            # and written first by the next snapshot
+            for key in reversed(loaded):
+                if key not in self._state:
+                    continue
+                if self._policy is None:
+                    self._state[key] = self._state.pop(key)
+                else:
+                    self._policy.access(key, hit=True)
+        return len(loaded)
+
+    @staticmethod
+    def _snapshot_at_exit(state_ref: weakref.ref):
+        # pylint: disable=W0212
+        if (state := state_ref()) is not None and not state._stop.is_set():
+            state.snapshot()
+
+    @staticmethod
+    def _snapshot_forever(
+        state_ref: weakref.ref, interval: float, stop: threading.Event
+    ):
+        while not stop.wait(interval):
+            if (state := state_ref()) is None:
+                return
+            try:
+                state.snapshot()
+            except OSError:
+                # Tried again on the next interval
+                pass
+            del state
+
+    @staticmethod
+    def _sweep(state_ref: weakref.ref, interval: float, stop: threading.Event):
+        while not stop.wait(interval):
+            if (state := state_ref()) is None:
+                return
+            step = state._expire_step  # pylint: disable=W0212
+            while state.purge_expired(step) == step:
+                pass
+            del state
 
     def sync_get(self, key: str):
+        return self._get(key=key, now_timestamp=datetime.utcnow().timestamp())
+
+    def sync_get_many(self, keys: list[str]) -> list:
+        now_timestamp = datetime.utcnow().timestamp()
+        return [self._get(key=key, now_timestamp=now_timestamp) for key in keys]
+
+    def sync_get_many_with_ttl(self, keys: list[str]) -> list[tuple]:
         now_timestamp = datetime.utcnow().timestamp()
-        if register := self._state.get(key):
+        values = []
+        for key in keys:
+            value = self._get(key=key, now_timestamp=now_timestamp)
+            register = None if value is MISS else self._state.get(key)
+            deadline = None if register is None else self._deadline(register)
+            values.append(
+                (value, None if deadline is None else deadline - now_timestamp)
+            )
+        return values
+
+    def _get(self, key: str, now_timestamp: float):
+        if self._policy is None:
+            register = self._state.get(key)
+        else:
+            with self._lock:
+                # Same lock as the lookup, or a concurrent eviction could drop the
+                # key before the policy sees the hit
+                register = self._state.get(key)
+                self._policy.access(key, hit=register is not None)
+        if register is not None:
+            if not self._current(register):
+                with self._lock:
+                    if self._state.get(key) is register:
+                        self._remove(key)
+                return MISS
             _ttl = register.get("ttl")
             if _ttl == _empty or ((register.get("created_at") + _ttl) >= now_timestamp):
                 return register.get("value")
-        return None
+            with self._lock:
+                if self._state.get(key) is register:
+                    self._remove(key)
+                    self.expirations += 1
+        return MISS
+
+    def _current(self, register: dict) -> bool:
+        """
+        The entry was stored after the last clear of its namespace
+        """
+        namespace = register.get("namespace")
+        return namespace is None or register.get("generation") == self._generations.get(
+            namespace, 0
+        )
 
     def sync_set(self, key: str, value: any, ttl: int = _empty):
+        with self._lock:
+            self._set(
+                key=key,
+                value=value,
+                ttl=ttl,
+                created_at=datetime.utcnow().timestamp(),
+            )
+            self.purge_expired()
+            if self._policy is not None:
+                self._evict()
+
+    def sync_set_many(self, values: dict[str, any], ttl: int = _empty):
+        created_at = datetime.utcnow().timestamp()
+        with self._lock:
+            for key, value in values.items():
+                self._set(key=key, value=value, ttl=ttl, created_at=created_at)
+            self.purge_expired()
+            if self._policy is not None:
+                self._evict()
+
+    def _set(self, key: str, value: any, ttl: int, created_at: float):
         value = {
-            "created_at": datetime.utcnow().timestamp(),
+            "created_at": created_at,
             "ttl": ttl,
             "value": value,
         }
+        if (namespace := namespace_of(key)) is not None:
+            value["namespace"] = namespace
+            value["generation"] = self._generations.get(namespace, 0)
+        exists = key in self._state
         self._state.update({key: value})
+        if (deadline := self._deadline(value)) is not None:
+            heapq.heappush(self._expiry, (deadline, next(self._expiry_counter), key))
+            if len(self._expiry) > 2 * len(self._state):
+                self._compact_expiry()
+        if self._policy is not None:
+            if self._max_bytes is not None:
+                size = self._size_of(value["value"])
+                self._bytes += size - self._sizes.get(key, 0)
+                self._sizes[key] = size
+            if exists:
+                self._policy.access(key, hit=True)
+            else:
+                self._policy.insert(key)
+
+    def _compact_expiry(self):
+        """
+        Rebuild the deadline heap from the stored entries. Overwritten, deleted and
+        evicted keys leave their deadlines behind, the heap would grow without bound
+        """
+        self._expiry = [
+            (deadline, next(self._expiry_counter), key)
+            for key, register in self._state.items()
+            if (deadline := self._deadline(register)) is not None
+        ]
+        heapq.heapify(self._expiry)
+
+    def _over_budget(self) -> bool:
+        return (
+            self._max_entries is not None and len(self._state) > self._max_entries
+        ) or (self._max_bytes is not None and self._bytes > self._max_bytes)
+
+    def _evict(self):
+        while self._state and self._over_budget():
+            self._delete(self._policy.victim())
+            self.evictions += 1
+
+    def _delete(self, key: str):
+        del self._state[key]
+        self._bytes -= self._sizes.pop(key, 0)
+
+    def _remove(self, key: str):
+        self._delete(key)
+        if self._policy is not None:
+            self._policy.remove(key)
+
+    def sync_delete(self, key: str):
+        """
+        Remove the key
+        @param key: str
+        @return:
+        """
+        with self._lock:
+            if key in self._state:
+                self._remove(key)
+
+    def sync_clear_namespace(self, namespace: str):
+        """
+        Remove every key of the namespace in O(1): the namespace generation is
+        bumped, older entries are dropped when read, expired or evicted
+        @param namespace: str
+        @return:
+        """
+        with self._lock:
+            self._generations[namespace] = self._generations.get(namespace, 0) + 1
+
+    def sync_clear(self):
+        """
+        Remove every key
+        @return:
+        """
+        with self._lock:
+            for key in list(self._state):
+                self._remove(key)
+            self._expiry.clear()
 
     async def async_get(self, key: str):
         return self.sync_get(key)
 
     async def async_set(self, key: str, value: any, ttl: int = _empty):
         return self.sync_set(key=key, value=value, ttl=ttl)
+
+    async def async_get_many(self, keys: list[str]) -> list:
+        return self.sync_get_many(keys=keys)
+
+    async def async_delete(self, key: str):
+        return self.sync_delete(key=key)
+
+    async def async_clear_namespace(self, namespace: str):
+        return self.sync_clear_namespace(namespace=namespace)
+
+    async def async_set_many(self, values: dict[str, any], ttl: int = _empty):
+        return self.sync_set_many(values=values, ttl=ttl)
+
+    async def async_get_many_with_ttl(self, keys: list[str]) -> list[tuple]:
+        return self.sync_get_many_with_ttl(keys=keys)
@@ -1,68 +1,978 @@
 """
 Memory state implementation
 """
-import pickle
+import asyncio
+import itertools
+import random
+import re
+import threading
+import uuid
+import time
+import weakref
 from contextlib import contextmanager, asynccontextmanager
 from inspect import _empty
+from typing import Awaitable, Callable, Optional
 
 from redis.asyncio.client import Redis as AsyncRedis
+from redis.asyncio.connection import (
+    BlockingConnectionPool as AsyncBlockingConnectionPool,
+)
 from redis.client import Redis as SyncRedis
+from redis.exceptions import RedisError
+from redis.connection import BlockingConnectionPool as SyncBlockingConnectionPool
 
 
-from mr.states.interface import IState
+from mr.states import serializers
+from mr.states.implementations.memory import MemoryState
+from mr.states.interface import IState, MISS, NAMESPACE_SEPARATOR, namespace_of
 
+# Keys removed per round trip by clear_namespace
+CLEAR_BATCH = 500
+# Characters with a meaning in a SCAN MATCH pattern
+GLOB_SPECIAL = re.compile(r"([*?\[\]\\])")
 
-class RedisState(IState):
+# Returns {"v", value} when the key is cached, else {"l"} when the lease was granted
+# or {"w", lease pttl} when another client holds it
+LOCK_OR_GET = """
+local value = redis.call("GET", KEYS[1])
+if value then
+    return {"v", value}
+end
+if redis.call("SET", KEYS[2], ARGV[1], "NX", "PX", ARGV[2]) then
+    return {"l"}
+end
+return {"w", redis.call("PTTL", KEYS[2])}
+"""
+
+# Indexes the keys of a namespace, ARGV = score, pttl ("" when the keys never expire)
+# and the keys. The index lives as long as its longest lived key, a persistent index
+# stays persistent
+INDEX = """
+local pttl = redis.call("PTTL", KEYS[1])
+for i = 3, #ARGV do
+    redis.call("ZADD", KEYS[1], ARGV[1], ARGV[i])
+end
+if ARGV[2] == "" then
+    redis.call("PERSIST", KEYS[1])
+elseif pttl == -2 or (pttl >= 0 and pttl < tonumber(ARGV[2])) then
+    redis.call("PEXPIRE", KEYS[1], ARGV[2])
+end
+"""
+
+# Deletes the lease only when it is still held by the token
+RELEASE = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+# Extends the lease only when it is still held by the token
+RENEW = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("PEXPIRE", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class PoolStats:  # pylint: disable=R0902
+    """
+    Connection pool counters, used to tune MAX_CONNECTIONS under load
+    """
+
+    __slots__ = (
+        "_lock",
+        "max_connections",
+        "in_use",
+        "peak_in_use",
+        "acquired",
+        "waited",
+        "wait_time",
+        "max_wait_time",
+    )
+
+    def __init__(self, max_connections: int):
+        self._lock = threading.Lock()
+        self.max_connections = max_connections
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.acquired = 0
+        self.waited = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def acquire(self, wait_time: float):
+        """
+        A connection was taken from the pool after waiting wait_time seconds
+        :param wait_time: float
+        :return:
+        """
+        with self._lock:
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            self.acquired += 1
+            self.wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+
+    def release(self):
+        """
+        A connection was given back to the pool
+        :return:
+        """
+        with self._lock:
+            self.in_use -= 1
+
+    def failed(self, wait_time: float):
+        """
+        No connection was available before the pool timeout
+        :param wait_time: float
+        :return:
+        """
+        with self._lock:
+            self.waited += 1
+            self.wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+
+    def as_dict(self) -> dict:
+        """
+        Counters snapshot
+        :return: dict
+        """
+        with self._lock:
+            return {
+                "max_connections": self.max_connections,
+                "in_use": self.in_use,
+                "peak_in_use": self.peak_in_use,
+                "saturation": self.in_use / self.max_connections,
+                "acquired": self.acquired,
+                "timeouts": self.waited,
+                "avg_wait_time": self.wait_time / max(self.acquired + self.waited, 1),
+                "max_wait_time": self.max_wait_time,
+            }
+
+
+class _SyncPool(SyncBlockingConnectionPool):
+    """
+    Thread-safe blocking pool that records the connection wait time
+    """
+
+    def __init__(self, stats: PoolStats, **kwargs):
+        self.stats = stats
+        self._handed_out = weakref.WeakSet()
+        super().__init__(**kwargs)
+
+    def get_connection(self, command_name, *keys, **options):
+        started = time.perf_counter()
+        try:
+            connection = super().get_connection(command_name, *keys, **options)
+        except BaseException:
+            self.stats.failed(time.perf_counter() - started)
+            raise
+        self.stats.acquire(time.perf_counter() - started)
+        self._handed_out.add(connection)
+        return connection
+
+    def release(self, connection):
+        if connection in self._handed_out:
+            self._handed_out.discard(connection)
+            self.stats.release()
+        super().release(connection)
+
+
+class _AsyncPool(AsyncBlockingConnectionPool):
+    """
+    Event loop bound blocking pool that records the connection wait time
+    """
+
+    def __init__(self, stats: PoolStats, **kwargs):
+        self.stats = stats
+        self._handed_out = weakref.WeakSet()
+        super().__init__(**kwargs)
+
+    async def get_connection(self, command_name, *keys, **options):
+        started = time.perf_counter()
+        try:
+            connection = await super().get_connection(command_name, *keys, **options)
+        except BaseException:
+            self.stats.failed(time.perf_counter() - started)
+            raise
+        self.stats.acquire(time.perf_counter() - started)
+        self._handed_out.add(connection)
+        return connection
+
+    async def release(self, connection):
+        if connection in self._handed_out:
+            self._handed_out.discard(connection)
+            self.stats.release()
+        await super().release(connection)
+
+
+class _GetBatcher:  # pylint: disable=R0902,R0903
+    """
+    Coalesces the async gets of an event loop into multi-gets, like a DataLoader.
+    The keys asked in the same loop iteration, or window seconds, are fetched with
+    a single call and every awaiter gets its own value
+    """
+
+    __slots__ = (
+        "_fetch",
+        "_window",
+        "_max_keys",
+        "_waiters",
+        "_handle",
+        "_tasks",
+        "gets",
+        "batches",
+    )
+
+    def __init__(
+        self,
+        fetch: Callable[[list[str]], Awaitable[list]],
+        window: float,
+        max_keys: int,
+    ):
+        self._fetch = fetch
+        self._window = window
+        self._max_keys = max_keys
+        self._waiters: dict[str, list[asyncio.Future]] = {}
+        self._handle: Optional[asyncio.Handle] = None
+        self._tasks: set[asyncio.Task] = set()
+        self.gets = 0
+        self.batches = 0
+
+    def load(self, key: str) -> asyncio.Future:
+        """
+        Queue the key for the next multi-get
+        :param key: str
+        :return: Future of the value or MISS
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._waiters.setdefault(key, []).append(future)
+        self.gets += 1
+        if len(self._waiters) >= self._max_keys:
+            self._dispatch()
+        elif self._handle is None:
+            self._handle = (
+                loop.call_later(self._window, self._dispatch)
+                if self._window
+                else loop.call_soon(self._dispatch)
+            )
+        return future
+
+    def _dispatch(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        waiters, self._waiters = self._waiters, {}
+        self.batches += 1
+        # The loop keeps weak references to its tasks
+        task = asyncio.get_running_loop().create_task(self._run(waiters))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, waiters: dict[str, list[asyncio.Future]]):
+        try:
+            values = await self._fetch(list(waiters))
+        except asyncio.CancelledError:
+            for futures in waiters.values():
+                for future in futures:
+                    future.cancel()
+            raise
+        except Exception as exception:  # pylint: disable=W0718
+            for futures in waiters.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(exception)
+            return
+        for futures, value in zip(waiters.values(), values):
+            for future in futures:
+                # The awaiter may have been cancelled
+                if not future.done():
+                    future.set_result(value)
+
+
+class RedisState(IState):  # pylint: disable=R0902,R0904
     """
     State that use hash table to save cached returns
     """
 
-    __async_state: AsyncRedis = None
-    __sync_state: SyncRedis = None
+    _pool_kwarg_names = {
+        "SOCKET_TIMEOUT": "socket_timeout",
+        "SOCKET_CONNECT_TIMEOUT": "socket_connect_timeout",
+        "SOCKET_KEEPALIVE": "socket_keepalive",
+        "HEALTH_CHECK_INTERVAL": "health_check_interval",
+        "POOL_TIMEOUT": "timeout",
+    }
+
+    INVALIDATE_ALL = "*"
 
     @contextmanager
     def _sync_state(self) -> SyncRedis:
         """
-        Get redis sync client
+        Get redis sync client, shared by all threads
         :return: SyncRedis
         """
-
         if self.__sync_state is None:
-            self.__sync_state = SyncRedis.from_url(url=self.redis_url)
+            with self.__sync_lock:
+                if self.__sync_state is None:
+                    self.__sync_state = SyncRedis(
+                        connection_pool=_SyncPool.from_url(
+                            url=self.redis_url,
+                            stats=self.__sync_stats,
+                            **self._pool_kwargs,
+                        )
+                    )
         yield self.__sync_state
 
     @asynccontextmanager
     async def _async_state(self) -> AsyncRedis:
         """
-        Get redis async client
-        :return: SyncRedis
+        Get redis async client, one for each event loop
+        :return: AsyncRedis
         """
-        if self.__async_state is None:
-            self.__async_state = AsyncRedis.from_url(url=self.redis_url)
-        yield self.__async_state
+        loop = asyncio.get_running_loop()
+        if (state := self.__async_states.get(loop)) is None:
+            state = self.__async_states[loop] = AsyncRedis(
+                connection_pool=_AsyncPool.from_url(
+                    url=self.redis_url,
+                    stats=self.__async_stats,
+                    **self._pool_kwargs,
+                )
+            )
+        yield state
 
     def __init__(self, **kwargs):
         try:
             self.redis_url = kwargs["REDIS_URL"]
         except KeyError as exception:
             raise KeyError("The config value REDIS_URL was not informed") from exception
+        max_connections = kwargs.get("MAX_CONNECTIONS", 50)
+        self._pool_kwargs = (
+            {"max_connections": max_connections}
+            | {
+                pool_kwarg: kwargs[name]
+                for name, pool_kwarg in self._pool_kwarg_names.items()
+                if name in kwargs
+            }
+            | kwargs.get("CONNECTION_KWARGS", {})
+        )
+        self._serializer = serializers.from_kwargs(kwargs)
+        self._near = None
+        if kwargs.get("NEAR_CACHE"):
+            self._near = MemoryState(
+                MAX_ENTRIES=kwargs.get("NEAR_CACHE_MAX_ENTRIES", 10_000)
+            )
+        self._near_ttl = kwargs.get("NEAR_CACHE_TTL", 60)
+        self._near_lock = threading.Lock()
+        # Invalidations received, the epoch of the last full clear and, for the keys
+        # being fetched only, the in-flight fetches and the epoch of their last
+        # invalidation
+        self._near_epoch = 0
+        self._near_cleared = 0
+        self._near_reads: dict[str, int] = {}
+        self._near_invalidated: dict[str, int] = {}
+        self._channel = kwargs.get("INVALIDATION_CHANNEL", "mr:invalidate")
+        self._index = kwargs.get("NAMESPACE_INDEX", True)
+        self._index_prefix = kwargs.get("NAMESPACE_INDEX_PREFIX", "mr:ns:")
+        self._index_trim_every = kwargs.get("NAMESPACE_INDEX_TRIM_EVERY", 256)
+        self._index_writes = itertools.count(1)
+        self._lock_prefix = kwargs.get("LOCK_PREFIX", "mr:lock:")
+        self._lock_lease = kwargs.get("LOCK_LEASE", 10)
+        self._lock_poll = kwargs.get("LOCK_POLL_INTERVAL", 0.005)
+        self._lock_poll_max = kwargs.get("LOCK_POLL_MAX", 0.25)
+        self._get_batch = kwargs.get("GET_BATCH", False)
+        self._get_batch_window = kwargs.get("GET_BATCH_WINDOW", 0)
+        self._get_batch_max_keys = kwargs.get("GET_BATCH_MAX_KEYS", 1_000)
+        self._get_batchers = weakref.WeakKeyDictionary()
+        self._listener = None
+        self._listener_lock = threading.Lock()
+        self.__sync_state = None
+        self.__sync_lock = threading.Lock()
+        self.__sync_stats = PoolStats(max_connections=max_connections)
+        self.__async_states = weakref.WeakKeyDictionary()
+        self.__async_stats = PoolStats(max_connections=max_connections)
+
+    @property
+    def pool_stats(self) -> dict:
+        """
+        Pool saturation and wait time counters. The async counters are shared by the
+        pools of every event loop
+        :return: dict
+        """
+        return {
+            "sync": self.__sync_stats.as_dict(),
+            "async": self.__async_stats.as_dict(),
+        }
+
+    @property
+    def get_batch_stats(self) -> dict:
+        """
+        Async gets and the multi-gets that fetched them, summed over the event loops
+        :return: dict
+        """
+        batchers = list(self._get_batchers.values())
+        return {
+            "gets": sum(batcher.gets for batcher in batchers),
+            "batches": sum(batcher.batches for batcher in batchers),
+        }
+
+    def _get_batcher(self) -> _GetBatcher:
+        """
+        Get the get batcher, one for each event loop
+        :return: _GetBatcher
+        """
+        loop = asyncio.get_running_loop()
+        if (batcher := self._get_batchers.get(loop)) is None:
+            batcher = self._get_batchers[loop] = _GetBatcher(
+                fetch=self.async_get_many,
+                window=self._get_batch_window,
+                max_keys=self._get_batch_max_keys,
+            )
+        return batcher
+
+    @staticmethod
+    def _ex(ttl: int):
+        return None if ttl in (_empty, None) else ttl
+
+    def _near_cache(self) -> Optional[MemoryState]:
+        """
+        Get the near-cache, subscribing to the invalidation channel on first use
+        :return: MemoryState or None when disabled
+        """
+        if self._near is not None and self._listener is None:
+            with self._listener_lock:
+                if self._listener is None:
+                    with self._sync_state() as state:
+                        pubsub = state.pubsub(ignore_subscribe_messages=True)
+                        pubsub.subscribe(**{self._channel: self._on_invalidation})
+                        self._listener = pubsub.run_in_thread(
+                            sleep_time=1.0,
+                            daemon=True,
+                            exception_handler=self._on_listener_error,
+                        )
+        return self._near
+
+    def _on_invalidation(self, message: dict):
+        key = message["data"]
+        key = key.decode() if isinstance(key, bytes) else key
+        with self._near_lock:
+            self._near_epoch += 1
+            if key == self.INVALIDATE_ALL:
+                self._near_cleared = self._near_epoch
+                self._near.sync_clear()
+            else:
+                if key in self._near_reads:
+                    self._near_invalidated[key] = self._near_epoch
+                self._near.sync_delete(key)
+
+    def _on_listener_error(self, _, __, ___):
+        # Invalidations may have been lost while the subscription was down
+        with self._near_lock:
+            self._near_epoch += 1
+            self._near_cleared = self._near_epoch
+            self._near.sync_clear()
+        time.sleep(1.0)
+
+    @contextmanager
+    def _near_reading(self, keys: list[str]):
+        """
+        Track the fetch of the keys, so only their own invalidations (or a full
+        clear) keep the fetched values out of the near-cache
+        :param keys: list[str]
+        :return: int. The epoch when the fetch started
+        """
+        with self._near_lock:
+            for key in keys:
+                self._near_reads[key] = self._near_reads.get(key, 0) + 1
+            epoch = self._near_epoch
+        try:
+            yield epoch
+        finally:
+            with self._near_lock:
+                for key in keys:
+                    if reads := self._near_reads[key] - 1:
+                        self._near_reads[key] = reads
+                    else:
+                        del self._near_reads[key]
+                        self._near_invalidated.pop(key, None)
+
+    def _near_set(self, key: str, value: Optional[bytes], pttl: int, epoch: int):
+        if value is None:
+            return MISS
+        value = serializers.loads(value)
+        ttl = self._near_ttl if pttl < 0 else min(self._near_ttl, pttl / 1000)
+        with self._near_lock:
+            # Skip values that may have been invalidated while they were fetched
+            if (
+                self._near_cleared <= epoch
+                and self._near_invalidated.get(key, 0) <= epoch
+            ):
+                self._near.sync_set(key=key, value=value, ttl=ttl)
+        return value
+
+    def close(self):
+        """
+        Stop the near-cache invalidation listener
+        :return:
+        """
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
 
     def sync_get(self, key: str):
+        if (near := self._near_cache()) is not None:
+            if (value := near.sync_get(key)) is not MISS:
+                return value
+            with self._near_reading([key]) as epoch, self._sync_state() as state:
+                value, pttl = (
+                    state.pipeline(transaction=False).get(key).pttl(key).execute()
+                )
+                return self._near_set(key=key, value=value, pttl=pttl, epoch=epoch)
         with self._sync_state() as state:
-            if value := state.get(key):
-                return pickle.loads(value)
-        return None
+            if (value := state.get(key)) is not None:
+                return serializers.loads(value)
+        return MISS
 
     def sync_set(self, key: str, value: any, ttl: int = _empty):
         with self._sync_state() as state:
-            state.set(key, pickle.dumps(value), ex=ttl, nx=True)
+            if self._near_cache() is None and self._index_of(key) is None:
+                state.set(key, self._serializer.dumps(value), ex=self._ex(ttl), nx=True)
+                return
+            pipeline = state.pipeline(transaction=False)
+            self._pipeline_set(pipeline, values={key: value}, ttl=ttl)
+            pipeline.execute()
 
     async def async_get(self, key: str):
+        if (near := self._near_cache()) is not None:
+            if (value := near.sync_get(key)) is not MISS:
+                return value
+        if self._get_batch:
+            return await self._get_batcher().load(key)
+        if near is not None:
+            with self._near_reading([key]) as epoch:
+                async with self._async_state() as state:
+                    value, pttl = (
+                        await state.pipeline(transaction=False)
+                        .get(key)
+                        .pttl(key)
+                        .execute()
+                    )
+                return self._near_set(key=key, value=value, pttl=pttl, epoch=epoch)
         async with self._async_state() as state:
-            if value := await state.get(key):
-                return pickle.loads(value)
-        return None
+            if (value := await state.get(key)) is not None:
+                return serializers.loads(value)
+        return MISS
 
     async def async_set(self, key: str, value: any, ttl: int = _empty):
         async with self._async_state() as state:
-            await state.set(key, pickle.dumps(value), ex=ttl, nx=True)
+            if self._near_cache() is None and self._index_of(key) is None:
+                await state.set(
+                    key, self._serializer.dumps(value), ex=self._ex(ttl), nx=True
+                )
+                return
+            pipeline = state.pipeline(transaction=False)
+            self._pipeline_set(pipeline, values={key: value}, ttl=ttl)
+            await pipeline.execute()
+
+    def sync_get_many(self, keys: list[str]) -> list:
+        if (near := self._near_cache()) is not None:
+            values = near.sync_get_many(keys=keys)
+            if missing := [key for key, value in zip(keys, values) if value is MISS]:
+                with self._near_reading(missing) as epoch, self._sync_state() as state:
+                    pipeline = state.pipeline(transaction=False)
+                    self._pipeline_get_with_ttl(pipeline, keys=missing)
+                    found, *pttls = pipeline.execute()
+                    values = self._merge_near(
+                        keys, values, missing, found, pttls, epoch
+                    )
+            return values
+        with self._sync_state() as state:
+            values = state.mget(keys)
+        return [MISS if value is None else serializers.loads(value) for value in values]
+
+    def sync_set_many(self, values: dict[str, any], ttl: int = _empty):
+        with self._sync_state() as state:
+            pipeline = state.pipeline(transaction=False)
+            self._pipeline_set(pipeline, values=values, ttl=ttl)
+            pipeline.execute()
+
+    async def async_get_many(self, keys: list[str]) -> list:
+        if (near := self._near_cache()) is not None:
+            values = near.sync_get_many(keys=keys)
+            if missing := [key for key, value in zip(keys, values) if value is MISS]:
+                with self._near_reading(missing) as epoch:
+                    async with self._async_state() as state:
+                        pipeline = state.pipeline(transaction=False)
+                        self._pipeline_get_with_ttl(pipeline, keys=missing)
+                        found, *pttls = await pipeline.execute()
+                    values = self._merge_near(
+                        keys, values, missing, found, pttls, epoch
+                    )
+            return values
+        async with self._async_state() as state:
+            values = await state.mget(keys)
+        return [MISS if value is None else serializers.loads(value) for value in values]
+
+    @staticmethod
+    def _pipeline_get_with_ttl(pipeline, keys: list[str]):
+        """
+        Queue the multi-get and the remaining ttl of each key
+        """
+        pipeline.mget(keys)
+        for key in keys:
+            pipeline.pttl(key)
+
+    @staticmethod
+    def _with_ttls(found: list, pttls: list[int]) -> list[tuple]:
+        return [
+            (MISS, None)
+            if value is None
+            else (serializers.loads(value), None if pttl < 0 else pttl / 1000)
+            for value, pttl in zip(found, pttls)
+        ]
+
+    def sync_get_many_with_ttl(self, keys: list[str]) -> list[tuple]:
+        """
+        Multi-get with the remaining ttl, read from redis and not the near-cache
+        :param keys: list[str]
+        :return: list[tuple]
+        """
+        with self._sync_state() as state:
+            pipeline = state.pipeline(transaction=False)
+            self._pipeline_get_with_ttl(pipeline, keys=keys)
+            found, *pttls = pipeline.execute()
+        return self._with_ttls(found, pttls)
+
+    async def async_get_many_with_ttl(self, keys: list[str]) -> list[tuple]:
+        """
+        Multi-get with the remaining ttl, read from redis and not the near-cache
+        :param keys: list[str]
+        :return: list[tuple]
+        """
+        async with self._async_state() as state:
+            pipeline = state.pipeline(transaction=False)
+            self._pipeline_get_with_ttl(pipeline, keys=keys)
+            found, *pttls = await pipeline.execute()
+        return self._with_ttls(found, pttls)
+
+    async def async_set_many(self, values: dict[str, any], ttl: int = _empty):
+        async with self._async_state() as state:
+            pipeline = state.pipeline(transaction=False)
+            self._pipeline_set(pipeline, values=values, ttl=ttl)
+            await pipeline.execute()
+
+    def _pipeline_set(
+        self, pipeline, values: dict[str, any], ttl: int, replace: bool = False
+    ):
+        """
+        Queue the sets, their near-cache invalidations and the namespace index
+        updates. The index is a sorted set of the keys by deadline that expires with
+        its last key, the expired ones are pruned every NAMESPACE_INDEX_TRIM_EVERY
+        writes and when the namespace is cleared. Without replace the cached keys are
+        kept (SET NX)
+        """
+        near = self._near_cache() is not None
+        now_timestamp = time.time()
+        forever = ttl in (_empty, None)
+        deadline = "+inf" if forever else now_timestamp + ttl
+        indexes = {}
+        for key, value in values.items():
+            pipeline.set(
+                key,
+                self._serializer.dumps(value),
+                ex=self._ex(ttl),
+                nx=not replace,
+            )
+            if near:
+                pipeline.publish(self._channel, key)
+            if (index := self._index_of(key)) is not None:
+                indexes.setdefault(index, []).append(key)
+        pttl = "" if forever else int(ttl * 1000)
+        for index, keys in indexes.items():
+            # EVAL and not a registered script, which checks it exists on every
+            # pipeline execution
+            pipeline.eval(INDEX, 1, index, deadline, pttl, *keys)
+        if indexes and next(self._index_writes) % self._index_trim_every == 0:
+            for index in indexes:
+                pipeline.zremrangebyscore(index, "-inf", f"({now_timestamp}")
+
+    def _index_of(self, key: str) -> Optional[str]:
+        """
+        The namespace index of the key, None without namespace or NAMESPACE_INDEX
+        """
+        if not self._index or (namespace := namespace_of(key)) is None:
+            return None
+        return self._index_prefix + namespace
+
+    def sync_replace(self, key: str, value: any, ttl: int = _empty):
+        with self._sync_state() as state:
+            pipeline = state.pipeline(transaction=False)
+            self._pipeline_set(pipeline, values={key: value}, ttl=ttl, replace=True)
+            pipeline.execute()
+
+    async def async_replace(self, key: str, value: any, ttl: int = _empty):
+        async with self._async_state() as state:
+            pipeline = state.pipeline(transaction=False)
+            self._pipeline_set(pipeline, values={key: value}, ttl=ttl, replace=True)
+            await pipeline.execute()
+
+    def _pipeline_delete(self, pipeline, keys: list[str]):
+        """
+        Queue the deletes, their near-cache invalidations and the namespace index
+        updates
+        """
+        pipeline.unlink(*keys)
+        near = self._near_cache() is not None
+        for key in keys:
+            if near:
+                pipeline.publish(self._channel, key)
+            if (index := self._index_of(key)) is not None:
+                pipeline.zrem(index, key)
+
+    def sync_delete(self, key: str):
+        with self._sync_state() as state:
+            pipeline = state.pipeline(transaction=False)
+            self._pipeline_delete(pipeline, keys=[key])
+            pipeline.execute()
+
+    async def async_delete(self, key: str):
+        async with self._async_state() as state:
+            pipeline = state.pipeline(transaction=False)
+            self._pipeline_delete(pipeline, keys=[key])
+            await pipeline.execute()
+
+    @staticmethod
+    def _decoded(keys: list) -> list[str]:
+        return [key.decode() if isinstance(key, bytes) else key for key in keys]
+
+    @staticmethod
+    def _match(namespace: str) -> str:
+        """
+        SCAN pattern of the keys of the namespace
+        """
+        return GLOB_SPECIAL.sub(r"\\\1", namespace) + NAMESPACE_SEPARATOR + "*"
+
+    def _sync_namespace_keys(self, state: SyncRedis, namespace: str):
+        """
+        Batches of the keys of the namespace, read from its index or, without
+        NAMESPACE_INDEX, from a SCAN of the whole keyspace. Each batch must be
+        deleted before the next one is read
+        """
+        if self._index:
+            index = self._index_prefix + namespace
+            # The expired keys are gone already
+            state.zremrangebyscore(index, "-inf", f"({time.time()}")
+            while keys := state.zrange(index, 0, CLEAR_BATCH - 1):
+                yield self._decoded(keys)
+            return
+        keys = []
+        for key in state.scan_iter(match=self._match(namespace), count=CLEAR_BATCH):
+            keys.append(key)
+            if len(keys) == CLEAR_BATCH:
+                yield self._decoded(keys)
+                keys = []
+        if keys:
+            yield self._decoded(keys)
+
+    async def _async_namespace_keys(self, state: AsyncRedis, namespace: str):
+        """
+        Batches of the keys of the namespace, read from its index or, without
+        NAMESPACE_INDEX, from a SCAN of the whole keyspace. Each batch must be
+        deleted before the next one is read
+        """
+        if self._index:
+            index = self._index_prefix + namespace
+            # The expired keys are gone already
+            await state.zremrangebyscore(index, "-inf", f"({time.time()}")
+            while keys := await state.zrange(index, 0, CLEAR_BATCH - 1):
+                yield self._decoded(keys)
+            return
+        keys = []
+        async for key in state.scan_iter(
+            match=self._match(namespace), count=CLEAR_BATCH
+        ):
+            keys.append(key)
+            if len(keys) == CLEAR_BATCH:
+                yield self._decoded(keys)
+                keys = []
+        if keys:
+            yield self._decoded(keys)
+
+    def sync_clear_namespace(self, namespace: str):
+        with self._sync_state() as state:
+            for keys in self._sync_namespace_keys(state, namespace):
+                pipeline = state.pipeline(transaction=False)
+                self._pipeline_delete(pipeline, keys=keys)
+                pipeline.execute()
+
+    async def async_clear_namespace(self, namespace: str):
+        async with self._async_state() as state:
+            async for keys in self._async_namespace_keys(state, namespace):
+                pipeline = state.pipeline(transaction=False)
+                self._pipeline_delete(pipeline, keys=keys)
+                await pipeline.execute()
+
+    @staticmethod
+    def _lock_or_get(status: list) -> tuple[bool, any]:
+        """
+        Whether to stop waiting, with the value or MISS when the lease was granted
+        """
+        match status[0]:
+            case b"v" | "v":
+                return True, serializers.loads(status[1])
+            case b"l" | "l":
+                return True, MISS
+        return False, None
+
+    def _backoff(self, delay: float, lease_pttl: int) -> float:
+        """
+        Jittered exponential backoff, never past the end of the lease
+        """
+        delay = random.uniform(delay / 2, delay)
+        if lease_pttl > 0:
+            delay = min(delay, lease_pttl / 1000)
+        return delay
+
+    def _lease_key(self, key: str) -> str:
+        """
+        The lease of the key, hash tagged so that both are in the same Redis Cluster
+        slot, as the script touching both requires. Keys with a "}" outside of a
+        hash tag can't share their slot
+        """
+        key = str(key)
+        start = key.find("{")
+        end = key.find("}", start + 1)
+        if start != -1 and end > start + 1:
+            # The key slot is taken from its own hash tag
+            return f"{self._lock_prefix}{{{key[start + 1:end]}}}{key}"
+        return f"{self._lock_prefix}{{{key}}}"
+
+    def _sync_renew(self, lease_key: str, token: str, stop: threading.Event):
+        """
+        Extend the lease every third of LOCK_LEASE until stop is set or the lease
+        was lost
+        """
+        lease = int(self._lock_lease * 1000)
+        while not stop.wait(self._lock_lease / 3):
+            try:
+                with self._sync_state() as state:
+                    if not state.register_script(RENEW)(
+                        keys=[lease_key], args=[token, lease]
+                    ):
+                        return
+            except RedisError:
+                # Tried again on the next interval, before the lease ends
+                continue
+
+    async def _async_renew(self, lease_key: str, token: str):
+        """
+        Extend the lease every third of LOCK_LEASE until cancelled or the lease was
+        lost
+        """
+        lease = int(self._lock_lease * 1000)
+        while True:
+            await asyncio.sleep(self._lock_lease / 3)
+            try:
+                async with self._async_state() as state:
+                    if not await state.register_script(RENEW)(
+                        keys=[lease_key], args=[token, lease]
+                    ):
+                        return
+            except RedisError:
+                # Tried again on the next interval, before the lease ends
+                continue
+
+    @contextmanager
+    def sync_lock(self, key: str):
+        """
+        Distributed recompute lock. A single script returns the cached value or
+        grants a LOCK_LEASE seconds lease, renewed while the holder computes, the
+        other clients poll with backoff until the value is stored or the lease
+        times out, when the holder died, and one of them takes over
+        :param key: str
+        :return: Context manager that yields the value cached meanwhile or MISS
+        """
+        lease_key = self._lease_key(key)
+        token = uuid.uuid4().hex
+        delay = self._lock_poll
+        with self._sync_state() as state:
+            lock_or_get = state.register_script(LOCK_OR_GET)
+            while True:
+                status = lock_or_get(
+                    keys=[key, lease_key], args=[token, int(self._lock_lease * 1000)]
+                )
+                done, value = self._lock_or_get(status)
+                if done:
+                    break
+                time.sleep(self._backoff(delay, status[1]))
+                delay = min(delay * 2, self._lock_poll_max)
+        if value is not MISS:
+            yield value
+            return
+        stop = threading.Event()
+        threading.Thread(
+            target=self._sync_renew,
+            args=(lease_key, token, stop),
+            name="mr-lock-renew",
+            daemon=True,
+        ).start()
+        try:
+            yield MISS
+        finally:
+            stop.set()
+            with self._sync_state() as state:
+                state.register_script(RELEASE)(keys=[lease_key], args=[token])
+
+    @asynccontextmanager
+    async def async_lock(self, key: str):
+        """
+        Distributed recompute lock. A single script returns the cached value or
+        grants a LOCK_LEASE seconds lease, renewed while the holder computes, the
+        other clients poll with backoff until the value is stored or the lease
+        times out, when the holder died, and one of them takes over
+        :param key: str
+        :return: Async context manager that yields the value cached meanwhile or MISS
+        """
+        lease_key = self._lease_key(key)
+        token = uuid.uuid4().hex
+        delay = self._lock_poll
+        async with self._async_state() as state:
+            lock_or_get = state.register_script(LOCK_OR_GET)
+            while True:
+                status = await lock_or_get(
+                    keys=[key, lease_key], args=[token, int(self._lock_lease * 1000)]
+                )
+                done, value = self._lock_or_get(status)
+                if done:
+                    break
+                await asyncio.sleep(self._backoff(delay, status[1]))
+                delay = min(delay * 2, self._lock_poll_max)
+        if value is not MISS:
+            yield value
+            return
+        renewer = asyncio.create_task(self._async_renew(lease_key, token))
+        try:
+            yield MISS
+        finally:
+            renewer.cancel()
+            async with self._async_state() as state:
+                await state.register_script(RELEASE)(keys=[lease_key], args=[token])
+
+    def _merge_near(  # pylint: disable=R0913
+        self,
+        keys: list[str],
+        values: list,
+        missing: list[str],
+        found: list,
+        pttls: list[int],
+        epoch: int,
+    ) -> list:
+        fetched = {
+            key: self._near_set(key=key, value=value, pttl=pttl, epoch=epoch)
+            for key, value, pttl in zip(missing, found, pttls)
+        }
+        return [
+            fetched[key] if value is MISS else value for key, value in zip(keys, values)
+        ]
@@ -0,0 +1,418 @@
+"""
+Shared memory state implementation
+"""
+import fcntl
+import hashlib
+import functools
+import struct
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from inspect import _empty
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+
+from mr.states import serializers
+from mr.states.interface import IState, MISS, namespace_of
+
+MAGIC = b"MRSM"
+VERSION = 2
+# magic, version, slots, slot size, ways
+HEADER = struct.Struct("<4sB3xIII")
+# sequence, key digest, created_at, ttl (-1 never dies), payload size, namespace
+# generation, namespace generation index, flags
+SLOT = struct.Struct("<Q16sddIIHB5x")
+SEQUENCE = struct.Struct("<Q")
+HEADER_SIZE = 64
+# Namespace generations, after the header. Namespaces hash to one of them, so
+# clearing a namespace may clear the ones sharing its generation too
+GENERATION = struct.Struct("<I")
+GENERATIONS = 1024
+NO_NAMESPACE = 0xFFFF
+SLOTS_OFFSET = HEADER_SIZE + GENERATIONS * GENERATION.size
+
+EMPTY = 0
+SERIALIZED = 1
+RAW = 2
+# Raw too, loaded back as a bytearray
+RAW_BYTEARRAY = 3
+
+_EMPTY_SLOT = (b"", 0.0, 0.0, 0, 0, NO_NAMESPACE, EMPTY)
+
+READ_RETRIES = 64
+ATTACH_TIMEOUT = 1.0
+THREAD_LOCK_STRIPES = 64
+
+
+@functools.lru_cache(maxsize=GENERATIONS)
+def _generation_index(namespace: str) -> int:
+    digest = hashlib.blake2b(namespace.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little") % GENERATIONS
+
+
+def _open_shared_memory(name: str, size: int) -> tuple[SharedMemory, bool]:
+    """
+    Create the segment or attach to the one created by another process. The segment
+    outlives the processes, so it is untracked, unlink() removes it
+    """
+    deadline = time.monotonic() + ATTACH_TIMEOUT
+    while True:
+        try:
+            shared_memory = SharedMemory(name=name, create=True, size=size)
+            created = True
+            break
+        except FileExistsError:
+            pass
+        try:
+            shared_memory = SharedMemory(name=name)
+            created = False
+            break
+        except ValueError:
+            # Created but not sized yet
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.001)
+        except FileNotFoundError:
+            # Unlinked meanwhile, create it again
+            continue
+    resource_tracker.unregister(
+        shared_memory._name, "shared_memory"  # pylint: disable=W0212
+    )
+    return shared_memory, created
+
+
+class SharedMemoryState(IState):  # pylint: disable=R0902
+    """
+    State on a shared memory segment used by every process of the host. A set
+    associative table of fixed size slots, read without locks (seqlock) and
+    written under a per bucket file lock. The slots of a namespace are cleared by
+    bumping its generation
+    """
+
+    _shared_memory: SharedMemory
+    _buffer: memoryview
+    _slots: int
+    _slot_size: int
+    _ways: int
+    _buckets: int
+    _stride: int
+    _serializer: serializers.ISerializer
+    _zero_copy: bool
+    _lock_file: any
+    _thread_locks: list[threading.Lock]
+    oversized: int
+
+    __slots__ = (
+        "_shared_memory",
+        "_buffer",
+        "_slots",
+        "_slot_size",
+        "_ways",
+        "_buckets",
+        "_stride",
+        "_serializer",
+        "_zero_copy",
+        "_lock_file",
+        "_thread_locks",
+        "oversized",
+    )
+
+    def __init__(self, **kwargs):
+        name = kwargs.get("NAME", "mr-mime")
+        self._slots = kwargs.get("SLOTS", 4096)
+        # Payloads are 8 bytes aligned so every sequence stays aligned
+        self._slot_size = -(-kwargs.get("SLOT_SIZE", 4096) // 8) * 8
+        self._ways = kwargs.get("WAYS", 4)
+        if self._slots % self._ways:
+            raise ValueError("The config value SLOTS must be a multiple of WAYS")
+        self._buckets = self._slots // self._ways
+        self._stride = SLOT.size + self._slot_size
+        self._serializer = serializers.from_kwargs(kwargs)
+        self._zero_copy = kwargs.get("ZERO_COPY", False)
+        self.oversized = 0
+        self._shared_memory, created = _open_shared_memory(
+            name=name, size=SLOTS_OFFSET + self._slots * self._stride
+        )
+        self._buffer = self._shared_memory.buf
+        layout = (MAGIC, VERSION, self._slots, self._slot_size, self._ways)
+        if created:
+            HEADER.pack_into(self._buffer, 0, *layout)
+        else:
+            self._check_layout(name, layout)
+        # Shared memory has no atomics, writers of other processes are excluded with
+        # a lock file byte per bucket (and per generation, after the buckets) and the
+        # threads of this one with a lock stripe
+        self._lock_file = open(self._lock_path(name), "ab")  # pylint: disable=R1732
+        self._thread_locks = [threading.Lock() for _ in range(THREAD_LOCK_STRIPES)]
+
+    @staticmethod
+    def _lock_path(name: str) -> Path:
+        return Path(tempfile.gettempdir()) / f"{name}.lock"
+
+    def _check_layout(self, name: str, layout: tuple):
+        deadline = time.monotonic() + ATTACH_TIMEOUT
+        # The creator may not have written the header yet
+        while (header := HEADER.unpack_from(self._buffer, 0))[0] != MAGIC:
+            if time.monotonic() > deadline:
+                break
+            time.sleep(0.001)
+        if header != layout:
+            raise TypeError(
+                f"The config value NAME {name} is already used with another layout"
+            )
+
+    def close(self):
+        """
+        Detach from the shared memory
+        :return:
+        """
+        self._buffer = None
+        self._shared_memory.close()
+        self._lock_file.close()
+
+    def unlink(self):
+        """
+        Detach and remove the shared memory, the processes still attached keep it
+        until they close it
+        :return:
+        """
+        self.close()
+        # unlink() unregisters it from the resource tracker
+        resource_tracker.register(
+            self._shared_memory._name, "shared_memory"  # pylint: disable=W0212
+        )
+        self._shared_memory.unlink()
+        self._lock_path(self._shared_memory.name).unlink(missing_ok=True)
+
+    @staticmethod
+    def _digest(key: str) -> bytes:
+        return hashlib.blake2b(str(key).encode(), digest_size=16).digest()
+
+    def _bucket(self, digest: bytes) -> int:
+        return int.from_bytes(digest[:8], "little") % self._buckets
+
+    def _offset(self, slot: int) -> int:
+        return SLOTS_OFFSET + slot * self._stride
+
+    def _generation(self, index: int) -> int:
+        if index == NO_NAMESPACE:
+            return 0
+        return GENERATION.unpack_from(
+            self._buffer, HEADER_SIZE + index * GENERATION.size
+        )[0]
+
+    def _stale(self, generation: int, index: int) -> bool:
+        """
+        The slot was written before the last clear of its namespace
+        """
+        return index != NO_NAMESPACE and generation != self._generation(index)
+
+    def _read(self, offset: int, digest: bytes, now_timestamp: float):
+        """
+        Seqlock read of a slot: retried while a writer changes it
+        """
+        buffer = self._buffer
+        for _ in range(READ_RETRIES):
+            (
+                sequence,
+                slot_digest,
+                created_at,
+                ttl,
+                size,
+                generation,
+                index,
+                flags,
+            ) = SLOT.unpack_from(buffer, offset)
+            if sequence & 1:
+                continue
+            if flags == EMPTY or slot_digest != digest or size > self._slot_size:
+                return MISS
+            if self._stale(generation, index):
+                return MISS
+            start = offset + SLOT.size
+            if self._zero_copy and flags == RAW:
+                data = buffer[start : start + size].toreadonly()
+            elif flags == RAW_BYTEARRAY:
+                data = bytearray(buffer[start : start + size])
+            else:
+                data = bytes(buffer[start : start + size])
+            if SEQUENCE.unpack_from(buffer, offset)[0] != sequence:
+                continue
+            if ttl >= 0 and created_at + ttl < now_timestamp:
+                return MISS
+            if flags in (RAW, RAW_BYTEARRAY):
+                return data
+            return serializers.loads(data)
+        # Written all the time, treated as a miss instead of spinning
+        return MISS
+
+    def _get(self, key: str, now_timestamp: float):
+        digest = self._digest(key)
+        first = self._bucket(digest) * self._ways
+        for slot in range(first, first + self._ways):
+            value = self._read(self._offset(slot), digest, now_timestamp)
+            if value is not MISS:
+                return value
+        return MISS
+
+    def _encode(self, value: any) -> tuple[bytes, int]:
+        if isinstance(value, bytearray):
+            return value, RAW_BYTEARRAY
+        if isinstance(value, (bytes, memoryview)):
+            return value, RAW
+        return self._serializer.dumps(value), SERIALIZED
+
+    def _victim(self, first: int, digest: bytes, now_timestamp: float) -> int:
+        """
+        The slot of the key, else an empty, expired or cleared slot, else the
+        oldest one
+        """
+        candidates = []
+        for slot in range(first, first + self._ways):
+            (
+                _,
+                slot_digest,
+                created_at,
+                ttl,
+                _,
+                generation,
+                index,
+                flags,
+            ) = SLOT.unpack_from(self._buffer, self._offset(slot))
+            if flags != EMPTY and slot_digest == digest:
+                return slot
+            if (
+                flags == EMPTY
+                or (ttl >= 0 and created_at + ttl < now_timestamp)
+                or self._stale(generation, index)
+            ):
+                candidates.append((float("-inf"), slot))
+            else:
+                candidates.append((created_at, slot))
+        return min(candidates)[1]
+
+    def _write(self, slot: int, fields: tuple, payload: bytes = b""):
+        offset = self._offset(slot)
+        (sequence,) = SEQUENCE.unpack_from(self._buffer, offset)
+        SEQUENCE.pack_into(self._buffer, offset, sequence + 1)
+        SLOT.pack_into(self._buffer, offset, sequence + 1, *fields)
+        start = offset + SLOT.size
+        self._buffer[start : start + len(payload)] = payload
+        SEQUENCE.pack_into(self._buffer, offset, sequence + 2)
+
+    @contextmanager
+    def _locked(self, bucket: int):
+        with self._thread_locks[bucket % THREAD_LOCK_STRIPES]:
+            fcntl.lockf(self._lock_file, fcntl.LOCK_EX, 1, bucket)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._lock_file, fcntl.LOCK_UN, 1, bucket)
+
+    def _set(self, key: str, value: any, ttl: int, now_timestamp: float):
+        payload, flags = self._encode(value)
+        payload = memoryview(payload).cast("B")
+        if payload.nbytes > self._slot_size:
+            self.oversized += 1
+            return
+        digest = self._digest(key)
+        bucket = self._bucket(digest)
+        index = NO_NAMESPACE
+        if (namespace := namespace_of(key)) is not None:
+            index = _generation_index(namespace)
+        # Read before the write, a clear in between leaves the value stale
+        generation = self._generation(index)
+        with self._locked(bucket):
+            slot = self._victim(bucket * self._ways, digest, now_timestamp)
+            fields = (
+                digest,
+                now_timestamp,
+                -1.0 if ttl in (_empty, None) else float(ttl),
+                payload.nbytes,
+                generation,
+                index,
+                flags,
+            )
+            self._write(slot, fields, payload)
+
+    def sync_get(self, key: str):
+        return self._get(key, datetime.utcnow().timestamp())
+
+    def sync_get_many(self, keys: list[str]) -> list:
+        now_timestamp = datetime.utcnow().timestamp()
+        return [self._get(key, now_timestamp) for key in keys]
+
+    def sync_set(self, key: str, value: any, ttl: int = _empty):
+        self._set(key, value, ttl, datetime.utcnow().timestamp())
+
+    def sync_set_many(self, values: dict[str, any], ttl: int = _empty):
+        now_timestamp = datetime.utcnow().timestamp()
+        for key, value in values.items():
+            self._set(key, value, ttl, now_timestamp)
+
+    def sync_delete(self, key: str):
+        """
+        Delete the key
+        :param key: str
+        :return:
+        """
+        digest = self._digest(key)
+        bucket = self._bucket(digest)
+        with self._locked(bucket):
+            first = bucket * self._ways
+            for slot in range(first, first + self._ways):
+                _, slot_digest, *_, flags = SLOT.unpack_from(
+                    self._buffer, self._offset(slot)
+                )
+                if flags != EMPTY and slot_digest == digest:
+                    self._write(slot, _EMPTY_SLOT)
+
+    def sync_clear(self):
+        """
+        Delete every key
+        :return:
+        """
+        for bucket in range(self._buckets):
+            with self._locked(bucket):
+                first = bucket * self._ways
+                for slot in range(first, first + self._ways):
+                    self._write(slot, _EMPTY_SLOT)
+
+    def sync_clear_namespace(self, namespace: str):
+        """
+        Delete every key of the namespace in O(1): its generation is bumped, the
+        older slots are read as misses and are the first ones replaced. Namespaces
+        sharing the generation are cleared too
+        :param namespace: str
+        :return:
+        """
+        index = _generation_index(namespace)
+        with self._locked(self._buckets + index):
+            GENERATION.pack_into(
+                self._buffer,
+                HEADER_SIZE + index * GENERATION.size,
+                (self._generation(index) + 1) % (1 << 32),
+            )
+
+    # Reads never block and writes hold a bucket lock for a memory copy, so the
+    # async methods run inline
+    async def async_get(self, key: str):
+        return self.sync_get(key)
+
+    async def async_get_many(self, keys: list[str]) -> list:
+        return self.sync_get_many(keys)
+
+    async def async_set(self, key: str, value: any, ttl: int = _empty):
+        self.sync_set(key, value, ttl)
+
+    async def async_set_many(self, values: dict[str, any], ttl: int = _empty):
+        self.sync_set_many(values, ttl)
+
+    async def async_delete(self, key: str):
+        self.sync_delete(key)
+
+    async def async_clear_namespace(self, namespace: str):
+        self.sync_clear_namespace(namespace)
@@ -0,0 +1,272 @@
+"""
+SQLite state implementation
+"""
+import asyncio
+import itertools
+import os
+import sqlite3
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from inspect import _empty
+from pathlib import Path
+from typing import Optional
+
+from mr.states import serializers
+from mr.states.interface import (
+    IState,
+    MISS,
+    NAMESPACE_SEPARATOR,
+    private_temp_directory,
+)
+
+# Keeps the IN (...) lists under the default SQLITE_MAX_VARIABLE_NUMBER of old builds
+BATCH_SIZE = 500
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS mr_cache ("
+    "key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL)",
+    "CREATE INDEX IF NOT EXISTS mr_cache_expires_at ON mr_cache (expires_at)",
+)
+
+
+def _default_path() -> Path:
+    """
+    my-mimic.sqlite3 in a directory of the user on the OS temp folder. The values are
+    unpickled, so the directory must not be writable by anyone else
+    :return: Path
+    """
+    return private_temp_directory("my-mimic", "PATH") / "my-mimic.sqlite3"
+
+
+class _Connection:  # pylint: disable=R0903
+    """
+    Connection of a thread, closed when the thread-local storage drops it as the
+    thread exits
+    """
+
+    __slots__ = ("connection", "pid", "close", "__weakref__")
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+        self.pid = os.getpid()
+        self.close = weakref.finalize(self, connection.close)
+
+
+class SQLiteState(IState):  # pylint: disable=R0902
+    """
+    State stored on a SQLite database in WAL mode, persistent and shared by the
+    processes of the host
+    """
+
+    _path: Path
+    _serializer: serializers.ISerializer
+    _timeout: float
+    _purge_every: int
+    _sets: itertools.count
+    _local: threading.local
+    _connections: weakref.WeakSet
+    _connections_lock: threading.Lock
+    _executor: ThreadPoolExecutor
+    expirations: int
+
+    __slots__ = (
+        "_path",
+        "_serializer",
+        "_timeout",
+        "_purge_every",
+        "_sets",
+        "_local",
+        "_connections",
+        "_connections_lock",
+        "_executor",
+        "expirations",
+    )
+
+    def __init__(self, **kwargs):
+        self._serializer = serializers.from_kwargs(kwargs)
+        self._timeout = kwargs.get("BUSY_TIMEOUT", 5.0)
+        self._purge_every = kwargs.get("PURGE_EVERY", 1024)
+        self._sets = itertools.count(1)
+        self._local = threading.local()
+        self._connections = weakref.WeakSet()
+        self._connections_lock = threading.Lock()
+        self.expirations = 0
+        path = kwargs.get("PATH") or _default_path()
+        try:
+            self._path = Path(path)
+            connection = self._connection()
+        except (TypeError, sqlite3.OperationalError) as exception:
+            raise TypeError(
+                "The config value PATH is not a valid database path"
+            ) from exception
+        connection.execute("PRAGMA journal_mode=WAL")
+        for statement in SCHEMA:
+            connection.execute(statement)
+        # A single thread runs the async calls, so the event loop never blocks
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="mr-sqlite"
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        """
+        Connection of the current thread. A forked process opens its own
+        :return: sqlite3.Connection
+        """
+        local = getattr(self._local, "connection", None)
+        if local is None or local.pid != os.getpid():
+            # Used by this thread only, but closed by close() from any thread
+            connection = sqlite3.connect(
+                self._path,
+                timeout=self._timeout,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            connection.execute("PRAGMA synchronous=NORMAL")
+            local = self._local.connection = _Connection(connection)
+            with self._connections_lock:
+                self._connections.add(local)
+        return local.connection
+
+    def close(self):
+        """
+        Stop the async thread and close the connections
+        :return:
+        """
+        self._executor.shutdown(wait=True)
+        with self._connections_lock:
+            for local in list(self._connections):
+                local.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+    def purge_expired(self) -> int:
+        """
+        Delete every expired entry, a single range delete on the expires_at index
+        :return: int. How many entries were deleted
+        """
+        cursor = self._connection().execute(
+            "DELETE FROM mr_cache WHERE expires_at < ?",
+            (datetime.utcnow().timestamp(),),
+        )
+        self.expirations += cursor.rowcount
+        return cursor.rowcount
+
+    @staticmethod
+    def _expires_at(ttl: int, now_timestamp: float) -> Optional[float]:
+        if ttl in (_empty, None):
+            return None
+        return now_timestamp + ttl
+
+    def sync_get(self, key: str):
+        return self.sync_get_many(keys=[key])[0]
+
+    def sync_set(self, key: str, value: any, ttl: int = _empty):
+        self.sync_set_many(values={key: value}, ttl=ttl)
+
+    def sync_get_many(self, keys: list[str]) -> list:
+        return [value for value, _ in self.sync_get_many_with_ttl(keys=keys)]
+
+    def sync_get_many_with_ttl(self, keys: list[str]) -> list[tuple]:
+        keys = [str(key) for key in keys]
+        now_timestamp = datetime.utcnow().timestamp()
+        connection = self._connection()
+        found = {}
+        for start in range(0, len(keys), BATCH_SIZE):
+            batch = keys[start : start + BATCH_SIZE]
+            found.update(
+                (key, (value, expires_at))
+                for key, value, expires_at in connection.execute(
+                    f"SELECT key, value, expires_at FROM mr_cache WHERE key IN "
+                    f"({','.join('?' * len(batch))}) "
+                    f"AND (expires_at IS NULL OR expires_at >= ?)",
+                    (*batch, now_timestamp),
+                )
+            )
+        return [
+            (MISS, None)
+            if (row := found.get(key)) is None
+            else (
+                serializers.loads(row[0]),
+                None if row[1] is None else row[1] - now_timestamp,
+            )
+            for key in keys
+        ]
+
+    def sync_set_many(self, values: dict[str, any], ttl: int = _empty):
+        expires_at = self._expires_at(ttl, datetime.utcnow().timestamp())
+        rows = [
+            (str(key), self._serializer.dumps(value), expires_at)
+            for key, value in values.items()
+        ]
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany(
+                "INSERT OR REPLACE INTO mr_cache (key, value, expires_at) "
+                "VALUES (?, ?, ?)",
+                rows,
+            )
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        counts = [next(self._sets) for _ in rows]
+        if self._purge_every and any(
+            count % self._purge_every == 0 for count in counts
+        ):
+            self.purge_expired()
+
+    def sync_delete(self, key: str):
+        """
+        Delete the key
+        :param key: str
+        :return:
+        """
+        self._connection().execute("DELETE FROM mr_cache WHERE key = ?", (str(key),))
+
+    def sync_clear_namespace(self, namespace: str):
+        """
+        Delete every key of the namespace, a range delete on the primary key
+        :param namespace: str
+        :return:
+        """
+        prefix = f"{namespace}{NAMESPACE_SEPARATOR}"
+        self._connection().execute(
+            "DELETE FROM mr_cache WHERE key >= ? AND key < ?",
+            (prefix, prefix[:-1] + chr(ord(NAMESPACE_SEPARATOR) + 1)),
+        )
+
+    def sync_clear(self):
+        """
+        Delete every key
+        :return:
+        """
+        self._connection().execute("DELETE FROM mr_cache")
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, func, *args
+        )
+
+    async def async_get(self, key: str):
+        return await self._run(self.sync_get, key)
+
+    async def async_set(self, key: str, value: any, ttl: int = _empty):
+        await self._run(self.sync_set, key, value, ttl)
+
+    async def async_get_many(self, keys: list[str]) -> list:
+        return await self._run(self.sync_get_many, keys)
+
+    async def async_get_many_with_ttl(self, keys: list[str]) -> list[tuple]:
+        return await self._run(self.sync_get_many_with_ttl, keys)
+
+    async def async_set_many(self, values: dict[str, any], ttl: int = _empty):
+        await self._run(self.sync_set_many, values, ttl)
+
+    async def async_delete(self, key: str):
+        await self._run(self.sync_delete, key)
+
+    async def async_clear_namespace(self, namespace: str):
+        await self._run(self.sync_clear_namespace, namespace)
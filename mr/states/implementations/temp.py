@@ -1,8 +1,18 @@
 """
 Memory state implementation
 """
-import pickle
+import asyncio
+import hashlib
+import itertools
+import mmap
+import os
+import re
+import shutil
+import struct
 import tempfile
+import threading
+import weakref
+from contextlib import asynccontextmanager, contextmanager
 from datetime import datetime
 from inspect import _empty
 from pathlib import Path
@@ -11,23 +21,104 @@ from typing import Optional
 
 import aiofile
 
-from mr.states.interface import IState
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
 
+from mr.states import serializers
+from mr.states.interface import IState, MISS, namespace_of, private_temp_directory
 
-class TempFileState(IState):
+MAGIC = b"MRMI"
+VERSION = 1
+# magic, version, created_at, ttl (-1 never dies), payload size, out of band buffers
+HEADER = struct.Struct("<4sBddQI")
+BUFFER_SIZE = struct.Struct("<Q")
+SHARD_FANOUT = 256
+# Writes in progress, removed by the collector when abandoned
+TEMP_SUFFIX = ".tmp"
+# .<entry>.<pid>.<write id>.tmp, other files with the suffix are not ours to remove
+TEMP_PATTERN = re.compile(rf"\..+\.\d+\.\d+{re.escape(TEMP_SUFFIX)}")
+TEMP_MAX_AGE = 3600
+_write_ids = itertools.count()
+LOCKS_DIR = ".locks"
+# One directory per namespace, renamed away by clear_namespace before it is removed
+NAMESPACES_DIR = "namespaces"
+TRASH_SUFFIX = ".trash"
+
+
+def _parse_header(header: bytes) -> Optional[tuple]:
+    """
+    Header fields, None when it is not a cache entry
+    """
+    if len(header) < HEADER.size:
+        return None
+    magic, version, *fields = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION:
+        return None
+    return tuple(fields)
+
+
+def _default_shared_path() -> Path:
+    """
+    mr-<uid> directory of the user on the OS temp folder. The collector removes the
+    cache files it finds and the values are unpickled, so the directory must not be
+    shared with anyone else
+    :return: Path
+    """
+    return private_temp_directory("mr", "BASE_PATH")
+
+
+def _expired(created_at: float, ttl: float, now_timestamp: float) -> bool:
+    return ttl >= 0 and (created_at + ttl) < now_timestamp
+
+
+class TempFileState(IState):  # pylint: disable=R0902
     """
     State interface
     """
 
     _path: Path
     _temp_folder: TemporaryDirectory
+    _serializer: serializers.ISerializer
+    _mmap_threshold: int
+    _shard_depth: int
+    _max_size: Optional[int]
+    _gc_every: int
+    _sets: itertools.count
+    _gc_cursor: itertools.count
+    _unit_sizes: dict[Path, int]
+    _collector: Optional[threading.Thread]
+    _collector_stop: threading.Event
+    _shared: bool
+    _lock_stripes: int
+    evictions: int
+    expirations: int
 
     def __init__(self, **kwargs):
+        self._serializer = serializers.from_kwargs(kwargs)
+        self._mmap_threshold = kwargs.get("MMAP_THRESHOLD", 1024 * 1024)
+        self._shard_depth = kwargs.get("SHARD_DEPTH", 2)
+        if not isinstance(self._shard_depth, int) or not 0 <= self._shard_depth <= 4:
+            raise TypeError("The config value SHARD_DEPTH must be an int from 0 to 4")
+        self._max_size = kwargs.get("MAX_SIZE")
+        self._gc_every = kwargs.get("GC_EVERY", 1024)
+        self._sets = itertools.count(1)
+        self._gc_cursor = itertools.count()
+        self._unit_sizes = {}
+        self.evictions = 0
+        self.expirations = 0
+        self._shared = bool(kwargs.get("SHARED"))
+        self._lock_stripes = kwargs.get("LOCK_STRIPES", 1024)
+        base_path = kwargs.get("BASE_PATH")
+        if self._shared and base_path is None:
+            # Never collect the files of other programs in the temp folder itself
+            base_path = _default_shared_path()
         try:
             _dir = Path(tempfile.gettempdir())
-            if kwargs.get("BASE_PATH") is not None:
-                _dir = Path(kwargs["BASE_PATH"])
-            if kwargs.get("STATIC"):
+            if base_path is not None:
+                _dir = Path(base_path)
+            if kwargs.get("STATIC") or self._shared:
                 self._path = _dir
             else:
                 self._temp_folder = TemporaryDirectory(  # pylint: disable=R1732
@@ -38,56 +129,408 @@ class TempFileState(IState):
             raise TypeError(
                 "The config value BASE_PATH is not a valid Path"
             ) from exception
+        if self._shared and fcntl is not None:
+            (self._path / LOCKS_DIR).mkdir(exist_ok=True)
+        self._collector = None
+        self._collector_stop = threading.Event()
+        if (gc_interval := kwargs.get("GC_INTERVAL")) is not None:
+            self._collector = threading.Thread(
+                target=self._collect_forever,
+                args=(weakref.ref(self), gc_interval, self._collector_stop),
+                name="mr-temp-file-collector",
+                daemon=True,
+            )
+            self._collector.start()
 
     def get_path(self, key: str) -> Path:
         """
-        Get temp file path
+        Get temp file path, inside the namespace directory of the key and
+        SHARD_DEPTH levels of directories named after the key hash
         :return: Path
         """
-        temp_path = self._path / str(key)
-        return temp_path
+        key = str(key)
+        root = self._path
+        if (namespace := namespace_of(key)) is not None:
+            root = self._path / NAMESPACES_DIR / namespace
+            key = key[len(namespace) + 1 :]
+        if not self._shard_depth:
+            return root / key
+        digest = hashlib.blake2b(
+            key.encode(), digest_size=self._shard_depth
+        ).hexdigest()
+        return root.joinpath(
+            *(digest[index : index + 2] for index in range(0, len(digest), 2)), key
+        )
+
+    def _roots(self) -> list[Path]:
+        """
+        The base directory and the namespace directories
+        """
+        roots = [self._path]
+        try:
+            with os.scandir(self._path / NAMESPACES_DIR) as entries:
+                roots.extend(
+                    Path(entry.path)
+                    for entry in entries
+                    # Skip the namespaces being cleared
+                    if entry.is_dir(follow_symlinks=False)
+                    and not entry.name.startswith(".")
+                )
+        except FileNotFoundError:
+            pass
+        return roots
+
+    def _units(self) -> list[Path]:
+        """
+        The directories scanned by each incremental collection step
+        """
+        if not self._shard_depth:
+            return self._roots()
+        return [
+            root / f"{index:02x}"
+            for root in self._roots()
+            for index in range(SHARD_FANOUT)
+        ]
+
+    def _scan(self, unit: Path, now_timestamp: float) -> list[tuple]:
+        """
+        Remove the expired entries of the unit and list the live ones as
+        (written at, size, path). Files that are not cache entries are left untouched
+        """
+        if self._shard_depth:
+            paths = (
+                Path(root) / name for root, _, names in os.walk(unit) for name in names
+            )
+        else:
+            paths = (
+                Path(entry.path)
+                for entry in os.scandir(unit)
+                if entry.is_file(follow_symlinks=False)
+            )
+        live = []
+        for path in paths:
+            if TEMP_PATTERN.fullmatch(path.name):
+                self._remove_abandoned(path, now_timestamp)
+                continue
+            try:
+                with open(path, "rb") as file:
+                    fields = _parse_header(file.read(HEADER.size))
+                    if fields is None:
+                        continue
+                    if _expired(fields[0], fields[1], now_timestamp):
+                        os.unlink(path)
+                        self.expirations += 1
+                        continue
+                    stat = os.fstat(file.fileno())
+                live.append((stat.st_mtime, stat.st_size, path))
+            except (FileNotFoundError, IsADirectoryError, PermissionError):
+                continue
+        return live
+
+    @staticmethod
+    def _remove_abandoned(path: Path, now_timestamp: float):
+        """
+        Remove a shared mode write that was not renamed for too long
+        """
+        try:
+            if path.stat().st_mtime + TEMP_MAX_AGE < now_timestamp:
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def _shrink(self, live: list[tuple], max_size: int) -> int:
+        """
+        Remove the oldest entries until they fit in max_size bytes
+        :return: int. The size left
+        """
+        total = sum(size for _, size, _ in live)
+        for _, size, path in sorted(live):
+            if total <= max_size:
+                break
+            try:
+                os.unlink(path)
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        return total
+
+    def collect(self):
+        """
+        Full garbage collection pass: remove the expired entries and, with MAX_SIZE,
+        the oldest ones until the total size fits
+        :return:
+        """
+        now_timestamp = datetime.utcnow().timestamp()
+        live = []
+        for unit in self._units():
+            if unit.is_dir():
+                live.extend(self._scan(unit, now_timestamp))
+        if self._max_size is not None:
+            self._shrink(live, self._max_size)
+        # The shard sizes are measured again by the next steps
+        self._unit_sizes = {}
+
+    def collect_step(self):
+        """
+        Incremental garbage collection over the next shard. The size of each shard
+        is remembered from its last step, and a shard is only shrunk when the total
+        exceeds MAX_SIZE, to its share of MAX_SIZE. The namespaces don't hold the
+        same amount of data, so an even split of MAX_SIZE would evict too much
+        :return:
+        """
+        units = self._units()
+        index = next(self._gc_cursor) % len(units)
+        unit = units[index]
+        live = self._scan(unit, datetime.utcnow().timestamp()) if unit.is_dir() else []
+        if self._max_size is None:
+            return
+        sizes = self._unit_sizes
+        if index == 0:
+            # Forget the shards of the cleared namespaces, once per round
+            current = set(units)
+            sizes = {other: size for other, size in sizes.items() if other in current}
+        sizes[unit] = sum(size for _, size, _ in live)
+        total = sum(sizes.values())
+        if total > self._max_size:
+            sizes[unit] = self._shrink(live, sizes[unit] * self._max_size // total)
+        self._unit_sizes = sizes
+
+    def sync_delete(self, key: str):
+        """
+        Delete the key
+        :param key: str
+        :return:
+        """
+        try:
+            os.unlink(self.get_path(key=key))
+        except FileNotFoundError:
+            pass
+
+    async def async_delete(self, key: str):
+        self.sync_delete(key=key)
+
+    def sync_clear_namespace(self, namespace: str):
+        """
+        Delete every key of the namespace. Its directory is renamed first, so the
+        namespace is empty at once for every process, then removed
+        :param namespace: str
+        :return:
+        """
+        directory = self._path / NAMESPACES_DIR / namespace
+        trash = directory.with_name(
+            f".{namespace}.{os.getpid()}.{threading.get_ident()}{TRASH_SUFFIX}"
+        )
+        try:
+            os.rename(directory, trash)
+        except FileNotFoundError:
+            return
+        shutil.rmtree(trash, ignore_errors=True)
+
+    async def async_clear_namespace(self, namespace: str):
+        await asyncio.to_thread(self.sync_clear_namespace, namespace)
+
+    def close(self):
+        """
+        Stop the background collector
+        :return:
+        """
+        self._collector_stop.set()
+
+    @staticmethod
+    def _collect_forever(
+        state_ref: weakref.ref, interval: float, stop: threading.Event
+    ):
+        while not stop.wait(interval):
+            if (state := state_ref()) is None:
+                return
+            state.collect()
+            del state
+
+    def _should_collect(self) -> bool:
+        return bool(self._gc_every) and next(self._sets) % self._gc_every == 0
 
     def sync_get(self, key: str):
+        return self.__sync_get_with_ttl(key=key)[0]
+
+    def sync_get_many_with_ttl(self, keys: list[str]) -> list[tuple]:
+        return [self.__sync_get_with_ttl(key=key) for key in keys]
+
+    def __sync_get_with_ttl(self, key: str) -> tuple:
         path = self.get_path(key=key)
-        if path.exists():
+        try:
             with open(path, "rb") as file:
-                value = file.read()
-            return self.__unpickle_with_header(value)
-        return None
+                header = self.__read_header(file.read(HEADER.size))
+                if header is None:
+                    return MISS, None
+                payload_size, buffer_count, remaining = header
+                if os.fstat(file.fileno()).st_size >= self._mmap_threshold:
+                    data = memoryview(
+                        mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                    )[HEADER.size :]
+                else:
+                    data = memoryview(file.read())
+                return self.__load(data, payload_size, buffer_count), remaining
+        except FileNotFoundError:
+            return MISS, None
 
     def sync_set(self, key: str, value: any, ttl: int = _empty):
         path = self.get_path(key=key)
+        target = self.__write_path(path)
+        chunks = self.__dump(value, ttl)
+        try:
+            self.__write(target, chunks)
+        except FileNotFoundError:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self.__write(target, chunks)
+        os.replace(target, path)
+        if self._should_collect():
+            self.collect_step()
+
+    @staticmethod
+    def __write_path(path: Path) -> Path:
+        """
+        Every write goes to a file of its own that is renamed over the entry, so the
+        readers never see a partial write and the last writer wins. The old file
+        keeps its inode, the values still mapped from it stay valid
+        """
+        return path.with_name(
+            f".{path.name}.{os.getpid()}.{next(_write_ids)}{TEMP_SUFFIX}"
+        )
+
+    def __lock_path(self, key: str) -> Path:
+        digest = hashlib.blake2b(str(key).encode(), digest_size=8).digest()
+        stripe = int.from_bytes(digest, "little") % self._lock_stripes
+        return self._path / LOCKS_DIR / f"{stripe:x}"
+
+    @contextmanager
+    def sync_lock(self, key: str):
+        if not self._shared or fcntl is None:
+            yield MISS
+            return
+        with open(self.__lock_path(key), "ab") as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield self.sync_get(key=key)
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    @asynccontextmanager
+    async def async_lock(self, key: str):
+        if not self._shared or fcntl is None:
+            yield MISS
+            return
+        with open(self.__lock_path(key), "ab") as lock_file:
+            # Poll instead of blocking a thread, so a cancelled waiter leaves nothing
+            delay = 0.001
+            while True:
+                try:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 0.05)
+            try:
+                yield await self.async_get(key=key)
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    @staticmethod
+    def __write(path: Path, chunks: list):
         with open(path, "wb") as file:
-            file.write(self.__pickle_with_header(value, ttl))
+            for chunk in chunks:
+                file.write(chunk)
 
     async def async_get(self, key: str):
+        return (await self.__async_get_with_ttl(key=key))[0]
+
+    async def async_get_many_with_ttl(self, keys: list[str]) -> list[tuple]:
+        return [await self.__async_get_with_ttl(key=key) for key in keys]
+
+    async def __async_get_with_ttl(self, key: str) -> tuple:
         path = self.get_path(key=key)
-        if path.exists():
+        try:
             async with aiofile.async_open(path, "rb") as file:
-                value = await file.read()
-            return self.__unpickle_with_header(value)
-        return None
+                header = self.__read_header(await file.read(HEADER.size))
+                if header is None:
+                    return MISS, None
+                payload_size, buffer_count, remaining = header
+                if os.stat(path).st_size >= self._mmap_threshold:
+                    with open(path, "rb") as mapped_file:
+                        data = mmap.mmap(
+                            mapped_file.fileno(), 0, access=mmap.ACCESS_READ
+                        )
+                    data = memoryview(data)[HEADER.size :]
+                else:
+                    data = memoryview(await file.read())
+            return self.__load(data, payload_size, buffer_count), remaining
+        except FileNotFoundError:
+            return MISS, None
 
     async def async_set(self, key: str, value: any, ttl: int = _empty):
         path = self.get_path(key=key)
-        async with aiofile.async_open(path, "wb") as file:
-            await file.write(self.__pickle_with_header(value, ttl))
+        target = self.__write_path(path)
+        chunks = self.__dump(value, ttl)
+        try:
+            await self.__async_write(target, chunks)
+        except FileNotFoundError:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            await self.__async_write(target, chunks)
+        os.replace(target, path)
+        if self._should_collect():
+            await asyncio.to_thread(self.collect_step)
 
     @staticmethod
-    def __pickle_with_header(value: any, ttl: int = _empty) -> bytes:
-        pack = {
-            "created_at": datetime.utcnow().timestamp(),
-            "ttl": ttl,
-            "value": pickle.dumps(value),
-        }
-        return pickle.dumps(pack)
+    async def __async_write(path: Path, chunks: list):
+        async with aiofile.async_open(path, "wb") as file:
+            for chunk in chunks:
+                await file.write(chunk)
+
+    def __dump(self, value: any, ttl: int = _empty) -> list:
+        """
+        Header, payload and the out of band buffers, written without joining them
+        """
+        buffers = []
+        if getattr(self._serializer, "out_of_band", False):
+            payload, pickle_buffers = self._serializer.dumps_out_of_band(value)
+            for pickle_buffer in pickle_buffers:
+                raw = pickle_buffer.raw()
+                buffers.extend((BUFFER_SIZE.pack(raw.nbytes), raw))
+        else:
+            payload = self._serializer.dumps(value)
+        header = HEADER.pack(
+            MAGIC,
+            VERSION,
+            datetime.utcnow().timestamp(),
+            -1.0 if ttl in (_empty, None) else float(ttl),
+            len(payload),
+            len(buffers) // 2,
+        )
+        return [header, payload, *buffers]
 
     @staticmethod
-    def __unpickle_with_header(pack_bytes: bytes) -> Optional[any]:
+    def __read_header(header: bytes):
+        """
+        Payload size, buffer count and remaining ttl (None when it never dies), None
+        when the entry is expired or unknown
+        """
+        if (fields := _parse_header(header)) is None:
+            return None
+        created_at, ttl, payload_size, buffer_count = fields
         now_timestamp = datetime.utcnow().timestamp()
-        pack = pickle.loads(pack_bytes)
-        register_timestamp = pack.get("created_at")
-        _ttl = pack.get("ttl")
-        if _ttl == _empty or ((register_timestamp + _ttl) >= now_timestamp):
-            return pickle.loads(pack.get("value"))
-        return None
+        if _expired(created_at, ttl, now_timestamp):
+            return None
+        remaining = None if ttl < 0 else created_at + ttl - now_timestamp
+        return payload_size, buffer_count, remaining
+
+    @staticmethod
+    def __load(data: memoryview, payload_size: int, buffer_count: int) -> any:
+        payload = data[:payload_size]
+        buffers = []
+        offset = payload_size
+        for _ in range(buffer_count):
+            (size,) = BUFFER_SIZE.unpack_from(data, offset)
+            offset += BUFFER_SIZE.size
+            buffers.append(data[offset : offset + size])
+            offset += size
+        return serializers.loads(payload, buffers=buffers)
@@ -0,0 +1,252 @@
+"""
+Tiered state implementation
+"""
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from inspect import _empty
+from typing import Optional
+
+from mr.states.interface import IState, MISS
+
+
+class TierStats:  # pylint: disable=R0903
+    """
+    Tier hit and miss counters
+    """
+
+    __slots__ = ("_lock", "hits", "misses")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def record(self, hits: int, misses: int):
+        """
+        Count hits and misses
+        :param hits: int
+        :param misses: int
+        :return:
+        """
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+
+class TieredState(IState):
+    """
+    State that stacks other states (L1 memory -> L2 redis/temp file). Reads fall
+    through the tiers and the hits are promoted to the upper tiers
+    """
+
+    WRITE_THROUGH = "THROUGH"
+    WRITE_AROUND = "AROUND"
+
+    tiers: list[IState]
+    _max_ttls: list[Optional[int]]
+    _stats: list[TierStats]
+    _promotion_ttl: int
+    _write_mode: str
+
+    __slots__ = ("tiers", "_max_ttls", "_stats", "_promotion_ttl", "_write_mode")
+
+    def __init__(self, **kwargs):
+        try:
+            tiers = kwargs["TIERS"]
+        except KeyError as exception:
+            raise KeyError("The config value TIERS was not informed") from exception
+        if not tiers:
+            raise ValueError("The config value TIERS must have at least one tier")
+        for tier in tiers:
+            if not issubclass(tier["state"], IState):
+                raise TypeError("State class does not implement IState interface")
+        self.tiers = [tier["state"](**tier.get("state_kwargs", {})) for tier in tiers]
+        self._max_ttls = [tier.get("max_ttl") for tier in tiers]
+        self._stats = [TierStats() for _ in tiers]
+        self._promotion_ttl = kwargs.get("PROMOTION_TTL", 60)
+        self._write_mode = kwargs.get("WRITE_MODE", self.WRITE_THROUGH).upper()
+        if self._write_mode not in (self.WRITE_THROUGH, self.WRITE_AROUND):
+            raise ValueError(
+                f"The config value WRITE_MODE must be one of "
+                f"{[self.WRITE_THROUGH, self.WRITE_AROUND]}"
+            )
+
+    @property
+    def stats(self) -> list[dict[str, int]]:
+        """
+        Hit and miss counters of each tier
+        :return: list[dict]
+        """
+        return [{"hits": stats.hits, "misses": stats.misses} for stats in self._stats]
+
+    def _capped_ttl(self, index: int, ttl: int) -> int:
+        if (max_ttl := self._max_ttls[index]) is None:
+            return ttl
+        if ttl in (_empty, None):
+            return max_ttl
+        return min(ttl, max_ttl)
+
+    def _promotion_ttl_for(self, index: int) -> int:
+        if (max_ttl := self._max_ttls[index]) is None:
+            return self._promotion_ttl
+        return max_ttl
+
+    def _promotions(self, upper: int, promoted: dict[str, tuple]) -> dict[int, dict]:
+        """
+        The values promoted to the upper tier by ttl. A value doesn't outlive the
+        remaining ttl of the tier it was found on, and is not promoted when that is
+        under a second
+        """
+        promotion_ttl = self._promotion_ttl_for(upper)
+        groups = {}
+        for key, (value, remaining) in promoted.items():
+            ttl = (
+                promotion_ttl
+                if remaining is None
+                else min(promotion_ttl, int(remaining))
+            )
+            if ttl > 0:
+                groups.setdefault(ttl, {})[key] = value
+        return groups
+
+    def _write_tiers(self) -> list[int]:
+        if self._write_mode == self.WRITE_AROUND:
+            return [len(self.tiers) - 1]
+        return list(range(len(self.tiers)))
+
+    def _sync_invalidate_around(self, keys):
+        """
+        Writing around leaves the upper tiers with the old values, drop them
+        """
+        if self._write_mode == self.WRITE_AROUND:
+            for tier in self.tiers[:-1]:
+                for key in keys:
+                    tier.sync_delete(key=key)
+
+    async def _async_invalidate_around(self, keys):
+        if self._write_mode == self.WRITE_AROUND:
+            for tier in self.tiers[:-1]:
+                for key in keys:
+                    await tier.async_delete(key=key)
+
+    def sync_get(self, key: str):
+        return self.sync_get_many(keys=[key])[0]
+
+    def sync_set(self, key: str, value: any, ttl: int = _empty):
+        self.sync_set_many(values={key: value}, ttl=ttl)
+
+    async def async_get(self, key: str):
+        return (await self.async_get_many(keys=[key]))[0]
+
+    async def async_set(self, key: str, value: any, ttl: int = _empty):
+        await self.async_set_many(values={key: value}, ttl=ttl)
+
+    def sync_get_many(self, keys: list[str]) -> list:
+        values = [MISS] * len(keys)
+        missing = list(range(len(keys)))
+        for index, tier in enumerate(self.tiers):
+            tier_keys = [keys[position] for position in missing]
+            if index:
+                found = tier.sync_get_many_with_ttl(keys=tier_keys)
+            else:
+                found = [(value, None) for value in tier.sync_get_many(keys=tier_keys)]
+            hits = {
+                position: row
+                for position, row in zip(missing, found)
+                if row[0] is not MISS
+            }
+            self._stats[index].record(hits=len(hits), misses=len(missing) - len(hits))
+            for position, (value, _) in hits.items():
+                values[position] = value
+            if hits and index:
+                promoted = {keys[position]: row for position, row in hits.items()}
+                for upper in range(index):
+                    for ttl, group in self._promotions(upper, promoted).items():
+                        self.tiers[upper].sync_set_many(values=group, ttl=ttl)
+            missing = [position for position in missing if position not in hits]
+            if not missing:
+                break
+        return values
+
+    def sync_set_many(self, values: dict[str, any], ttl: int = _empty):
+        for index in self._write_tiers():
+            self.tiers[index].sync_set_many(
+                values=values, ttl=self._capped_ttl(index, ttl)
+            )
+        self._sync_invalidate_around(values)
+
+    async def async_get_many(self, keys: list[str]) -> list:
+        values = [MISS] * len(keys)
+        missing = list(range(len(keys)))
+        for index, tier in enumerate(self.tiers):
+            tier_keys = [keys[position] for position in missing]
+            if index:
+                found = await tier.async_get_many_with_ttl(keys=tier_keys)
+            else:
+                found = [
+                    (value, None) for value in await tier.async_get_many(keys=tier_keys)
+                ]
+            hits = {
+                position: row
+                for position, row in zip(missing, found)
+                if row[0] is not MISS
+            }
+            self._stats[index].record(hits=len(hits), misses=len(missing) - len(hits))
+            for position, (value, _) in hits.items():
+                values[position] = value
+            if hits and index:
+                promoted = {keys[position]: row for position, row in hits.items()}
+                for upper in range(index):
+                    for ttl, group in self._promotions(upper, promoted).items():
+                        await self.tiers[upper].async_set_many(values=group, ttl=ttl)
+            missing = [position for position in missing if position not in hits]
+            if not missing:
+                break
+        return values
+
+    async def async_set_many(self, values: dict[str, any], ttl: int = _empty):
+        for index in self._write_tiers():
+            await self.tiers[index].async_set_many(
+                values=values, ttl=self._capped_ttl(index, ttl)
+            )
+        await self._async_invalidate_around(values)
+
+    def sync_replace(self, key: str, value: any, ttl: int = _empty):
+        for index in self._write_tiers():
+            self.tiers[index].sync_replace(
+                key=key, value=value, ttl=self._capped_ttl(index, ttl)
+            )
+        self._sync_invalidate_around([key])
+
+    async def async_replace(self, key: str, value: any, ttl: int = _empty):
+        for index in self._write_tiers():
+            await self.tiers[index].async_replace(
+                key=key, value=value, ttl=self._capped_ttl(index, ttl)
+            )
+        await self._async_invalidate_around([key])
+
+    def sync_delete(self, key: str):
+        for tier in self.tiers:
+            tier.sync_delete(key=key)
+
+    async def async_delete(self, key: str):
+        for tier in self.tiers:
+            await tier.async_delete(key=key)
+
+    def sync_clear_namespace(self, namespace: str):
+        for tier in self.tiers:
+            tier.sync_clear_namespace(namespace=namespace)
+
+    async def async_clear_namespace(self, namespace: str):
+        for tier in self.tiers:
+            await tier.async_clear_namespace(namespace=namespace)
+
+    @contextmanager
+    def sync_lock(self, key: str):
+        with self.tiers[-1].sync_lock(key=key) as value:
+            yield value
+
+    @asynccontextmanager
+    async def async_lock(self, key: str):
+        async with self.tiers[-1].async_lock(key=key) as value:
+            yield value
@@ -2,7 +2,71 @@
 State interface. You can implement your own State approach
 """
 
+import os
+import stat
+import tempfile
 from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager, contextmanager
+from pathlib import Path
+
+
+class _Miss:
+    """
+    Returned by the states when the key is not cached, so None, 0, "" and other
+    falsy values can be cached too
+    """
+
+    __slots__ = ()
+
+    def __repr__(self):
+        return "MISS"
+
+    def __bool__(self):
+        return False
+
+    def __reduce__(self):
+        return "MISS"
+
+
+MISS = _Miss()
+
+# Mime keys are "<namespace>:<digest>", one namespace per decorated function
+NAMESPACE_SEPARATOR = ":"
+
+
+def namespace_of(key: str):
+    """
+    Namespace of a key, None when the key has none
+    :param key: str
+    :return: Optional[str]
+    """
+    namespace, separator, _ = str(key).partition(NAMESPACE_SEPARATOR)
+    return namespace if separator else None
+
+
+def private_temp_directory(name: str, config: str) -> Path:
+    """
+    <name>-<uid> directory of the user on the OS temp folder, created with mode 0700.
+    The values are unpickled, so it must not be writable by anyone else
+    :param name: str. Directory name, the uid is appended when the OS has one
+    :param config: str. Config value named on the error
+    :return: Path
+    """
+    uid = os.getuid() if hasattr(os, "getuid") else None
+    directory = Path(tempfile.gettempdir()) / (name if uid is None else f"{name}-{uid}")
+    directory.mkdir(mode=0o700, exist_ok=True)
+    if uid is not None:
+        directory_stat = directory.lstat()
+        if (
+            not stat.S_ISDIR(directory_stat.st_mode)
+            or directory_stat.st_uid != uid
+            or directory_stat.st_mode & 0o077
+        ):
+            raise TypeError(
+                f"The default {config} directory {directory} is not private to the"
+                f" user, set the config value {config}"
+            )
+    return directory
 
 
 class IState(ABC):
@@ -19,7 +83,7 @@ class IState(ABC):
         """
         Sync get implementation
         :param key: str
-        :return:
+        :return: The cached value or MISS
         """
 
     @abstractmethod
@@ -37,7 +101,7 @@ class IState(ABC):
         """
         Async get implementation
         :param key: str
-        :return:
+        :return: The cached value or MISS
         """
 
     @abstractmethod
@@ -49,3 +113,137 @@ class IState(ABC):
         :param ttl: int. Seconds that the cache will have to live. Set None to never die
         :return:
         """
+
+    def sync_get_many(self, keys: list[str]) -> list:
+        """
+        Sync multi-get. Override it when the state can fetch many keys at once
+        :param keys: list[str]
+        :return: list. The cached values or MISS, in the keys order
+        """
+        return [self.sync_get(key) for key in keys]
+
+    def sync_set_many(self, values: dict[str, any], ttl: int):
+        """
+        Sync multi-set. Override it when the state can store many keys at once
+        :param values: dict[str, Any]. Values by key
+        :param ttl: int. Seconds that the cache will have to live. Set None to never die
+        :return:
+        """
+        for key, value in values.items():
+            self.sync_set(key=key, value=value, ttl=ttl)
+
+    async def async_get_many(self, keys: list[str]) -> list:
+        """
+        Async multi-get. Override it when the state can fetch many keys at once
+        :param keys: list[str]
+        :return: list. The cached values or MISS, in the keys order
+        """
+        return [await self.async_get(key) for key in keys]
+
+    async def async_set_many(self, values: dict[str, any], ttl: int):
+        """
+        Async multi-set. Override it when the state can store many keys at once
+        :param values: dict[str, Any]. Values by key
+        :param ttl: int. Seconds that the cache will have to live. Set None to never die
+        :return:
+        """
+        for key, value in values.items():
+            await self.async_set(key=key, value=value, ttl=ttl)
+
+    def sync_get_many_with_ttl(self, keys: list[str]) -> list[tuple]:
+        """
+        Sync multi-get with the remaining ttl of the values, used to promote them
+        between tiers. Override it when the state knows the ttl of its values
+        :param keys: list[str]
+        :return: list. (value or MISS, remaining seconds or None when the value never
+        dies or the ttl is unknown), in the keys order
+        """
+        return [(value, None) for value in self.sync_get_many(keys=keys)]
+
+    async def async_get_many_with_ttl(self, keys: list[str]) -> list[tuple]:
+        """
+        Async multi-get with the remaining ttl of the values, used to promote them
+        between tiers. Override it when the state knows the ttl of its values
+        :param keys: list[str]
+        :return: list. (value or MISS, remaining seconds or None when the value never
+        dies or the ttl is unknown), in the keys order
+        """
+        return [(value, None) for value in await self.async_get_many(keys=keys)]
+
+    def sync_replace(self, key: str, value: any, ttl: int):
+        """
+        Sync set that overwrites the cached value, used by the background refreshes.
+        Override it when sync_set keeps the value already cached
+        :param key: str
+        :param value: Any
+        :param ttl: int. Seconds that the cache will have to live. Set None to never die
+        :return:
+        """
+        self.sync_set(key=key, value=value, ttl=ttl)
+
+    async def async_replace(self, key: str, value: any, ttl: int):
+        """
+        Async set that overwrites the cached value, used by the background refreshes.
+        Override it when async_set keeps the value already cached
+        :param key: str
+        :param value: Any
+        :param ttl: int. Seconds that the cache will have to live. Set None to never die
+        :return:
+        """
+        await self.async_set(key=key, value=value, ttl=ttl)
+
+    def sync_delete(self, key: str):
+        """
+        Sync delete. Override it to support fn.invalidate
+        :param key: str
+        :return:
+        """
+        raise NotImplementedError(f"{type(self).__name__} can not delete keys")
+
+    async def async_delete(self, key: str):
+        """
+        Async delete. Override it to support fn.invalidate
+        :param key: str
+        :return:
+        """
+        raise NotImplementedError(f"{type(self).__name__} can not delete keys")
+
+    def sync_clear_namespace(self, namespace: str):
+        """
+        Sync delete of every key of the namespace. Override it to support fn.clear
+        and the tag invalidation
+        :param namespace: str
+        :return:
+        """
+        raise NotImplementedError(f"{type(self).__name__} can not clear namespaces")
+
+    async def async_clear_namespace(self, namespace: str):
+        """
+        Async delete of every key of the namespace. Override it to support fn.clear
+        and the tag invalidation
+        :param namespace: str
+        :return:
+        """
+        raise NotImplementedError(f"{type(self).__name__} can not clear namespaces")
+
+    @contextmanager
+    def sync_lock(self, key: str):  # pylint: disable=W0613
+        """
+        Sync lock shared with the other processes using the same storage, held while
+        the value of a missing key is computed (cross-process single flight). Override
+        it when the state can lock, by default nothing is locked
+        :param key: str
+        :return: Context manager that yields the value cached meanwhile or MISS
+        """
+        yield MISS
+
+    @asynccontextmanager
+    async def async_lock(self, key: str):  # pylint: disable=W0613
+        """
+        Async lock shared with the other processes using the same storage, held while
+        the value of a missing key is computed (cross-process single flight). Override
+        it when the state can lock, by default nothing is locked
+        :param key: str
+        :return: Async context manager that yields the value cached meanwhile or MISS
+        """
+        yield MISS
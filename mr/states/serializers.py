@@ -0,0 +1,188 @@
+"""
+Serializers used by the states that store bytes. The format is self-describing, the
+first byte tells how to load it, so switching serializer keeps the old entries readable
+"""
+import json
+import lzma
+import marshal
+import pickle
+import zlib
+from abc import ABC, abstractmethod
+
+_PICKLE = 0x80  # PROTO opcode, the first byte of every pickle since protocol 2
+_MARSHAL = ord("M")
+_JSON = ord("J")
+_ZLIB = ord("Z")
+_LZMA = ord("X")
+
+
+class ISerializer(ABC):  # pylint: disable=R0903
+    """
+    Serializer interface
+    """
+
+    @abstractmethod
+    def dumps(self, value: any) -> bytes:
+        """
+        Serialize the value, the result must start with the serializer tag
+        :param value: Any
+        :return: bytes
+        """
+
+
+class PickleSerializer(ISerializer):  # pylint: disable=R0903
+    """
+    Pickle with a selectable protocol, the pickle header itself is the tag
+    """
+
+    __slots__ = ("protocol",)
+
+    def __init__(self, protocol: int = pickle.DEFAULT_PROTOCOL):
+        if protocol < 2:
+            raise ValueError("The pickle protocol must be 2 or higher")
+        self.protocol = protocol
+
+    def dumps(self, value: any) -> bytes:
+        return pickle.dumps(value, protocol=self.protocol)
+
+    @property
+    def out_of_band(self) -> bool:
+        """
+        Protocol 5 can keep large buffers out of the pickle stream
+        :return: bool
+        """
+        return self.protocol >= 5
+
+    def dumps_out_of_band(self, value: any) -> tuple[bytes, list[pickle.PickleBuffer]]:
+        """
+        Serialize the value keeping the buffers (bytearray, arrays) out of band, so
+        they are written and loaded without copies
+        :param value: Any
+        :return: tuple[bytes, list[PickleBuffer]]
+        """
+        buffers = []
+        data = pickle.dumps(
+            value, protocol=self.protocol, buffer_callback=buffers.append
+        )
+        return data, buffers
+
+
+class MarshalSerializer(ISerializer):  # pylint: disable=R0903
+    """
+    Marshal, fast for plain data (None, bool, int, float, str, bytes, list, tuple,
+    set and dict). A bytearray is loaded as bytes
+    """
+
+    __slots__ = ()
+
+    def dumps(self, value: any) -> bytes:
+        return bytes((_MARSHAL,)) + marshal.dumps(value)
+
+
+class JsonSerializer(ISerializer):  # pylint: disable=R0903
+    """
+    JSON, for plain JSON-like data. Tuples are loaded as lists
+    """
+
+    __slots__ = ()
+
+    def dumps(self, value: any) -> bytes:
+        return bytes((_JSON,)) + json.dumps(value, separators=(",", ":")).encode()
+
+
+class CompressedSerializer(ISerializer):  # pylint: disable=R0903
+    """
+    Compress the inner serializer result when it is bigger than threshold bytes
+    """
+
+    __slots__ = ("inner", "tag", "threshold", "_compress")
+
+    def __init__(
+        self,
+        inner: ISerializer,
+        algorithm: str = "zlib",
+        threshold: int = 1024,
+        level: int = None,
+    ):
+        self.inner = inner
+        self.threshold = threshold
+        algorithm = algorithm.lower()
+        if algorithm == "zlib":
+            self.tag = bytes((_ZLIB,))
+            level = -1 if level is None else level
+            self._compress = lambda data: zlib.compress(data, level)
+        elif algorithm == "lzma":
+            self.tag = bytes((_LZMA,))
+            self._compress = lambda data: lzma.compress(data, preset=level)
+        else:
+            raise ValueError(
+                "The compression algorithm must be one of ['zlib', 'lzma']"
+            )
+
+    def dumps(self, value: any) -> bytes:
+        data = self.inner.dumps(value)
+        if len(data) < self.threshold:
+            return data
+        return self.tag + self._compress(data)
+
+
+def loads(data: bytes, buffers: list = None) -> any:
+    """
+    Load bytes written by any serializer
+    :param data: bytes-like
+    :param buffers: list. Out of band pickle buffers
+    :return: Any
+    """
+    tag = data[0]
+    if tag == _PICKLE:
+        return pickle.loads(data, buffers=buffers)
+    payload = memoryview(data)[1:]
+    if tag == _MARSHAL:
+        return marshal.loads(payload)
+    if tag == _JSON:
+        return json.loads(bytes(payload))
+    if tag == _ZLIB:
+        return loads(zlib.decompress(payload))
+    if tag == _LZMA:
+        return loads(lzma.decompress(payload))
+    raise ValueError(f"Unknown serializer tag {tag}")
+
+
+SERIALIZERS: dict[str, type[ISerializer]] = {
+    "PICKLE": PickleSerializer,
+    "MARSHAL": MarshalSerializer,
+    "JSON": JsonSerializer,
+}
+
+
+def from_kwargs(kwargs: dict) -> ISerializer:
+    """
+    Build the serializer from the state kwargs: SERIALIZER (a name or an ISerializer
+    instance), PICKLE_PROTOCOL, COMPRESSION (zlib or lzma), COMPRESSION_THRESHOLD
+    and COMPRESSION_LEVEL
+    :param kwargs: dict
+    :return: ISerializer
+    """
+    serializer = kwargs.get("SERIALIZER", "PICKLE")
+    if not isinstance(serializer, ISerializer):
+        try:
+            serializer_class = SERIALIZERS[serializer.upper()]
+        except (KeyError, AttributeError) as exception:
+            raise KeyError(
+                f"The config value SERIALIZER must be one of {list(SERIALIZERS)} "
+                f"or an ISerializer instance"
+            ) from exception
+        if serializer_class is PickleSerializer:
+            serializer = PickleSerializer(
+                protocol=kwargs.get("PICKLE_PROTOCOL", pickle.DEFAULT_PROTOCOL)
+            )
+        else:
+            serializer = serializer_class()
+    if (algorithm := kwargs.get("COMPRESSION")) is not None:
+        serializer = CompressedSerializer(
+            inner=serializer,
+            algorithm=algorithm,
+            threshold=kwargs.get("COMPRESSION_THRESHOLD", 1024),
+            level=kwargs.get("COMPRESSION_LEVEL"),
+        )
+    return serializer
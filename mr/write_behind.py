@@ -0,0 +1,285 @@
+"""
+Write-behind of cached values. The computed values are queued and a background
+thread stores them in batches, so the state write is not on the caller path
+"""
+import asyncio
+import atexit
+import queue
+import threading
+import time
+import weakref
+from contextlib import AbstractContextManager
+from typing import Callable, Optional
+
+from mr.states.interface import IState, MISS, NAMESPACE_SEPARATOR
+
+# What to do when the queue is full
+SYNC = "SYNC"  # the caller writes the value itself
+DROP = "DROP"  # the value is not stored
+BLOCK = "BLOCK"  # the caller waits for room in the queue
+POLICIES = (SYNC, DROP, BLOCK)
+
+FLUSH_AT_EXIT_TIMEOUT = 5.0
+
+_writers: weakref.WeakSet = weakref.WeakSet()
+
+
+class WriteBehind:  # pylint: disable=R0902
+    """
+    Bounded queue of (key, value, ttl) writes, drained by a daemon thread with the
+    state multi-set, one per ttl of each batch. Queued values are returned by
+    pending until they are written, so the callers don't compute them again
+    """
+
+    _acquire: Callable[[], AbstractContextManager[IState]]
+    _queue: queue.Queue
+    _batch_size: int
+    _policy: str
+    _lock: threading.Lock
+    _pending: dict[str, tuple]
+    _in_flight: set[str]
+    _discarded: set[str]
+    _thread: Optional[threading.Thread]
+    queued: int
+    written: int
+    dropped: int
+    errors: int
+
+    __slots__ = (
+        "_acquire",
+        "_queue",
+        "_batch_size",
+        "_policy",
+        "_lock",
+        "_pending",
+        "_in_flight",
+        "_discarded",
+        "_thread",
+        "queued",
+        "written",
+        "dropped",
+        "errors",
+        "__weakref__",
+    )
+
+    def __init__(
+        self,
+        acquire: Callable[[], AbstractContextManager[IState]],
+        max_queue: int = 10_000,
+        batch_size: int = 256,
+        policy: str = SYNC,
+    ):
+        """
+        :param acquire: Callable returning the sync state context manager
+        :param max_queue: int. Queued writes before the policy applies
+        :param batch_size: int. Writes stored by each multi-set round
+        :param policy: str. SYNC, DROP or BLOCK
+        """
+        if str(policy).upper() not in POLICIES:
+            raise ValueError(f"The write-behind policy must be one of {list(POLICIES)}")
+        self._acquire = acquire
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._batch_size = batch_size
+        self._policy = policy.upper()
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._in_flight = set()
+        self._discarded = set()
+        self._thread = None
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        _writers.add(self)
+
+    def _start(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._drain_forever,
+                        args=(weakref.ref(self), self._queue),
+                        name="mr-write-behind",
+                        daemon=True,
+                    )
+                    self._thread.start()
+
+    def _offer(self, entry: tuple, block: bool) -> bool:
+        with self._lock:
+            self._pending[entry[0]] = entry
+        try:
+            self._queue.put(entry, block=block)
+        except queue.Full:
+            with self._lock:
+                if self._pending.get(entry[0]) is entry:
+                    del self._pending[entry[0]]
+            return False
+        self.queued += 1
+        return True
+
+    def sync_put(self, key: str, value: any, ttl: int) -> bool:
+        """
+        Queue a write
+        :param key: str
+        :param value: Any. The value as stored in the state
+        :param ttl: int
+        :return: bool. False when the queue is full and, with the SYNC policy, the
+        caller must write the value itself
+        """
+        self._start()
+        if self._offer((key, value, ttl), block=self._policy == BLOCK):
+            return True
+        return self._full()
+
+    async def async_put(self, key: str, value: any, ttl: int) -> bool:
+        """
+        Queue a write without blocking the event loop
+        :param key: str
+        :param value: Any. The value as stored in the state
+        :param ttl: int
+        :return: bool. False when the queue is full and, with the SYNC policy, the
+        caller must write the value itself
+        """
+        self._start()
+        entry = (key, value, ttl)
+        delay = 0.001
+        while not self._offer(entry, block=False):
+            if self._policy != BLOCK:
+                return self._full()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.05)
+        return True
+
+    def _full(self) -> bool:
+        if self._policy == DROP:
+            self.dropped += 1
+            return True
+        return False
+
+    def pending(self, key: str):
+        """
+        The queued value of the key
+        :param key: str
+        :return: The value or MISS
+        """
+        entry = self._pending.get(key)
+        return MISS if entry is None else entry[1]
+
+    def discard(self, key: str):
+        """
+        Forget the queued write of the key, used when it is invalidated. A write
+        already running is deleted once it is done
+        :param key: str
+        :return:
+        """
+        with self._lock:
+            self._pending.pop(key, None)
+            if key in self._in_flight:
+                self._discarded.add(key)
+
+    def discard_namespace(self, namespace: str):
+        """
+        Forget the queued writes of the namespace
+        :param namespace: str
+        :return:
+        """
+        prefix = namespace + NAMESPACE_SEPARATOR
+        with self._lock:
+            for key in [key for key in self._pending if key.startswith(prefix)]:
+                del self._pending[key]
+            self._discarded.update(
+                key for key in self._in_flight if key.startswith(prefix)
+            )
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until every queued write is stored
+        :param timeout: Optional[float]. Seconds, None waits forever
+        :return: bool. False when the timeout expired first
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    async def async_flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until every queued write is stored, without blocking the event loop
+        :param timeout: Optional[float]. Seconds, None waits forever
+        :return: bool. False when the timeout expired first
+        """
+        return await asyncio.to_thread(self.flush, timeout)
+
+    def _write(self, batch: list[tuple]):
+        with self._lock:
+            # Skip the writes discarded or replaced by a newer one meanwhile
+            batch = [entry for entry in batch if self._pending.get(entry[0]) is entry]
+            self._in_flight = {entry[0] for entry in batch}
+        groups = {}
+        for key, value, ttl in batch:
+            groups.setdefault(ttl, {})[key] = value
+        try:
+            with self._acquire() as state:
+                for ttl, values in groups.items():
+                    state.sync_set_many(values=values, ttl=ttl)
+                self.written += len(batch)
+                with self._lock:
+                    discarded, self._discarded = self._discarded, set()
+                    self._in_flight = set()
+                for key in discarded:
+                    state.sync_delete(key=key)
+        except Exception:  # pylint: disable=W0718
+            self.errors += 1
+        finally:
+            with self._lock:
+                self._in_flight = set()
+                self._discarded = set()
+                for entry in batch:
+                    if self._pending.get(entry[0]) is entry:
+                        del self._pending[entry[0]]
+
+    @staticmethod
+    def _drain_forever(writer_ref: weakref.ref, writes: queue.Queue):
+        while True:
+            batch = [writes.get()]
+            if (writer := writer_ref()) is None:
+                return
+            while len(batch) < writer._batch_size:  # pylint: disable=W0212
+                try:
+                    batch.append(writes.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                writer._write(batch)  # pylint: disable=W0212
+            finally:
+                for _ in batch:
+                    writes.task_done()
+            del writer
+
+
+def discard_namespace(namespace: str):
+    """
+    Forget the queued writes of the namespace in every write-behind queue
+    :param namespace: str
+    :return:
+    """
+    for writer in list(_writers):
+        writer.discard_namespace(namespace=namespace)
+
+
+def flush_all(timeout: Optional[float] = None) -> bool:
+    """
+    Flush every write-behind queue, for a clean shutdown
+    :param timeout: Optional[float]. Seconds for each queue, None waits forever
+    :return: bool. False when a timeout expired
+    """
+    # Every queue is flushed, even after a timeout
+    flushed = [writer.flush(timeout) for writer in list(_writers)]
+    return all(flushed)
+
+
+atexit.register(flush_all, FLUSH_AT_EXIT_TIMEOUT)
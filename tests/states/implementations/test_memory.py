@@ -1,3 +1,6 @@
+import sys
+import threading
+import time
 from inspect import _empty
 from random import randint
 from uuid import uuid4
@@ -5,6 +8,7 @@ from uuid import uuid4
 import pytest
 from freezegun import freeze_time
 
+from mr import MISS
 from mr.states import MemoryState
 
 
@@ -35,7 +39,7 @@ def state_with_data():
 def test_sync_get_without_data(state_with_data):
     state, data = state_with_data
     value = state.sync_get(key=1)
-    assert value is None
+    assert value is MISS
 
 
 def test_sync_get_expired_ttl():
@@ -67,7 +71,7 @@ def test_sync_get_without_ttl_set(state_with_data):
 async def test_async_get_without_data(state_with_data):
     state, data = state_with_data
     value = await state.async_get(1)
-    assert value is None
+    assert value is MISS
 
 
 @pytest.mark.asyncio
@@ -75,7 +79,7 @@ async def test_async_get_expired_ttl(state_with_data):
     state, data = state_with_data
     with freeze_time("2023-01-14 13:00:00"):
         value = await state.async_get(1)
-    assert value is None
+    assert value is MISS
 
 
 @pytest.mark.asyncio
@@ -93,3 +97,274 @@ async def test_async_get_without_ttl_set(state_with_data):
     await state.async_set(*data)
     value = await state.async_get(data[0])
     assert value == data[1]
+
+
+def test_wrong_eviction_policy():
+    with pytest.raises(KeyError) as exception:
+        MemoryState(MAX_ENTRIES=1, EVICTION_POLICY="FIFO")
+    assert exception.value.args[0] == (
+        "The config value EVICTION_POLICY must be one of ['LRU', 'LFU', 'TINYLFU']"
+    )
+
+
+def test_max_entries_lru():
+    state = MemoryState(MAX_ENTRIES=2)
+    state.sync_set(1, 1)
+    state.sync_set(2, 2)
+    state.sync_get(1)
+    state.sync_set(3, 3)
+    assert set(state._state) == {1, 3}
+    assert state.stats == {"entries": 2, "bytes": 0, "evictions": 1, "expirations": 0}
+
+
+def test_max_entries_overwrite():
+    state = MemoryState(MAX_ENTRIES=2, EVICTION_POLICY="lfu")
+    state.sync_set(1, 1)
+    state.sync_set(1, 2)
+    state.sync_set(2, 2)
+    assert state.sync_get(1) == 2
+    assert state.evictions == 0
+
+
+def test_max_bytes():
+    state = MemoryState(MAX_BYTES=10, SIZE_OF=len)
+    state.sync_set(1, "12345")
+    state.sync_set(2, "12345")
+    state.sync_set(3, "1")
+    assert set(state._state) == {2, 3}
+    assert state.stats == {"entries": 2, "bytes": 6, "evictions": 1, "expirations": 0}
+    state.sync_set(4, "12345678901")
+    assert state._state == {}
+    assert state.stats == {"entries": 0, "bytes": 0, "evictions": 4, "expirations": 0}
+
+
+def test_max_entries_tinylfu():
+    state = MemoryState(MAX_ENTRIES=2, EVICTION_POLICY="TINYLFU")
+    for key in range(10):
+        state.sync_set(key, key)
+    assert len(state._state) == 2
+    assert state.evictions == 8
+
+
+@pytest.mark.parametrize("policy", ["LRU", "LFU", "TINYLFU"])
+def test_concurrent_get_and_eviction(policy):
+    state = MemoryState(MAX_ENTRIES=2, EVICTION_POLICY=policy)
+    errors = []
+
+    def setter():
+        for step in range(20000):
+            state.sync_set(step % 3, step)
+
+    def getter():
+        try:
+            for step in range(20000):
+                state.sync_get(step % 3)
+        except Exception as exception:  # pylint: disable=W0718
+            errors.append(exception)
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=setter), threading.Thread(target=getter)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+    assert errors == []
+    assert len(state._state) == 2
+
+
+def test_set_purges_expired_entries():
+    state = MemoryState(EXPIRE_STEP=1)
+    with freeze_time("2023-01-14 12:00:00"):
+        state.sync_set(1, 1, 1)
+        state.sync_set(2, 2, 1)
+        state.sync_set(3, 3)
+    with freeze_time("2023-01-14 12:00:05"):
+        state.sync_set(4, 4, 1)
+        assert set(state._state) == {2, 3, 4}
+        state.sync_set(5, 5, 1)
+    assert set(state._state) == {3, 4, 5}
+    assert state.stats["expirations"] == 2
+
+
+def test_purge_expired_overwritten_key():
+    state = MemoryState(MAX_ENTRIES=10)
+    with freeze_time("2023-01-14 12:00:00"):
+        state.sync_set(1, 1, 1)
+        state.sync_set(1, 2, 100)
+    with freeze_time("2023-01-14 12:00:05"):
+        assert state.purge_expired() == 1
+        assert state.sync_get(1) == 2
+    assert state.expirations == 0
+
+
+def test_expiry_heap_is_compacted():
+    state = MemoryState(MAX_ENTRIES=10, EXPIRE_STEP=1)
+    with freeze_time("2023-01-14 12:00:00"):
+        for step in range(1000):
+            state.sync_set(step % 20, step, 100 + step)
+            state.sync_delete((step + 5) % 20)
+    assert len(state._expiry) <= 2 * len(state._state) + 1
+    entries = len(state._state)
+    with freeze_time("2023-01-14 12:30:00"):
+        assert state.purge_expired(max_entries=100) <= 2 * entries + 1
+    assert state._state == {}
+    assert state.expirations == entries
+
+
+def test_get_removes_expired_entry():
+    state = MemoryState(MAX_ENTRIES=10)
+    with freeze_time("2023-01-14 12:00:00"):
+        state.sync_set(1, 1, 1)
+    with freeze_time("2023-01-14 12:00:05"):
+        assert state.sync_get(1) is MISS
+    assert state._state == {}
+    assert state.expirations == 1
+
+
+def test_background_sweeper():
+    state = MemoryState(SWEEP_INTERVAL=0.01)
+    state.sync_set(1, 1, -1)
+    for _ in range(100):
+        if not state._state:
+            break
+        time.sleep(0.01)
+    state.close()
+    assert state._state == {}
+    assert state.expirations == 1
+
+
+@pytest.mark.parametrize("value", [None, 0, "", [], False])
+def test_sync_get_falsy_value(value):
+    state = MemoryState()
+    state.sync_set(1, value)
+    assert state.sync_get(1) == value
+    assert state.sync_get(1) is not MISS
+
+
+def test_sync_get_many():
+    state = MemoryState()
+    with freeze_time("2023-01-14 12:00:00"):
+        state.sync_set_many({1: 1, 2: None}, ttl=1)
+        assert state.sync_get_many([1, 2, 3]) == [1, None, MISS]
+    with freeze_time("2023-01-14 12:00:05"):
+        assert state.sync_get_many([1, 2]) == [MISS, MISS]
+
+
+@pytest.mark.asyncio
+async def test_async_get_many():
+    state = MemoryState(MAX_ENTRIES=2)
+    await state.async_set_many({1: 1, 2: 2, 3: 3})
+    assert await state.async_get_many([1, 2, 3]) == [MISS, 2, 3]
+    assert state.evictions == 1
+
+
+def test_clear_namespace_generation():
+    state = MemoryState()
+    state.sync_set_many({"ns1:a": 1, "ns1:b": 2, "ns2:a": 3, "plain": 4})
+    state.sync_clear_namespace("ns1")
+    assert state.sync_get_many(["ns1:a", "ns2:a", "plain"]) == [MISS, 3, 4]
+    # The older generation is dropped when read
+    assert "ns1:a" not in state._state
+    state.sync_set("ns1:a", 5)
+    assert state.sync_get_many(["ns1:a", "ns1:b"]) == [5, MISS]
+
+
+@pytest.mark.asyncio
+async def test_async_delete_and_clear_namespace():
+    state = MemoryState()
+    await state.async_set_many({"ns:a": 1, "ns:b": 2})
+    await state.async_delete("ns:a")
+    assert await state.async_get_many(["ns:a", "ns:b"]) == [MISS, 2]
+    await state.async_clear_namespace("ns")
+    assert await state.async_get("ns:b") is MISS
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = tmp_path / "memory.snapshot"
+    state = MemoryState(SNAPSHOT_PATH=str(path))
+    with freeze_time("2023-01-14 12:00:00"):
+        state.sync_set_many({"a": 1, "forever": [2]})
+        state.sync_set("short", 3, ttl=10)
+        state.sync_set("expired", 4, ttl=-1)
+        state.sync_set("ns:a", 5)
+        state.sync_clear_namespace("ns")
+        state.sync_set("unpicklable", lambda: None)
+        assert state.snapshot() == 3
+    with freeze_time("2023-01-14 12:00:04"):
+        loaded = MemoryState(SNAPSHOT_PATH=str(path))
+        assert loaded.sync_get_many(["a", "forever", "short", "expired", "ns:a"]) == [
+            1,
+            [2],
+            3,
+            MISS,
+            MISS,
+        ]
+        # The time since the snapshot is taken from the ttl
+        assert loaded._state["short"]["ttl"] == 6
+    with freeze_time("2023-01-14 12:00:11"):
+        assert MemoryState(SNAPSHOT_PATH=str(path)).sync_get("short") is MISS
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_snapshot_load_most_recently_used(tmp_path):
+    path = tmp_path / "memory.snapshot"
+    state = MemoryState(MAX_ENTRIES=10)
+    state.sync_set_many({key: key for key in range(5)})
+    state.sync_get(1)
+    state.sync_get(0)
+    state.snapshot(path=str(path))
+    loaded = MemoryState(
+        SNAPSHOT_PATH=str(path), SNAPSHOT_LOAD_MAX_ENTRIES=3, MAX_ENTRIES=2
+    )
+    assert set(loaded._state) == {0, 1}
+    # The most recently used is evicted last
+    loaded.sync_set(9, 9)
+    assert set(loaded._state) == {0, 9}
+
+
+def test_snapshot_keeps_recency_across_restarts(tmp_path):
+    path = tmp_path / "memory.snapshot"
+    state = MemoryState(SNAPSHOT_PATH=str(path))
+    state.sync_set_many({"a": 1, "b": 2, "c": 3, "d": 4})
+    state.close()
+    loaded = MemoryState(SNAPSHOT_PATH=str(path), SNAPSHOT_LOAD_MAX_ENTRIES=3)
+    assert list(loaded._state) == ["b", "c", "d"]
+    loaded.close()
+    loaded = MemoryState(SNAPSHOT_PATH=str(path), SNAPSHOT_LOAD_MAX_ENTRIES=2)
+    # The newest entries survive each restart, stored oldest first
+    assert list(loaded._state) == ["c", "d"]
+    loaded.close()
+    assert list(MemoryState(SNAPSHOT_PATH=str(path))._state) == ["c", "d"]
+
+
+def test_load_snapshot_budget(tmp_path):
+    path = tmp_path / "memory.snapshot"
+    state = MemoryState()
+    state.sync_set_many({key: key for key in range(5)})
+    state.snapshot(path=str(path))
+    assert MemoryState().load_snapshot(path=str(path), max_entries=2) == 2
+
+
+def test_load_snapshot_invalid_file(tmp_path):
+    path = tmp_path / "memory.snapshot"
+    path.write_bytes(b"not a snapshot")
+    with pytest.raises(ValueError):
+        MemoryState(SNAPSHOT_PATH=str(path))
+
+
+def test_periodic_snapshot_and_close(tmp_path):
+    path = tmp_path / "memory.snapshot"
+    state = MemoryState(SNAPSHOT_PATH=str(path), SNAPSHOT_INTERVAL=0.01)
+    state.sync_set("a", 1)
+    for _ in range(100):
+        if path.exists():
+            break
+        time.sleep(0.01)
+    assert MemoryState(SNAPSHOT_PATH=str(path)).sync_get("a") == 1
+    state.sync_set("b", 2)
+    state.close()
+    assert MemoryState(SNAPSHOT_PATH=str(path)).sync_get_many(["a", "b"]) == [1, 2]
@@ -1,10 +1,16 @@
+import asyncio
 import pickle
-from unittest.mock import patch, MagicMock, AsyncMock
+import time
+from contextlib import contextmanager
+from unittest.mock import patch, MagicMock, AsyncMock, call
 import pytest
 from redis.asyncio.client import Redis as AsyncRedis
 from redis.client import Redis as SyncRedis
+from redis.exceptions import ConnectionError
 
+from mr import MISS
 from mr.states import RedisState
+from mr.states.implementations import redis as redis_module
 
 
 def test_missing_config():
@@ -15,7 +21,9 @@ def test_missing_config():
 
 def test_sync_state():
     state = RedisState(REDIS_URL="redis://")
-    with patch.object(SyncRedis, "from_url", side_effect=[MagicMock(), MagicMock()]):
+    with patch.object(
+        redis_module, "SyncRedis", side_effect=[MagicMock(), MagicMock()]
+    ):
         with state._sync_state() as a1:
             with state._sync_state() as a2:
                 assert id(a1) == id(a2)
@@ -24,7 +32,9 @@ def test_sync_state():
 @pytest.mark.asyncio
 async def test_async_state():
     state = RedisState(REDIS_URL="redis://")
-    with patch.object(AsyncRedis, "from_url", side_effect=[AsyncMock(), AsyncMock()]):
+    with patch.object(
+        redis_module, "AsyncRedis", side_effect=[AsyncMock(), AsyncMock()]
+    ):
         async with state._async_state() as a1:
             async with state._async_state() as a2:
                 assert id(a1) == id(a2)
@@ -33,7 +43,7 @@ async def test_async_state():
 def test_sync_state_set():
     state = RedisState(REDIS_URL="redis://")
     mock_object = MagicMock()
-    with patch.object(SyncRedis, "from_url", return_value=mock_object):
+    with patch.object(redis_module, "SyncRedis", return_value=mock_object):
         state.sync_set(1, 10, 1)
         state.sync_set(1, 10, 1)
     assert mock_object.set.call_count == 2
@@ -44,7 +54,7 @@ def test_sync_state_set():
 async def test_async_state_set():
     state = RedisState(REDIS_URL="redis://")
     mock_object = AsyncMock()
-    with patch.object(AsyncRedis, "from_url", return_value=mock_object):
+    with patch.object(redis_module, "AsyncRedis", return_value=mock_object):
         await state.async_set(1, 10, 1)
         await state.async_set(1, 10, 1)
     assert mock_object.set.call_count == 2
@@ -54,7 +64,7 @@ async def test_async_state_set():
 def test_sync_set():
     state = RedisState(REDIS_URL="redis://")
     mock_object = MagicMock()
-    with patch.object(SyncRedis, "from_url", return_value=mock_object):
+    with patch.object(redis_module, "SyncRedis", return_value=mock_object):
         state.sync_set(1, 10, 1)
     mock_object.set.assert_called_once()
 
@@ -63,7 +73,7 @@ def test_sync_set():
 async def test_async_set():
     state = RedisState(REDIS_URL="redis://")
     mock_object = AsyncMock()
-    with patch.object(AsyncRedis, "from_url", return_value=mock_object):
+    with patch.object(redis_module, "AsyncRedis", return_value=mock_object):
         await state.async_set(1, 10, 1)
     mock_object.set.assert_called_once()
 
@@ -72,9 +82,9 @@ def test_sync_get_none():
     state = RedisState(REDIS_URL="redis://")
     mock_object = MagicMock()
     mock_object.get.return_value = None
-    with patch.object(SyncRedis, "from_url", return_value=mock_object):
+    with patch.object(redis_module, "SyncRedis", return_value=mock_object):
         value = state.sync_get(1)
-    assert value is None
+    assert value is MISS
     mock_object.get.assert_called_once()
 
 
@@ -83,9 +93,9 @@ async def test_async_get_none():
     state = RedisState(REDIS_URL="redis://")
     mock_object = AsyncMock()
     mock_object.get.return_value = None
-    with patch.object(AsyncRedis, "from_url", return_value=mock_object):
+    with patch.object(redis_module, "AsyncRedis", return_value=mock_object):
         value = await state.async_get(1)
-    assert value is None
+    assert value is MISS
     mock_object.get.assert_called_once()
 
 
@@ -93,7 +103,7 @@ def test_sync_get():
     state = RedisState(REDIS_URL="redis://")
     mock_object = MagicMock()
     mock_object.get.return_value = pickle.dumps(1)
-    with patch.object(SyncRedis, "from_url", return_value=mock_object):
+    with patch.object(redis_module, "SyncRedis", return_value=mock_object):
         value = state.sync_get(1)
     assert value == 1
     mock_object.get.assert_called_once()
@@ -104,7 +114,647 @@ async def test_async_get():
     state = RedisState(REDIS_URL="redis://")
     mock_object = AsyncMock()
     mock_object.get.return_value = pickle.dumps(1)
-    with patch.object(AsyncRedis, "from_url", return_value=mock_object):
+    with patch.object(redis_module, "AsyncRedis", return_value=mock_object):
         value = await state.async_get(1)
     assert value == 1
     mock_object.get.assert_called_once()
+
+
+def test_sync_get_falsy_value():
+    state = RedisState(REDIS_URL="redis://")
+    mock_object = MagicMock()
+    mock_object.get.return_value = pickle.dumps(None)
+    with patch.object(redis_module, "SyncRedis", return_value=mock_object):
+        value = state.sync_get(1)
+    assert value is None
+
+
+def test_sync_get_many():
+    state = RedisState(REDIS_URL="redis://")
+    mock_object = MagicMock()
+    mock_object.mget.return_value = [pickle.dumps(1), None]
+    with patch.object(redis_module, "SyncRedis", return_value=mock_object):
+        values = state.sync_get_many([1, 2])
+    assert values == [1, MISS]
+    mock_object.mget.assert_called_once_with([1, 2])
+
+
+@pytest.mark.asyncio
+async def test_async_get_many():
+    state = RedisState(REDIS_URL="redis://")
+    mock_object = AsyncMock()
+    mock_object.mget.return_value = [None, pickle.dumps(2)]
+    with patch.object(redis_module, "AsyncRedis", return_value=mock_object):
+        values = await state.async_get_many([1, 2])
+    assert values == [MISS, 2]
+    mock_object.mget.assert_called_once_with([1, 2])
+
+
+def test_sync_set_many():
+    state = RedisState(REDIS_URL="redis://")
+    mock_object = MagicMock()
+    with patch.object(redis_module, "SyncRedis", return_value=mock_object):
+        state.sync_set_many({1: 10, 2: 20}, 1)
+    pipeline = mock_object.pipeline.return_value
+    assert pipeline.set.call_count == 2
+    assert pipeline.set.call_args.kwargs == {"ex": 1, "nx": True}
+    pipeline.execute.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_async_set_many():
+    state = RedisState(REDIS_URL="redis://")
+    mock_object = MagicMock()
+    mock_object.pipeline.return_value.execute = AsyncMock()
+    with patch.object(redis_module, "AsyncRedis", return_value=mock_object):
+        await state.async_set_many({1: 10, 2: 20}, 1)
+    pipeline = mock_object.pipeline.return_value
+    assert pipeline.set.call_count == 2
+    pipeline.execute.assert_awaited_once()
+
+
+def test_pool_kwargs():
+    state = RedisState(
+        REDIS_URL="redis://",
+        MAX_CONNECTIONS=2,
+        POOL_TIMEOUT=0.01,
+        SOCKET_TIMEOUT=1,
+        SOCKET_KEEPALIVE=True,
+    )
+    with state._sync_state() as client:
+        pool = client.connection_pool
+    assert isinstance(pool, redis_module._SyncPool)
+    assert pool.max_connections == 2
+    assert pool.timeout == 0.01
+    assert pool.connection_kwargs["socket_timeout"] == 1
+    assert pool.connection_kwargs["socket_keepalive"] is True
+
+
+def test_sync_pool_stats():
+    state = RedisState(REDIS_URL="redis://", MAX_CONNECTIONS=1, POOL_TIMEOUT=0.01)
+    with state._sync_state() as client:
+        pool = client.connection_pool
+    connection = MagicMock()
+    connection.can_read.return_value = False
+    with patch.object(pool, "make_connection", return_value=connection):
+        acquired = pool.get_connection("GET")
+        with pytest.raises(ConnectionError):
+            pool.get_connection("GET")
+        stats = state.pool_stats["sync"]
+        assert stats["in_use"] == 1
+        assert stats["saturation"] == 1
+        assert stats["acquired"] == 1
+        assert stats["timeouts"] == 1
+        assert stats["max_wait_time"] >= 0.01
+        pool.release(acquired)
+    stats = state.pool_stats["sync"]
+    assert stats["in_use"] == 0
+    assert stats["peak_in_use"] == 1
+
+
+def test_sync_pool_stats_connect_error():
+    state = RedisState(REDIS_URL="redis://", MAX_CONNECTIONS=1)
+    with state._sync_state() as client:
+        pool = client.connection_pool
+    connection = MagicMock()
+    connection.connect.side_effect = OSError
+    with patch.object(pool, "make_connection", return_value=connection):
+        with pytest.raises(OSError):
+            pool.get_connection("GET")
+    assert state.pool_stats["sync"]["in_use"] == 0
+    assert state.pool_stats["sync"]["timeouts"] == 1
+
+
+def test_async_state_by_event_loop():
+    state = RedisState(REDIS_URL="redis://")
+
+    async def get_client():
+        async with state._async_state() as client:
+            async with state._async_state() as same_client:
+                assert client is same_client
+            return client
+
+    client_a = asyncio.run(get_client())
+    client_b = asyncio.run(get_client())
+    assert client_a is not client_b
+    assert isinstance(client_a.connection_pool, redis_module._AsyncPool)
+
+
+@pytest.mark.asyncio
+async def test_async_pool_stats():
+    state = RedisState(REDIS_URL="redis://", MAX_CONNECTIONS=2)
+    async with state._async_state() as client:
+        pool = client.connection_pool
+    connection = AsyncMock()
+    connection.can_read_destructive.return_value = False
+    with patch.object(pool, "make_connection", return_value=connection):
+        acquired = await pool.get_connection("GET")
+        assert state.pool_stats["async"]["in_use"] == 1
+        assert state.pool_stats["async"]["saturation"] == 0.5
+        await pool.release(acquired)
+    assert state.pool_stats["async"]["in_use"] == 0
+
+
+@pytest.fixture()
+def fake_server():
+    fakeredis = pytest.importorskip("fakeredis")
+    return fakeredis.FakeServer()
+
+
+def near_cache_state(fake_server, **kwargs) -> RedisState:
+    fakeredis = pytest.importorskip("fakeredis")
+    return RedisState(
+        REDIS_URL="redis://",
+        NEAR_CACHE=True,
+        CONNECTION_KWARGS={
+            "connection_class": fakeredis.FakeConnection,
+            "server": fake_server,
+        },
+        **kwargs,
+    )
+
+
+def wait_for(condition):
+    for _ in range(200):
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def wait_for_invalidations(state: RedisState, count: int) -> bool:
+    """
+    Wait for the invalidations of the state own writes, or one arriving during
+    the next fetch of the key keeps the fetched value out of the near-cache
+    """
+    return wait_for(lambda: state._near_epoch >= count)
+
+
+def test_near_cache_hit(fake_server):
+    state = near_cache_state(fake_server)
+    state.sync_set("key", None, 10)
+    assert wait_for_invalidations(state, 1)
+    assert state.sync_get("key") is None
+    with patch.object(state, "_sync_state") as sync_state:
+        assert state.sync_get("key") is None
+        assert state.sync_get_many(["key"]) == [None]
+    sync_state.assert_not_called()
+    state.close()
+
+
+def test_near_cache_miss(fake_server):
+    state = near_cache_state(fake_server)
+    assert state.sync_get("key") is MISS
+    assert state.sync_get_many(["key", "other"]) == [MISS, MISS]
+    assert state._near._state == {}
+    state.close()
+
+
+def test_near_cache_ttl_capped_by_redis_ttl(fake_server):
+    state = near_cache_state(fake_server, NEAR_CACHE_TTL=100)
+    state.sync_set("key", 1, 10)
+    state.sync_set("forever", 2)
+    assert wait_for_invalidations(state, 2)
+    state.sync_get_many(["key", "forever"])
+    assert 9 < state._near._state["key"]["ttl"] <= 10
+    assert state._near._state["forever"]["ttl"] == 100
+    state.close()
+
+
+def test_near_cache_invalidation(fake_server):
+    state = near_cache_state(fake_server)
+    other = near_cache_state(fake_server)
+    state.sync_set("key", 1, 10)
+    assert other.sync_get("key") == 1
+    assert "key" in other._near._state
+    state.sync_set_many({"key": 2}, 10)
+    assert wait_for(lambda: "key" not in other._near._state)
+    with state._sync_state() as client:
+        client.publish("mr:invalidate", RedisState.INVALIDATE_ALL)
+    other.sync_get("key")
+    assert wait_for(lambda: other._near._state == {})
+    state.close()
+    other.close()
+
+
+def test_near_cache_skips_invalidated_fetch(fake_server):
+    state = near_cache_state(fake_server)
+    state._near_cache()
+    with state._near_reading(["key", "other"]) as epoch:
+        state._on_invalidation({"data": b"key"})
+        assert state._near_set("key", pickle.dumps(1), -1, epoch) == 1
+        # Invalidations of other keys don't drop the fetch
+        assert state._near_set("other", pickle.dumps(2), -1, epoch) == 2
+    assert set(state._near._state) == {"other"}
+    assert state._near_reads == {} and state._near_invalidated == {}
+    state.close()
+
+
+def test_near_cache_clear_skips_every_fetch(fake_server):
+    state = near_cache_state(fake_server)
+    state._near_cache()
+    with state._near_reading(["key"]) as epoch:
+        state._on_invalidation({"data": RedisState.INVALIDATE_ALL.encode()})
+        state._near_set("key", pickle.dumps(1), -1, epoch)
+    with state._near_reading(["key"]) as epoch:
+        state._near_set("key", pickle.dumps(1), -1, epoch)
+    assert set(state._near._state) == {"key"}
+    state.close()
+
+
+def test_near_cache_kept_under_unrelated_writes(fake_server):
+    state = near_cache_state(fake_server)
+    other = near_cache_state(fake_server)
+    state.sync_set("key", 1, 10)
+    assert wait_for_invalidations(state, 1)
+    fetch = state._sync_state
+
+    @contextmanager
+    def fetch_during_writes():
+        # Other keys are written and invalidated while "key" is fetched
+        other.sync_set_many({"a": 1, "b": 2}, 10)
+        assert wait_for_invalidations(state, 3)
+        with fetch() as client:
+            yield client
+
+    with patch.object(state, "_sync_state", fetch_during_writes):
+        assert state.sync_get("key") == 1
+    assert "key" in state._near._state
+    state.close()
+    other.close()
+
+
+def test_near_cache_listener_error(fake_server):
+    state = near_cache_state(fake_server)
+    state._near.sync_set("key", 1)
+    with patch.object(redis_module.time, "sleep") as sleep:
+        state._on_listener_error(ConnectionError(), None, None)
+    sleep.assert_called_once()
+    assert state._near._state == {}
+
+
+@pytest.mark.asyncio
+async def test_async_near_cache(fake_server):
+    from fakeredis.aioredis import FakeConnection
+
+    state = near_cache_state(fake_server)
+    state._near_cache()
+    state._pool_kwargs["connection_class"] = FakeConnection
+    await state.async_set("key", 1, 10)
+    await state.async_set_many({"other": 2}, 10)
+    assert wait_for_invalidations(state, 2)
+    assert await state.async_get("key") == 1
+    assert await state.async_get_many(["key", "other", "missing"]) == [1, 2, MISS]
+    with patch.object(state, "_async_state") as async_state:
+        assert await state.async_get("other") == 2
+    async_state.assert_not_called()
+    state.close()
+
+
+def test_serializer():
+    state = RedisState(REDIS_URL="redis://", SERIALIZER="json", COMPRESSION="zlib")
+    mock_object = MagicMock()
+    with patch.object(redis_module, "SyncRedis", return_value=mock_object):
+        state.sync_set("key", ["value"] * 1000, 1)
+        stored = mock_object.set.call_args.args[1]
+        assert stored[:1] == b"Z"
+        mock_object.get.return_value = stored
+        assert state.sync_get("key") == ["value"] * 1000
+        mock_object.get.return_value = pickle.dumps(1)
+        assert state.sync_get("key") == 1
+
+
+def test_sync_set_namespace_index():
+    state = RedisState(REDIS_URL="redis://")
+    mock_object = MagicMock()
+    with patch.object(redis_module, "SyncRedis", return_value=mock_object):
+        with patch.object(redis_module.time, "time", return_value=100.0):
+            state.sync_set("ns:a", 10, 5)
+    mock_object.set.assert_not_called()
+    pipeline = mock_object.pipeline.return_value
+    assert pipeline.set.call_args.kwargs == {"ex": 5, "nx": True}
+    pipeline.eval.assert_called_once_with(
+        redis_module.INDEX, 1, "mr:ns:ns", 105.0, 5000, "ns:a"
+    )
+    pipeline.zremrangebyscore.assert_not_called()
+    pipeline.execute.assert_called_once()
+
+
+def test_namespace_index_trimmed_every_n_writes():
+    state = RedisState(REDIS_URL="redis://", NAMESPACE_INDEX_TRIM_EVERY=2)
+    mock_object = MagicMock()
+    with patch.object(redis_module, "SyncRedis", return_value=mock_object):
+        with patch.object(redis_module.time, "time", return_value=100.0):
+            state.sync_set("plain", 10, 5)
+            state.sync_set("ns:a", 10, 5)
+            pipeline = mock_object.pipeline.return_value
+            pipeline.zremrangebyscore.assert_not_called()
+            state.sync_set_many({"ns:b": 10, "other:c": 10}, 5)
+    assert sorted(pipeline.zremrangebyscore.call_args_list) == [
+        call("mr:ns:ns", "-inf", "(100.0"),
+        call("mr:ns:other", "-inf", "(100.0"),
+    ]
+
+
+def redis_state(fake_server, **kwargs) -> RedisState:
+    fakeredis = pytest.importorskip("fakeredis")
+    return RedisState(
+        REDIS_URL="redis://",
+        CONNECTION_KWARGS={
+            "connection_class": fakeredis.FakeConnection,
+            "server": fake_server,
+        },
+        **kwargs,
+    )
+
+
+def test_namespace_index_expires_with_its_last_key(fake_server):
+    state = redis_state(fake_server)
+    state.sync_set_many({"ns:a": 1, "ns:b": 2}, 100)
+    with state._sync_state() as client:
+        assert client.zrange("mr:ns:ns", 0, -1) == [b"ns:a", b"ns:b"]
+        assert 99_000 < client.pttl("mr:ns:ns") <= 100_000
+        state.sync_set("ns:c", 3, 10)
+        assert client.pttl("mr:ns:ns") > 10_000
+        state.sync_set("ns:d", 4, 1000)
+        assert client.pttl("mr:ns:ns") > 100_000
+        state.sync_set("ns:e", 5)
+        assert client.pttl("mr:ns:ns") == -1
+        state.sync_set("ns:f", 6, 10)
+        assert client.pttl("mr:ns:ns") == -1
+
+
+@pytest.mark.parametrize("namespace_index", [True, False])
+def test_clear_namespace(fake_server, namespace_index):
+    state = redis_state(fake_server, NAMESPACE_INDEX=namespace_index)
+    state.sync_set_many({"n[s]*:a": 1, "n[s]*:b": 2, "ns:a": 3, "plain": 4}, 100)
+    state.sync_set("n[s]*:c", 5)
+    with state._sync_state() as client:
+        assert client.exists("mr:ns:n[s]*") == int(namespace_index)
+    state.sync_clear_namespace("n[s]*")
+    assert state.sync_get_many(["n[s]*:a", "n[s]*:b", "n[s]*:c", "ns:a", "plain"]) == [
+        MISS,
+        MISS,
+        MISS,
+        3,
+        4,
+    ]
+
+
+@pytest.mark.asyncio
+async def test_async_clear_namespace_without_index(fake_server):
+    from fakeredis.aioredis import FakeConnection
+
+    state = redis_state(fake_server, NAMESPACE_INDEX=False)
+    state._pool_kwargs["connection_class"] = FakeConnection
+    await state.async_set_many({"ns:a": 1, "ns:b": 2, "other:a": 3}, 100)
+    with patch.object(redis_module, "CLEAR_BATCH", 1):
+        await state.async_clear_namespace("ns")
+    assert await state.async_get_many(["ns:a", "ns:b", "other:a"]) == [MISS, MISS, 3]
+
+
+def test_sync_delete():
+    state = RedisState(REDIS_URL="redis://")
+    mock_object = MagicMock()
+    with patch.object(redis_module, "SyncRedis", return_value=mock_object):
+        state.sync_delete("ns:a")
+    pipeline = mock_object.pipeline.return_value
+    pipeline.unlink.assert_called_once_with("ns:a")
+    pipeline.zrem.assert_called_once_with("mr:ns:ns", "ns:a")
+
+
+def test_sync_clear_namespace():
+    state = RedisState(REDIS_URL="redis://", NAMESPACE_INDEX_PREFIX="idx:")
+    mock_object = MagicMock()
+    mock_object.zrange.side_effect = [[b"ns:a", b"ns:b"], []]
+    with patch.object(redis_module, "SyncRedis", return_value=mock_object):
+        state.sync_clear_namespace("ns")
+    mock_object.zrange.assert_called_with("idx:ns", 0, redis_module.CLEAR_BATCH - 1)
+    mock_object.zremrangebyscore.assert_called_once()
+    pipeline = mock_object.pipeline.return_value
+    pipeline.unlink.assert_called_once_with("ns:a", "ns:b")
+    assert pipeline.zrem.call_count == 2
+    pipeline.execute.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_async_clear_namespace():
+    state = RedisState(REDIS_URL="redis://")
+    mock_object = MagicMock()
+    mock_object.zrange = AsyncMock(side_effect=[["ns:a"], []])
+    mock_object.zremrangebyscore = AsyncMock()
+    mock_object.pipeline.return_value.execute = AsyncMock()
+    with patch.object(redis_module, "AsyncRedis", return_value=mock_object):
+        await state.async_clear_namespace("ns")
+        await state.async_delete("ns:b")
+    pipeline = mock_object.pipeline.return_value
+    assert pipeline.unlink.call_args_list == [call("ns:a"), call("ns:b")]
+    assert pipeline.execute.await_count == 2
+
+
+def _scripts(mock_object, *statuses):
+    lock_or_get, release = MagicMock(side_effect=list(statuses)), MagicMock()
+    mock_object.register_script.side_effect = lambda script: (
+        lock_or_get if script == redis_module.LOCK_OR_GET else release
+    )
+    return lock_or_get, release
+
+
+def test_sync_lock_lease():
+    state = RedisState(REDIS_URL="redis://", LOCK_LEASE=2)
+    mock_object = MagicMock()
+    lock_or_get, release = _scripts(mock_object, [b"l"])
+    with patch.object(redis_module, "SyncRedis", return_value=mock_object):
+        with state.sync_lock("key") as value:
+            assert value is MISS
+            release.assert_not_called()
+    keys, (token, lease) = (
+        lock_or_get.call_args.kwargs["keys"],
+        lock_or_get.call_args.kwargs["args"],
+    )
+    assert keys == ["key", "mr:lock:{key}"]
+    assert lease == 2000
+    release.assert_called_once_with(keys=["mr:lock:{key}"], args=[token])
+
+
+@pytest.mark.parametrize("key", ["ns:0123abcd", "{user:1}:profile", "x{y"])
+def test_lease_key_in_the_key_slot(key):
+    from redis.crc import key_slot
+
+    lease_key = RedisState(REDIS_URL="redis://")._lease_key(key)
+    assert lease_key.startswith("mr:lock:")
+    assert key_slot(lease_key.encode()) == key_slot(key.encode())
+
+
+def test_sync_lock_lease_renewed(fake_server):
+    holder = redis_state(fake_server, LOCK_LEASE=0.15)
+    other = redis_state(fake_server, LOCK_LEASE=0.15)
+    lease_key = holder._lease_key("key")
+    with holder.sync_lock("key") as value:
+        assert value is MISS
+        # Computing for longer than the lease keeps it
+        time.sleep(0.4)
+        with other._sync_state() as client:
+            assert client.exists(lease_key)
+        holder.sync_set("key", 1)
+    with other.sync_lock("key") as value:
+        assert value == 1
+    with other._sync_state() as client:
+        assert not client.exists(lease_key)
+
+
+@pytest.mark.asyncio
+async def test_async_lock_lease_renewed(fake_server):
+    from fakeredis.aioredis import FakeConnection
+
+    holder = redis_state(fake_server, LOCK_LEASE=0.15)
+    holder._pool_kwargs["connection_class"] = FakeConnection
+    lease_key = holder._lease_key("key")
+    async with holder.async_lock("key") as value:
+        assert value is MISS
+        await asyncio.sleep(0.4)
+        async with holder._async_state() as client:
+            assert await client.exists(lease_key)
+    async with holder._async_state() as client:
+        assert not await client.exists(lease_key)
+
+
+def test_sync_lock_release_on_error():
+    state = RedisState(REDIS_URL="redis://")
+    mock_object = MagicMock()
+    _, release = _scripts(mock_object, [b"l"])
+    with patch.object(redis_module, "SyncRedis", return_value=mock_object):
+        with pytest.raises(ValueError):
+            with state.sync_lock("key"):
+                raise ValueError()
+    release.assert_called_once()
+
+
+def test_sync_lock_waits_for_value():
+    state = RedisState(REDIS_URL="redis://", LOCK_POLL_INTERVAL=0.01)
+    mock_object = MagicMock()
+    _, release = _scripts(
+        mock_object, [b"w", 5000], [b"w", 3], [b"v", pickle.dumps(10)]
+    )
+    with patch.object(redis_module, "SyncRedis", return_value=mock_object):
+        with patch.object(redis_module.time, "sleep") as sleep:
+            with state.sync_lock("key") as value:
+                assert value == 10
+    first, second = (sleep_call.args[0] for sleep_call in sleep.call_args_list)
+    assert 0.005 <= first <= 0.01
+    # Never past the end of the lease
+    assert second <= 0.003
+    release.assert_not_called()
+
+
+def test_sync_lock_takes_over_expired_lease():
+    state = RedisState(REDIS_URL="redis://")
+    mock_object = MagicMock()
+    _, release = _scripts(mock_object, [b"w", 1], [b"l"])
+    with patch.object(redis_module, "SyncRedis", return_value=mock_object):
+        with patch.object(redis_module.time, "sleep"):
+            with state.sync_lock("key") as value:
+                assert value is MISS
+    release.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_async_lock():
+    state = RedisState(REDIS_URL="redis://")
+    mock_object = MagicMock()
+    lock_or_get, release = AsyncMock(side_effect=[[b"w", 1], [b"l"]]), AsyncMock()
+    mock_object.register_script.side_effect = lambda script: (
+        lock_or_get if script == redis_module.LOCK_OR_GET else release
+    )
+    with patch.object(redis_module, "AsyncRedis", return_value=mock_object):
+        async with state.async_lock("key") as value:
+            assert value is MISS
+        release.assert_awaited_once()
+        lock_or_get.side_effect = [[b"v", pickle.dumps(None)]]
+        async with state.async_lock("key") as value:
+            assert value is None
+    assert release.await_count == 1
+
+
+def _batched_state(**kwargs) -> RedisState:
+    return RedisState(REDIS_URL="redis://", GET_BATCH=True, **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_async_get_batch():
+    mock_object = AsyncMock()
+    mock_object.mget.return_value = [pickle.dumps(1), None]
+    state = _batched_state()
+    with patch.object(redis_module, "AsyncRedis", return_value=mock_object):
+        values = await asyncio.gather(
+            state.async_get("a"), state.async_get("b"), state.async_get("a")
+        )
+    assert values == [1, MISS, 1]
+    mock_object.mget.assert_awaited_once_with(["a", "b"])
+    mock_object.get.assert_not_called()
+    assert state.get_batch_stats == {"gets": 3, "batches": 1}
+
+
+@pytest.mark.asyncio
+async def test_async_get_batch_window():
+    mock_object = AsyncMock()
+    mock_object.mget.return_value = [pickle.dumps(1), pickle.dumps(2)]
+    state = _batched_state(GET_BATCH_WINDOW=0.01)
+
+    async def later_get(key: str):
+        await asyncio.sleep(0)
+        return await state.async_get(key)
+
+    with patch.object(redis_module, "AsyncRedis", return_value=mock_object):
+        values = await asyncio.gather(state.async_get("a"), later_get("b"))
+    assert values == [1, 2]
+    mock_object.mget.assert_awaited_once_with(["a", "b"])
+
+
+@pytest.mark.asyncio
+async def test_async_get_batch_max_keys():
+    mock_object = AsyncMock()
+    mock_object.mget.side_effect = lambda keys: [pickle.dumps(key) for key in keys]
+    state = _batched_state(GET_BATCH_MAX_KEYS=2)
+    with patch.object(redis_module, "AsyncRedis", return_value=mock_object):
+        values = await asyncio.gather(*[state.async_get(key) for key in "abc"])
+    assert values == ["a", "b", "c"]
+    assert mock_object.mget.await_args_list == [call(["a", "b"]), call(["c"])]
+
+
+@pytest.mark.asyncio
+async def test_async_get_batch_error():
+    mock_object = AsyncMock()
+    mock_object.mget.side_effect = ConnectionError()
+    state = _batched_state()
+    with patch.object(redis_module, "AsyncRedis", return_value=mock_object):
+        results = await asyncio.gather(
+            state.async_get("a"), state.async_get("b"), return_exceptions=True
+        )
+    assert all(isinstance(result, ConnectionError) for result in results)
+
+
+@pytest.mark.asyncio
+async def test_get_many_with_ttl(fake_server):
+    from fakeredis.aioredis import FakeConnection
+
+    state = near_cache_state(fake_server)
+    state.sync_set_many({"key": 1}, 10)
+    state.sync_set("forever", 2)
+    values = state.sync_get_many_with_ttl(["key", "forever", "missing"])
+    assert [value for value, _ in values] == [1, 2, MISS]
+    assert 9 < values[0][1] <= 10 and values[1][1] is None and values[2][1] is None
+    state._pool_kwargs["connection_class"] = FakeConnection
+    assert (await state.async_get_many_with_ttl(["forever"])) == [(2, None)]
+    state.close()
+
+
+def test_sync_replace(fake_server):
+    state = near_cache_state(fake_server)
+    state.sync_set("key", 1, 10)
+    state.sync_set("key", 2, 10)
+    assert wait_for_invalidations(state, 2)
+    assert state.sync_get("key") == 1
+    state.sync_replace("key", 3, 10)
+    assert wait_for(lambda: state.sync_get("key") == 3)
+    state.close()
@@ -0,0 +1,237 @@
+import multiprocessing
+import uuid
+from inspect import _empty
+
+import pytest
+from freezegun import freeze_time
+
+from mr import MISS
+from mr.states import SharedMemoryState
+from mr.states.implementations import shared_memory as shared_memory_module
+from mr.states.implementations.shared_memory import SEQUENCE
+
+
+@pytest.fixture()
+def name():
+    return f"mr-test-{uuid.uuid4().hex[:12]}"
+
+
+@pytest.fixture()
+def state(name):
+    state = SharedMemoryState(NAME=name, SLOTS=64, SLOT_SIZE=256)
+    yield state
+    state.unlink()
+
+
+def test_wrong_config(name):
+    with pytest.raises(ValueError) as exception:
+        SharedMemoryState(NAME=name, SLOTS=10, WAYS=4)
+    assert (
+        exception.value.args[0] == "The config value SLOTS must be a multiple of WAYS"
+    )
+
+
+def test_layout_mismatch(state, name):
+    with pytest.raises(TypeError) as exception:
+        SharedMemoryState(NAME=name, SLOTS=64, SLOT_SIZE=512)
+    assert (
+        exception.value.args[0]
+        == f"The config value NAME {name} is already used with another layout"
+    )
+
+
+def test_sync_set_get(state):
+    state.sync_set(1, {"a": 1}, 10)
+    assert state.sync_get(1) == {"a": 1}
+    assert state.sync_get(2) is MISS
+
+
+@pytest.mark.parametrize("value", [None, 0, "", [], False, b""])
+def test_sync_get_falsy_value(state, value):
+    state.sync_set(1, value)
+    assert state.sync_get(1) is not MISS
+    assert state.sync_get(1) == value
+
+
+def test_sync_get_expired_ttl(state):
+    with freeze_time("2023-01-14 12:00:00"):
+        state.sync_set(1, 10, 1)
+        state.sync_set(2, 20, _empty)
+    with freeze_time("2023-01-14 12:00:01"):
+        assert state.sync_get(1) == 10
+    with freeze_time("2023-01-14 12:00:02"):
+        assert state.sync_get_many([1, 2]) == [MISS, 20]
+
+
+def test_overwrite(state):
+    state.sync_set(1, "first")
+    state.sync_set(1, "second")
+    assert state.sync_get(1) == "second"
+
+
+def test_bytes_are_stored_raw(state):
+    state.sync_set(1, b"raw")
+    state.sync_set(2, memoryview(b"view"))
+    assert state.sync_get(1) == b"raw"
+    assert isinstance(state.sync_get(1), bytes)
+    assert state.sync_get(2) == b"view"
+    assert isinstance(state.sync_get(2), bytes)
+
+
+def test_bytearray_keeps_its_type(name):
+    state = SharedMemoryState(NAME=name, SLOTS=4, SLOT_SIZE=64, ZERO_COPY=True)
+    state.sync_set(1, bytearray(b"raw"))
+    value = state.sync_get(1)
+    assert value == bytearray(b"raw")
+    assert isinstance(value, bytearray)
+    value[0] = ord("R")
+    assert state.sync_get(1) == b"raw"
+    state.unlink()
+
+
+def test_zero_copy(name):
+    state = SharedMemoryState(NAME=name, SLOTS=4, SLOT_SIZE=64, ZERO_COPY=True)
+    state.sync_set(1, b"raw")
+    state.sync_set(2, ["not", "raw"])
+    value = state.sync_get(1)
+    assert isinstance(value, memoryview)
+    assert value.readonly
+    assert value == b"raw"
+    assert state.sync_get(2) == ["not", "raw"]
+    value.release()
+    state.unlink()
+
+
+def test_oversized_values_are_not_stored(state):
+    state.sync_set(1, b"x" * 257)
+    assert state.sync_get(1) is MISS
+    assert state.oversized == 1
+
+
+def test_oldest_slot_is_replaced(name):
+    state = SharedMemoryState(NAME=name, SLOTS=2, WAYS=2, SLOT_SIZE=64)
+    with freeze_time("2023-01-14 12:00:00"):
+        state.sync_set(1, 1)
+    with freeze_time("2023-01-14 12:00:01"):
+        state.sync_set(2, 2)
+        state.sync_set(3, 3)
+    assert state.sync_get_many([1, 2, 3]) == [MISS, 2, 3]
+    state.unlink()
+
+
+def test_expired_slot_is_replaced_first(name):
+    state = SharedMemoryState(NAME=name, SLOTS=2, WAYS=2, SLOT_SIZE=64)
+    with freeze_time("2023-01-14 12:00:00"):
+        state.sync_set(1, 1)
+        state.sync_set(2, 2, 1)
+    with freeze_time("2023-01-14 12:00:05"):
+        state.sync_set(3, 3)
+        assert state.sync_get_many([1, 2, 3]) == [1, MISS, 3]
+    state.unlink()
+
+
+def test_write_in_progress_is_a_miss(state):
+    state.sync_set(1, "value")
+    offset = next(
+        state._offset(slot)
+        for slot in range(state._slots)
+        if state._read(state._offset(slot), state._digest(1), 0) is not MISS
+    )
+    (sequence,) = SEQUENCE.unpack_from(state._buffer, offset)
+    SEQUENCE.pack_into(state._buffer, offset, sequence + 1)
+    assert state.sync_get(1) is MISS
+    SEQUENCE.pack_into(state._buffer, offset, sequence + 2)
+    assert state.sync_get(1) == "value"
+
+
+def test_torn_read_is_retried(state, monkeypatch):
+    state.sync_set(1, "value")
+    real_unpack = SEQUENCE.unpack_from
+    calls = []
+
+    class Sequence:
+        @staticmethod
+        def unpack_from(buffer, offset):
+            calls.append(offset)
+            (sequence,) = real_unpack(buffer, offset)
+            # A writer finished between the two sequence reads the first time
+            return (sequence + 2,) if len(calls) == 1 else (sequence,)
+
+    monkeypatch.setattr(shared_memory_module, "SEQUENCE", Sequence)
+    assert state.sync_get(1) == "value"
+    assert len(calls) == 2
+
+
+def test_delete_and_clear(state):
+    state.sync_set_many({1: 1, 2: 2, 3: 3})
+    state.sync_delete(1)
+    assert state.sync_get_many([1, 2]) == [MISS, 2]
+    state.sync_clear()
+    assert state.sync_get_many([2, 3]) == [MISS, MISS]
+
+
+def test_clear_namespace(state, name):
+    other = SharedMemoryState(NAME=name, SLOTS=64, SLOT_SIZE=256)
+    state.sync_set_many({"ns1:a": 1, "ns1:b": 2, "ns2:a": 3, "plain": 4})
+    other.sync_clear_namespace("ns1")
+    assert state.sync_get_many(["ns1:a", "ns1:b", "ns2:a", "plain"]) == [
+        MISS,
+        MISS,
+        3,
+        4,
+    ]
+    state.sync_set("ns1:a", 5)
+    assert other.sync_get("ns1:a") == 5
+    other.close()
+
+
+def test_cleared_slot_is_replaced_first(name):
+    state = SharedMemoryState(NAME=name, SLOTS=2, WAYS=2, SLOT_SIZE=64)
+    with freeze_time("2023-01-14 12:00:00"):
+        state.sync_set("old", 1)
+    with freeze_time("2023-01-14 12:00:01"):
+        state.sync_set("ns:a", 2)
+    state.sync_clear_namespace("ns")
+    state.sync_set("new", 3)
+    assert state.sync_get_many(["old", "new"]) == [1, 3]
+    state.unlink()
+
+
+@pytest.mark.asyncio
+async def test_async(state):
+    await state.async_set(1, 10)
+    await state.async_set_many({2: 20}, ttl=10)
+    assert await state.async_get(1) == 10
+    assert await state.async_get_many([1, 2, 3]) == [10, 20, MISS]
+
+
+def _write(name, index):
+    state = SharedMemoryState(NAME=name, SLOTS=64, SLOT_SIZE=256)
+    state.sync_set_many({f"{index}-{key}": key for key in range(8)})
+    state.close()
+
+
+def test_processes_share_the_memory(state, name):
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(target=_write, args=(name, index)) for index in range(4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert all(process.exitcode == 0 for process in processes)
+    keys = [f"{index}-{key}" for index in range(4) for key in range(8)]
+    values = state.sync_get_many(keys)
+    # 32 keys on 64 slots of 4 ways, a full bucket may evict some
+    assert sum(value is not MISS for value in values) >= 24
+    assert all(value in (MISS, key % 8) for key, value in enumerate(values))
+
+
+def test_attach_after_close(name):
+    state = SharedMemoryState(NAME=name, SLOTS=4, SLOT_SIZE=64)
+    state.sync_set(1, "value")
+    state.close()
+    other = SharedMemoryState(NAME=name, SLOTS=4, SLOT_SIZE=64)
+    assert other.sync_get(1) == "value"
+    other.unlink()
@@ -0,0 +1,248 @@
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import threading
+from inspect import _empty
+
+import pytest
+from freezegun import freeze_time
+
+from mr import MISS
+from mr.states import SQLiteState
+
+
+@pytest.fixture()
+def state(tmp_path):
+    state = SQLiteState(PATH=tmp_path / "cache.sqlite3")
+    yield state
+    state.close()
+
+
+def test_wrong_config(tmp_path):
+    with pytest.raises(TypeError) as exception:
+        SQLiteState(PATH=tmp_path / "missing" / "cache.sqlite3")
+    assert (
+        exception.value.args[0] == "The config value PATH is not a valid database path"
+    )
+
+
+def test_default_path_is_private(tmp_path, monkeypatch):
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    state = SQLiteState()
+    directory = state._path.parent
+    assert directory.parent == tmp_path
+    assert directory.stat().st_mode & 0o777 == 0o700
+    state.sync_set(1, "value")
+    state.close()
+    assert SQLiteState().sync_get(1) == "value"
+
+
+def test_default_path_shared_directory(tmp_path, monkeypatch):
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    directory = tmp_path / f"my-mimic-{os.getuid()}"
+    directory.mkdir()
+    directory.chmod(0o777)
+    with pytest.raises(TypeError) as exception:
+        SQLiteState()
+    assert exception.value.args[0] == (
+        f"The default PATH directory {directory} is not private to the user,"
+        " set the config value PATH"
+    )
+
+
+def test_wal_mode(state):
+    assert state._connection().execute("PRAGMA journal_mode").fetchone() == ("wal",)
+
+
+def test_expires_at_index(state):
+    plan = state._connection().execute(
+        "EXPLAIN QUERY PLAN DELETE FROM mr_cache WHERE expires_at < 1"
+    )
+    assert "mr_cache_expires_at" in " ".join(str(row) for row in plan)
+
+
+def test_sync_set_get(state):
+    state.sync_set(1, {"a": 1}, 10)
+    assert state.sync_get(1) == {"a": 1}
+    assert state.sync_get(2) is MISS
+
+
+@pytest.mark.parametrize("value", [None, 0, "", [], False])
+def test_sync_get_falsy_value(state, value):
+    state.sync_set(1, value)
+    assert state.sync_get(1) is not MISS
+    assert state.sync_get(1) == value
+
+
+def test_sync_get_expired_ttl(state):
+    with freeze_time("2023-01-14 12:00:00"):
+        state.sync_set(1, 10, 1)
+        state.sync_set(2, 20, _empty)
+        state.sync_set(3, 30, None)
+    with freeze_time("2023-01-14 12:00:01"):
+        assert state.sync_get(1) == 10
+    with freeze_time("2023-01-14 12:00:02"):
+        assert state.sync_get_many([1, 2, 3]) == [MISS, 20, 30]
+
+
+@pytest.mark.asyncio
+async def test_get_many_with_ttl(state):
+    with freeze_time("2023-01-14 12:00:00"):
+        state.sync_set(1, 10, 5)
+        state.sync_set(2, 20)
+    with freeze_time("2023-01-14 12:00:02"):
+        assert state.sync_get_many_with_ttl([1, 2, 3]) == [
+            (10, 3),
+            (20, None),
+            (MISS, None),
+        ]
+        assert await state.async_get_many_with_ttl([1]) == [(10, 3)]
+
+
+def test_get_set_many(state):
+    state.sync_set_many({str(index): index for index in range(1200)}, ttl=10)
+    keys = [str(index) for index in range(1300)]
+    assert state.sync_get_many(keys) == list(range(1200)) + [MISS] * 100
+
+
+def test_purge_expired(state):
+    with freeze_time("2023-01-14 12:00:00"):
+        state.sync_set_many({1: 1, 2: 2}, ttl=1)
+        state.sync_set(3, 3, 100)
+        state.sync_set(4, 4)
+    with freeze_time("2023-01-14 12:00:10"):
+        assert state.purge_expired() == 2
+    count = state._connection().execute("SELECT COUNT(*) FROM mr_cache").fetchone()
+    assert count == (2,)
+    assert state.expirations == 2
+
+
+def test_purge_every(tmp_path):
+    state = SQLiteState(PATH=tmp_path / "cache.sqlite3", PURGE_EVERY=3)
+    with freeze_time("2023-01-14 12:00:00"):
+        state.sync_set(1, 1, 1)
+    with freeze_time("2023-01-14 12:00:10"):
+        state.sync_set(2, 2)
+        assert state.expirations == 0
+        state.sync_set_many({3: 3, 4: 4})
+    assert state.expirations == 1
+
+
+def test_persistent(tmp_path):
+    state = SQLiteState(PATH=tmp_path / "cache.sqlite3")
+    state.sync_set(1, "value")
+    state.close()
+    assert SQLiteState(PATH=tmp_path / "cache.sqlite3").sync_get(1) == "value"
+
+
+def test_delete_and_clear(state):
+    state.sync_set_many({1: 1, 2: 2, 3: 3})
+    state.sync_delete(1)
+    assert state.sync_get_many([1, 2]) == [MISS, 2]
+    state.sync_clear()
+    assert state.sync_get_many([2, 3]) == [MISS, MISS]
+
+
+def test_connection_per_thread(state):
+    connections = []
+
+    def worker():
+        connections.append(state._connection())
+        state.sync_set("thread", 1)
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    thread.join()
+    assert connections[0] is not state._connection()
+    assert state.sync_get("thread") == 1
+
+
+def test_serializer(tmp_path):
+    state = SQLiteState(
+        PATH=tmp_path / "cache.sqlite3", SERIALIZER="json", COMPRESSION="zlib"
+    )
+    state.sync_set(1, {"a": [1] * 1000})
+    assert state.sync_get(1) == {"a": [1] * 1000}
+    (value,) = state._connection().execute("SELECT value FROM mr_cache").fetchone()
+    assert value[:1] == b"Z"
+
+
+@pytest.mark.asyncio
+async def test_async_runs_on_dedicated_thread(state):
+    main_thread = threading.get_ident()
+    threads = set()
+    real_get_many = state.sync_get_many
+
+    def tracked_get_many(keys):
+        threads.add(threading.current_thread().name)
+        return real_get_many(keys)
+
+    state.sync_get_many = tracked_get_many
+    await state.async_set(1, 10)
+    await state.async_set_many({2: 20}, ttl=10)
+    assert await state.async_get(1) == 10
+    assert await state.async_get_many([1, 2, 3]) == [10, 20, MISS]
+    assert len(threads) == 1
+    assert threads.pop().startswith("mr-sqlite")
+    assert threading.get_ident() == main_thread
+
+
+def test_thread_connections_closed_on_exit(state):
+    state.sync_set(1, "value")
+    connections = []
+
+    def read():
+        connections.append(state._connection())
+        assert state.sync_get(1) == "value"
+
+    for _ in range(8):
+        thread = threading.Thread(target=read)
+        thread.start()
+        thread.join()
+    assert len(state._connections) == 1
+    for connection in connections:
+        with pytest.raises(sqlite3.ProgrammingError):
+            connection.execute("SELECT 1")
+
+
+def _write(path, index):
+    state = SQLiteState(PATH=path)
+    state.sync_set_many({f"{index}-{key}": key for key in range(100)})
+
+
+def test_processes_share_the_database(tmp_path):
+    path = tmp_path / "cache.sqlite3"
+    state = SQLiteState(PATH=path)
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(target=_write, args=(path, index)) for index in range(4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert all(process.exitcode == 0 for process in processes)
+    keys = [f"{index}-{key}" for index in range(4) for key in range(100)]
+    assert state.sync_get_many(keys) == list(range(100)) * 4
+
+
+def test_clear_namespace(state):
+    state.sync_set_many({"ns:a": 1, "ns:b": 2, "ns;": 3, "nsx:a": 4, "ns": 5})
+    state.sync_clear_namespace("ns")
+    assert state.sync_get_many(["ns:a", "ns:b", "ns;", "nsx:a", "ns"]) == [
+        MISS,
+        MISS,
+        3,
+        4,
+        5,
+    ]
+
+
+@pytest.mark.asyncio
+async def test_async_delete_and_clear_namespace(state):
+    await state.async_set_many({"ns:a": 1, "ns:b": 2})
+    await state.async_delete("ns:a")
+    assert await state.async_get_many(["ns:a", "ns:b"]) == [MISS, 2]
+    await state.async_clear_namespace("ns")
+    assert await state.async_get("ns:b") is MISS
@@ -1,5 +1,10 @@
+import asyncio
 import builtins
+import multiprocessing
+from array import array
 import os
+import pickle
+import time
 import tempfile
 from inspect import _empty
 from pathlib import Path
@@ -10,7 +15,10 @@ from unittest.mock import patch, MagicMock, call
 import pytest
 from freezegun import freeze_time
 
+from mr import MISS
 from mr.states import TempFileState
+from mr.states.implementations import temp as temp_module
+from mr.states.implementations.temp import HEADER
 
 
 def test_wrong_config():
@@ -30,6 +38,26 @@ def test_static_without_base_path():
     assert str(state._path) == str((Path(tempfile.gettempdir())))
 
 
+def test_shared_without_base_path_is_private(tmp_path, monkeypatch):
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    state = TempFileState(SHARED=True)
+    assert state._path == tmp_path / f"mr-{os.getuid()}"
+    assert state._path.stat().st_mode & 0o777 == 0o700
+    state.sync_set(1, "value")
+    assert TempFileState(SHARED=True).sync_get(1) == "value"
+
+
+def test_shared_without_base_path_shared_directory(tmp_path, monkeypatch):
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    (tmp_path / f"mr-{os.getuid()}").mkdir(mode=0o777)
+    os.chmod(tmp_path / f"mr-{os.getuid()}", 0o777)
+    with pytest.raises(TypeError) as exception:
+        TempFileState(SHARED=True)
+    assert exception.value.args[0].endswith(
+        "is not private to the user, set the config value BASE_PATH"
+    )
+
+
 def test_static_with_base_path():
     state = TempFileState(STATIC=False, BASE_PATH=os.getcwd())
     assert isinstance(state._temp_folder, TemporaryDirectory)
@@ -41,25 +69,36 @@ def test_sync_set():
     state = TempFileState()
     with freeze_time("2023-01-14 12:00:01"):
         mock_object = MagicMock()
-        with patch.object(builtins, "open", return_value=mock_object):
+        with patch.object(builtins, "open", return_value=mock_object), patch.object(
+            temp_module.os, "replace"
+        ):
             state.sync_set(1, 10, 1)
-    write_bytes_call = call.write(
-        b"\x80\x04\x953\x00\x00\x00\x00\x00\x00\x00}\x94(\x8c\ncreated_at\x94GA\xd8\xf0\xa6P@\x00\x00\x8c\x03ttl\x94K\x01\x8c\x05value\x94C\x05\x80\x04K\n.\x94u.",
+    write_header_call = call.write(
+        b"MRMI\x01\x00\x00@P\xa6\xf0\xd8A\x00\x00\x00\x00\x00\x00\xf0?"
+        b"\x05\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00",
     )
-    assert write_bytes_call in mock_object.__enter__().method_calls
+    write_payload_call = call.write(b"\x80\x04K\n.")
+    assert mock_object.__enter__().method_calls == [
+        write_header_call,
+        write_payload_call,
+    ]
 
 
 @pytest.mark.asyncio
 async def test_async_set():
     state = TempFileState()
     with freeze_time("2023-01-14 12:00:01"):
-        with patch("aiofile.async_open") as mock_object:
+        with patch("aiofile.async_open") as mock_object, patch.object(
+            temp_module.os, "replace"
+        ):
             await state.async_set(1, 10, 1)
-    write_bytes_call = call.write(
-        b"\x80\x04\x953\x00\x00\x00\x00\x00\x00\x00}\x94(\x8c\ncreated_at\x94GA\xd8\xf0\xa6P@\x00\x00\x8c\x03ttl\x94K\x01\x8c\x05value\x94C\x05\x80\x04K\n.\x94u.",
+    write_header_call = call.write(
+        b"MRMI\x01\x00\x00@P\xa6\xf0\xd8A\x00\x00\x00\x00\x00\x00\xf0?"
+        b"\x05\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00",
     )
+    write_payload_call = call.write(b"\x80\x04K\n.")
     async with mock_object() as a:
-        assert write_bytes_call in a.method_calls
+        assert a.method_calls == [write_header_call, write_payload_call]
 
 
 @pytest.fixture()
@@ -74,7 +113,7 @@ def state_with_data():
 def test_sync_get_without_data(state_with_data):
     state, data = state_with_data
     value = state.sync_get(1)
-    assert value is None
+    assert value is MISS
 
 
 def test_sync_get_expired_ttl():
@@ -97,14 +136,14 @@ def test_sync_get(state_with_data):
 def test_sync_get_without_set():
     state = TempFileState()
     value = state.sync_get(1)
-    assert value is None
+    assert value is MISS
 
 
 @pytest.mark.asyncio
 async def test_async_get_without_set():
     state = TempFileState()
     value = await state.async_get(1)
-    assert value is None
+    assert value is MISS
 
 
 def test_sync_get_without_ttl_set(state_with_data):
@@ -119,7 +158,7 @@ def test_sync_get_without_ttl_set(state_with_data):
 async def test_async_get_without_data(state_with_data):
     state, data = state_with_data
     value = await state.async_get(1)
-    assert value is None
+    assert value is MISS
 
 
 @pytest.mark.asyncio
@@ -127,7 +166,7 @@ async def test_async_get_expired_ttl(state_with_data):
     state, data = state_with_data
     with freeze_time("2023-01-14 13:00:00"):
         value = await state.async_get(1)
-    assert value is None
+    assert value is MISS
 
 
 @pytest.mark.asyncio
@@ -145,3 +184,354 @@ async def test_async_get_without_ttl_set(state_with_data):
     await state.async_set(*data)
     value = await state.async_get(data[0])
     assert value == data[1]
+
+
+@pytest.mark.parametrize("value", [None, 0, "", [], False])
+def test_sync_get_falsy_value(value):
+    state = TempFileState()
+    state.sync_set(1, value)
+    assert state.sync_get(1) == value
+    assert state.sync_get(1) is not MISS
+
+
+def test_serializer():
+    state = TempFileState(SERIALIZER="marshal", COMPRESSION="lzma")
+    state.sync_set(1, {"a": [1] * 1000})
+    assert state.sync_get(1) == {"a": [1] * 1000}
+
+
+def test_expired_entry_reads_only_the_header():
+    state = TempFileState()
+    with freeze_time("2023-01-14 12:00:00"):
+        state.sync_set(1, b"x" * 1000, 1)
+    real_open = builtins.open
+    reads = []
+
+    def tracked_open(*args, **kwargs):
+        file = real_open(*args, **kwargs)
+        read = file.read
+        file.read = lambda *size: reads.append(size) or read(*size)
+        return file
+
+    with freeze_time("2023-01-14 12:00:05"):
+        with patch.object(builtins, "open", tracked_open):
+            assert state.sync_get(1) is MISS
+    assert reads == [(HEADER.size,)]
+
+
+def test_unknown_file_format():
+    state = TempFileState()
+    state.get_path(1).parent.mkdir(parents=True)
+    state.get_path(1).write_bytes(b"not a cache entry" * 10)
+    assert state.sync_get(1) is MISS
+    state.get_path(2).parent.mkdir(parents=True, exist_ok=True)
+    state.get_path(2).write_bytes(b"")
+    assert state.sync_get(2) is MISS
+
+
+@pytest.mark.parametrize("mmap_threshold", [0, 1024 * 1024])
+def test_out_of_band_buffers(mmap_threshold):
+    state = TempFileState(PICKLE_PROTOCOL=5, MMAP_THRESHOLD=mmap_threshold)
+    value = {"array": array("d", range(1000)), "raw": bytearray(b"y" * 1000)}
+    state.sync_set(1, value)
+    assert state.sync_get(1) == value
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mmap_threshold", [0, 1024 * 1024])
+async def test_async_out_of_band_buffers(mmap_threshold):
+    state = TempFileState(PICKLE_PROTOCOL=5, MMAP_THRESHOLD=mmap_threshold)
+    value = {"raw": bytearray(b"y" * 1000), "other": bytearray(b"z")}
+    await state.async_set(1, value)
+    assert await state.async_get(1) == value
+
+
+def test_mmap_large_payload():
+    state = TempFileState(MMAP_THRESHOLD=100)
+    state.sync_set(1, b"x" * 1000)
+    with patch.object(temp_module.mmap, "mmap", wraps=temp_module.mmap.mmap) as mapped:
+        assert state.sync_get(1) == b"x" * 1000
+    mapped.assert_called_once()
+
+
+class MappedBuffer:
+    """
+    Keeps the out of band buffer it is loaded from, like a numpy array does
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    def __reduce_ex__(self, protocol):
+        return MappedBuffer, (pickle.PickleBuffer(self.data),)
+
+
+@pytest.mark.parametrize("shared", [False, True])
+def test_rewrite_keeps_mapped_value(tmp_path, shared):
+    state = TempFileState(
+        PICKLE_PROTOCOL=5, MMAP_THRESHOLD=100, SHARED=shared, BASE_PATH=tmp_path
+    )
+    state.sync_set(1, MappedBuffer(bytearray(b"x" * 100_000)))
+    value = state.sync_get(1)
+    assert isinstance(value.data, memoryview)
+    state.sync_set(1, MappedBuffer(bytearray(b"y" * 10)))
+    # The old value still points into the mapping of the replaced file
+    assert bytes(value.data) == b"x" * 100_000
+    assert bytes(state.sync_get(1).data) == b"y" * 10
+    assert _files(state) == ["1"]
+
+
+def test_sharded_path():
+    state = TempFileState()
+    path = state.get_path("key")
+    assert path.name == "key"
+    assert path.parent.parent.parent == state._path
+    assert len(path.parent.name) == len(path.parent.parent.name) == 2
+
+
+def test_flat_path():
+    state = TempFileState(SHARD_DEPTH=0)
+    assert state.get_path("key") == state._path / "key"
+    state.sync_set("key", 1)
+    assert state.sync_get("key") == 1
+
+
+def test_wrong_shard_depth():
+    with pytest.raises(TypeError) as exception:
+        TempFileState(SHARD_DEPTH=5)
+    assert (
+        exception.value.args[0]
+        == "The config value SHARD_DEPTH must be an int from 0 to 4"
+    )
+
+
+def _files(state):
+    return sorted(path.name for path in state._path.rglob("*") if path.is_file())
+
+
+@pytest.mark.parametrize("shard_depth", [0, 1, 2])
+def test_collect_expired(shard_depth):
+    state = TempFileState(SHARD_DEPTH=shard_depth, GC_EVERY=0)
+    with freeze_time("2023-01-14 12:00:00"):
+        state.sync_set("short", 1, 1)
+        state.sync_set("long", 1, 100)
+        state.sync_set("forever", 1)
+    (state._path / "other").write_bytes(b"not a cache entry")
+    with freeze_time("2023-01-14 12:00:10"):
+        state.collect()
+    assert _files(state) == ["forever", "long", "other"]
+    assert state.expirations == 1
+
+
+def test_collect_max_size():
+    state = TempFileState(MAX_SIZE=2500, GC_EVERY=0)
+    for index in range(5):
+        state.sync_set(index, b"x" * 1000)
+        os.utime(state.get_path(index), (1000 + index, 1000 + index))
+    state.collect()
+    assert _files(state) == ["3", "4"]
+    assert state.evictions == 3
+
+
+def test_collect_step_visits_each_shard():
+    state = TempFileState(SHARD_DEPTH=1, GC_EVERY=0)
+    with freeze_time("2023-01-14 12:00:00"):
+        for index in range(50):
+            state.sync_set(index, index, 1)
+    with freeze_time("2023-01-14 12:00:10"):
+        for _ in range(temp_module.SHARD_FANOUT - 1):
+            state.collect_step()
+        assert len(_files(state)) in (0, 1, 2)
+        state.collect_step()
+    assert _files(state) == []
+    assert state.expirations == 50
+
+
+def test_collect_step_namespaces_under_max_size():
+    state = TempFileState(SHARD_DEPTH=0, MAX_SIZE=10_000, GC_EVERY=0)
+    for index in range(4):
+        state.sync_set(f"ns1:{index}", b"x" * 1000)
+        state.sync_set(f"ns2:{index}", b"x" * 1000)
+    # The base directory and the two namespaces, twice
+    for _ in range(6):
+        state.collect_step()
+    assert len(_files(state)) == 8
+    assert state.evictions == 0
+
+
+def test_collect_step_over_max_size():
+    state = TempFileState(SHARD_DEPTH=0, MAX_SIZE=2500, GC_EVERY=0)
+    for index in range(5):
+        state.sync_set(f"ns:{index}", b"x" * 1000)
+        os.utime(state.get_path(f"ns:{index}"), (1000 + index, 1000 + index))
+    for _ in range(4):
+        state.collect_step()
+    assert _files(state) == ["3", "4"]
+    assert state.evictions == 3
+
+
+def test_collect_on_sets():
+    state = TempFileState(SHARD_DEPTH=0, GC_EVERY=3)
+    with patch.object(state, "collect_step") as collect_step:
+        for index in range(7):
+            state.sync_set(index, index)
+    assert collect_step.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_async_collect_on_sets():
+    state = TempFileState(SHARD_DEPTH=0, GC_EVERY=2)
+    with patch.object(state, "collect_step") as collect_step:
+        for index in range(4):
+            await state.async_set(index, index)
+            assert await state.async_get(index) == index
+    assert collect_step.call_count == 2
+
+
+def test_background_collector():
+    state = TempFileState(GC_INTERVAL=0.01, GC_EVERY=0)
+    state.sync_set(1, 1, 0)
+    for _ in range(100):
+        if not _files(state):
+            break
+        time.sleep(0.01)
+    state.close()
+    assert _files(state) == []
+
+
+def test_shared_uses_base_path(tmp_path):
+    state = TempFileState(SHARED=True, BASE_PATH=tmp_path)
+    assert state._path == tmp_path
+    assert (tmp_path / ".locks").is_dir()
+
+
+def test_shared_atomic_write(tmp_path):
+    state = TempFileState(SHARED=True, BASE_PATH=tmp_path)
+    with patch.object(temp_module.os, "replace", wraps=os.replace) as replace:
+        state.sync_set(1, "value")
+    source, target = replace.call_args.args
+    assert source.name.startswith(".1.") and source.name.endswith(".tmp")
+    assert target == state.get_path(1)
+    assert _files(state) == ["1"]
+    assert state.sync_get(1) == "value"
+
+
+@pytest.mark.asyncio
+async def test_async_shared_atomic_write(tmp_path):
+    state = TempFileState(SHARED=True, BASE_PATH=tmp_path)
+    await state.async_set(1, "value")
+    await state.async_set(1, "other")
+    assert _files(state) == ["1"]
+    assert await state.async_get(1) == "other"
+
+
+def test_collect_abandoned_writes(tmp_path):
+    state = TempFileState(SHARED=True, BASE_PATH=tmp_path, SHARD_DEPTH=0)
+    abandoned = tmp_path / ".1.10.10.tmp"
+    in_progress = tmp_path / ".2.10.10.tmp"
+    foreign = [tmp_path / "download.tmp", tmp_path / ".session.tmp"]
+    for path in [abandoned, in_progress, *foreign]:
+        path.write_bytes(b"")
+    for path in [abandoned, *foreign]:
+        os.utime(path, (1000, 1000))
+    state.collect()
+    assert not abandoned.exists()
+    assert in_progress.exists()
+    assert all(path.exists() for path in foreign)
+
+
+def _compute_once(base_path, queue):
+    state = TempFileState(SHARED=True, BASE_PATH=base_path)
+    with state.sync_lock("key") as value:
+        if value is MISS:
+            time.sleep(0.2)
+            value = os.getpid()
+            state.sync_set("key", value)
+    queue.put(value)
+
+
+def test_shared_lock_across_processes(tmp_path):
+    context = multiprocessing.get_context("fork")
+    queue = context.Queue()
+    processes = [
+        context.Process(target=_compute_once, args=(tmp_path, queue)) for _ in range(4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    values = {queue.get() for _ in processes}
+    assert len(values) == 1
+    assert values.pop() in {process.pid for process in processes}
+
+
+@pytest.mark.asyncio
+async def test_async_shared_lock(tmp_path):
+    state = TempFileState(SHARED=True, BASE_PATH=tmp_path)
+    calls = []
+
+    async def compute():
+        async with state.async_lock("key") as value:
+            if value is MISS:
+                calls.append(1)
+                await asyncio.sleep(0.05)
+                value = "value"
+                await state.async_set("key", value)
+        return value
+
+    assert await asyncio.gather(compute(), compute(), compute()) == ["value"] * 3
+    assert calls == [1]
+
+
+def test_lock_without_shared():
+    state = TempFileState()
+    with state.sync_lock("key") as value:
+        assert value is MISS
+
+
+def test_namespace_directory():
+    state = TempFileState(SHARD_DEPTH=1)
+    path = state.get_path("ns:key")
+    assert path.name == "key"
+    assert path.parent.parent == state._path / temp_module.NAMESPACES_DIR / "ns"
+
+
+@pytest.mark.parametrize("shard_depth", [0, 2])
+def test_delete_and_clear_namespace(shard_depth):
+    state = TempFileState(SHARD_DEPTH=shard_depth)
+    for key in ("ns1:a", "ns1:b", "ns2:a", "plain"):
+        state.sync_set(key, key)
+    state.sync_delete("ns1:a")
+    state.sync_delete("ns1:missing")
+    assert state.sync_get("ns1:a") is MISS
+    state.sync_clear_namespace("ns1")
+    state.sync_clear_namespace("missing")
+    assert not (state._path / temp_module.NAMESPACES_DIR / "ns1").exists()
+    assert [state.sync_get(key) for key in ("ns1:b", "ns2:a", "plain")] == [
+        MISS,
+        "ns2:a",
+        "plain",
+    ]
+    state.sync_set("ns1:b", 1)
+    assert state.sync_get("ns1:b") == 1
+
+
+def test_collect_namespaces():
+    state = TempFileState(SHARD_DEPTH=1)
+    with freeze_time("2023-01-14 12:00:00"):
+        state.sync_set("ns:a", 1, 1)
+        state.sync_set("b", 1, 1)
+    with freeze_time("2023-01-14 12:00:05"):
+        state.collect()
+    assert _files(state) == []
+
+
+@pytest.mark.asyncio
+async def test_async_delete_and_clear_namespace():
+    state = TempFileState()
+    await state.async_set("ns:a", 1)
+    await state.async_set("ns:b", 2)
+    await state.async_delete("ns:a")
+    assert await state.async_get("ns:a") is MISS
+    await state.async_clear_namespace("ns")
+    assert await state.async_get("ns:b") is MISS
@@ -0,0 +1,154 @@
+import pytest
+from freezegun import freeze_time
+
+from mr import MISS
+from mr.states import MemoryState, TempFileState, TieredState
+
+
+def test_missing_config():
+    with pytest.raises(KeyError) as exception:
+        TieredState()
+    assert exception.value.args[0] == "The config value TIERS was not informed"
+
+
+def test_empty_tiers():
+    with pytest.raises(ValueError) as exception:
+        TieredState(TIERS=[])
+    assert (
+        exception.value.args[0] == "The config value TIERS must have at least one tier"
+    )
+
+
+def test_wrong_write_mode():
+    with pytest.raises(ValueError) as exception:
+        TieredState(TIERS=[{"state": MemoryState}], WRITE_MODE="back")
+    assert exception.value.args[0] == (
+        "The config value WRITE_MODE must be one of ['THROUGH', 'AROUND']"
+    )
+
+
+def test_wrong_tier_state():
+    with pytest.raises(TypeError):
+        TieredState(TIERS=[{"state": dict}])
+
+
+@pytest.fixture()
+def state():
+    return TieredState(
+        TIERS=[
+            {"state": MemoryState, "max_ttl": 10},
+            {"state": TempFileState},
+        ]
+    )
+
+
+def test_write_through(state):
+    l1, l2 = state.tiers
+    with freeze_time("2023-01-14 12:00:00"):
+        state.sync_set("key", 1, 100)
+        assert l2.sync_get("key") == 1
+    assert l1._state["key"]["ttl"] == 10
+    with freeze_time("2023-01-14 12:00:00"):
+        state.sync_set("forever", 1)
+    assert l1._state["forever"]["ttl"] == 10
+
+
+def test_write_around():
+    state = TieredState(
+        TIERS=[{"state": MemoryState}, {"state": MemoryState}], WRITE_MODE="around"
+    )
+    state.sync_set("key", 1, 100)
+    l1, l2 = state.tiers
+    assert l1._state == {}
+    assert state.sync_get("key") == 1
+    assert l1._state["key"]["ttl"] == 60
+    assert state.stats == [{"hits": 0, "misses": 1}, {"hits": 1, "misses": 0}]
+
+
+def test_write_around_invalidates_upper_tiers():
+    state = TieredState(
+        TIERS=[{"state": MemoryState}, {"state": MemoryState}], WRITE_MODE="around"
+    )
+    state.sync_set("key", 1, 100)
+    assert state.sync_get("key") == 1
+    state.sync_set("key", 2, 100)
+    assert state.sync_get("key") == 2
+    state.sync_replace("key", 3, 100)
+    assert state.sync_get("key") == 3
+
+
+@pytest.mark.asyncio
+async def test_async_write_around_invalidates_upper_tiers():
+    state = TieredState(
+        TIERS=[{"state": MemoryState}, {"state": MemoryState}], WRITE_MODE="around"
+    )
+    await state.async_set("key", 1, 100)
+    assert await state.async_get("key") == 1
+    await state.async_set_many({"key": 2}, 100)
+    assert await state.async_get("key") == 2
+    await state.async_replace("key", 3, 100)
+    assert await state.async_get("key") == 3
+
+
+def test_fall_through_and_promotion(state):
+    l1, l2 = state.tiers
+    l2.sync_set("key", None, 100)
+    assert state.sync_get("key") is None
+    assert l1._state["key"]["ttl"] == 10
+    assert state.sync_get("key") is None
+    assert state.sync_get("missing") is MISS
+    assert state.stats == [{"hits": 1, "misses": 2}, {"hits": 1, "misses": 1}]
+
+
+def test_promotion_capped_by_lower_tier_ttl(state):
+    l1, l2 = state.tiers
+    with freeze_time("2023-01-14 12:00:00"):
+        l2.sync_set("short", 1, 4)
+        l2.sync_set("ending", 2, 1)
+    with freeze_time("2023-01-14 12:00:00.500000"):
+        assert state.sync_get_many(["short", "ending"]) == [1, 2]
+    assert l1._state["short"]["ttl"] == 3
+    # Less than a second left, not worth promoting
+    assert "ending" not in l1._state
+
+
+@pytest.mark.asyncio
+async def test_async_promotion_capped_by_lower_tier_ttl():
+    state = TieredState(TIERS=[{"state": MemoryState}, {"state": MemoryState}])
+    l1, l2 = state.tiers
+    with freeze_time("2023-01-14 12:00:00"):
+        await l2.async_set("key", 1, 30)
+        await l2.async_set("forever", 2)
+    with freeze_time("2023-01-14 12:00:10"):
+        assert await state.async_get_many(["key", "forever"]) == [1, 2]
+    assert l1._state["key"]["ttl"] == 20
+    assert l1._state["forever"]["ttl"] == 60
+
+
+def test_sync_get_many(state):
+    l1, l2 = state.tiers
+    l1.sync_set("a", 1)
+    l2.sync_set("b", 2)
+    assert state.sync_get_many(["a", "b", "c"]) == [1, 2, MISS]
+    assert state.stats == [{"hits": 1, "misses": 2}, {"hits": 1, "misses": 1}]
+
+
+@pytest.mark.asyncio
+async def test_async(state):
+    l1, l2 = state.tiers
+    await l2.async_set("b", 2)
+    await state.async_set("a", 1, 5)
+    assert await state.async_get("a") == 1
+    assert await state.async_get("b") == 2
+    assert await state.async_get_many(["a", "b", "c"]) == [1, 2, MISS]
+    assert await l1.async_get("b") == 2
+    assert state.stats == [{"hits": 3, "misses": 2}, {"hits": 1, "misses": 1}]
+
+
+def test_delete_and_clear_namespace(state):
+    state.sync_set_many({"ns:a": 1, "ns:b": 2, "other:a": 3})
+    state.sync_delete("ns:a")
+    assert state.sync_get("ns:a") is MISS
+    state.sync_clear_namespace("ns")
+    assert state.sync_get_many(["ns:b", "other:a"]) == [MISS, 3]
+    assert [tier.sync_get("ns:b") for tier in state.tiers] == [MISS, MISS]
@@ -0,0 +1,93 @@
+import pytest
+
+from mr.states.eviction import (
+    CountMinSketch,
+    LFUPolicy,
+    LRUPolicy,
+    TinyLFUPolicy,
+)
+
+
+def test_lru_victim():
+    policy = LRUPolicy()
+    for key in range(3):
+        policy.insert(key)
+    policy.access(0, hit=True)
+    assert policy.victim() == 1
+    assert list(policy) == [0, 2]
+
+
+def test_lru_remove():
+    policy = LRUPolicy()
+    policy.insert(0)
+    policy.insert(1)
+    policy.remove(0)
+    policy.remove(10)
+    assert policy.victim() == 1
+
+
+def test_lfu_victim():
+    policy = LFUPolicy()
+    for key in range(3):
+        policy.insert(key)
+    policy.access(0, hit=True)
+    policy.access(0, hit=True)
+    policy.access(1, hit=True)
+    policy.access(3, hit=False)
+    assert policy.victim() == 2
+    assert policy.victim() == 1
+    assert list(policy) == [0]
+
+
+def test_lfu_remove_min_frequency():
+    policy = LFUPolicy()
+    policy.insert(0)
+    policy.insert(1)
+    policy.access(1, hit=True)
+    policy.remove(0)
+    assert policy.victim() == 1
+
+
+def test_count_min_sketch():
+    sketch = CountMinSketch(width=64)
+    for _ in range(5):
+        sketch.add("a")
+    assert sketch.estimate("a") >= 5
+    assert sketch.estimate("b") <= sketch.estimate("a")
+
+
+def test_count_min_sketch_aging():
+    sketch = CountMinSketch(width=2)
+    for _ in range(20):
+        sketch.add("a")
+    assert sketch.estimate("a") < 15
+
+
+def test_tinylfu_rejects_cold_candidate():
+    policy = TinyLFUPolicy(sketch_width=64)
+    policy.insert("hot")
+    policy.insert("warm")
+    for _ in range(5):
+        policy.access("hot", hit=True)
+    policy.insert("cold")
+    assert policy.victim() in ("warm", "cold")
+    assert "hot" in list(policy)
+
+
+def test_tinylfu_admits_frequent_candidate():
+    policy = TinyLFUPolicy(sketch_width=64)
+    policy.insert("old")
+    policy.insert("other")
+    for _ in range(5):
+        policy.access("new", hit=False)
+    policy.insert("new")
+    assert policy.victim() == "old"
+    assert set(policy) == {"other", "new"}
+
+
+@pytest.mark.parametrize("policy_class", [LRUPolicy, LFUPolicy, TinyLFUPolicy])
+def test_policy_drains(policy_class):
+    policy = policy_class()
+    for key in range(10):
+        policy.insert(key)
+    assert sorted(policy.victim() for _ in range(10)) == list(range(10))
@@ -0,0 +1,103 @@
+import pickle
+
+import pytest
+
+from mr.states import serializers
+from mr.states.serializers import (
+    CompressedSerializer,
+    JsonSerializer,
+    MarshalSerializer,
+    PickleSerializer,
+)
+
+DATA = {"id": 1, "names": ["a", "b"] * 1000, "ok": True, "none": None}
+
+
+@pytest.mark.parametrize(
+    "serializer",
+    [
+        PickleSerializer(),
+        PickleSerializer(protocol=2),
+        PickleSerializer(protocol=5),
+        MarshalSerializer(),
+        JsonSerializer(),
+        CompressedSerializer(inner=MarshalSerializer()),
+        CompressedSerializer(inner=JsonSerializer(), algorithm="lzma"),
+        CompressedSerializer(inner=PickleSerializer(), threshold=10**9),
+    ],
+)
+def test_round_trip(serializer):
+    assert serializers.loads(serializer.dumps(DATA)) == DATA
+
+
+def test_bytearray_round_trip():
+    data = bytearray(b"raw")
+    assert type(serializers.loads(PickleSerializer().dumps(data))) is bytearray
+    assert serializers.loads(MarshalSerializer().dumps(data)) == b"raw"
+    assert type(serializers.loads(MarshalSerializer().dumps(data))) is bytes
+
+
+def test_pickle_is_plain_pickle():
+    assert PickleSerializer().dumps(DATA) == pickle.dumps(DATA)
+
+
+def test_wrong_pickle_protocol():
+    with pytest.raises(ValueError) as exception:
+        PickleSerializer(protocol=1)
+    assert exception.value.args[0] == "The pickle protocol must be 2 or higher"
+
+
+def test_wrong_compression():
+    with pytest.raises(ValueError) as exception:
+        CompressedSerializer(inner=PickleSerializer(), algorithm="gzip")
+    assert exception.value.args[0] == (
+        "The compression algorithm must be one of ['zlib', 'lzma']"
+    )
+
+
+def test_compression_threshold():
+    serializer = CompressedSerializer(inner=MarshalSerializer(), threshold=100)
+    assert serializer.dumps(1) == MarshalSerializer().dumps(1)
+    compressed = serializer.dumps(DATA)
+    assert compressed[:1] == b"Z"
+    assert len(compressed) < len(MarshalSerializer().dumps(DATA))
+
+
+def test_unknown_tag():
+    with pytest.raises(ValueError) as exception:
+        serializers.loads(b"?")
+    assert exception.value.args[0] == "Unknown serializer tag 63"
+
+
+def test_from_kwargs():
+    assert isinstance(serializers.from_kwargs({}), PickleSerializer)
+    assert serializers.from_kwargs({"PICKLE_PROTOCOL": 5}).protocol == 5
+    assert isinstance(serializers.from_kwargs({"SERIALIZER": "json"}), JsonSerializer)
+    serializer = serializers.from_kwargs(
+        {
+            "SERIALIZER": "marshal",
+            "COMPRESSION": "lzma",
+            "COMPRESSION_THRESHOLD": 10,
+            "COMPRESSION_LEVEL": 1,
+        }
+    )
+    assert isinstance(serializer, CompressedSerializer)
+    assert isinstance(serializer.inner, MarshalSerializer)
+    assert serializer.threshold == 10
+    instance = JsonSerializer()
+    assert serializers.from_kwargs({"SERIALIZER": instance}) is instance
+
+
+def test_from_kwargs_wrong_serializer():
+    with pytest.raises(KeyError) as exception:
+        serializers.from_kwargs({"SERIALIZER": "yaml"})
+    assert exception.value.args[0] == (
+        "The config value SERIALIZER must be one of ['PICKLE', 'MARSHAL', 'JSON'] "
+        "or an ISerializer instance"
+    )
+
+
+def test_switching_serializer_keeps_old_entries():
+    old = PickleSerializer().dumps(DATA)
+    new = serializers.from_kwargs({"SERIALIZER": "json", "COMPRESSION": "zlib"})
+    assert serializers.loads(old) == serializers.loads(new.dumps(DATA)) == DATA
@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+from mr.flight import AsyncSingleFlight
+
+
+@pytest.mark.asyncio
+async def test_async_leader_cancelled():
+    flight = AsyncSingleFlight()
+    calls = []
+    release = asyncio.Event()
+
+    async def compute():
+        calls.append(len(calls))
+        await release.wait()
+        return len(calls)
+
+    leader = asyncio.create_task(flight.do("key", compute))
+    await asyncio.sleep(0)
+    waiters = [asyncio.create_task(flight.do("key", compute)) for _ in range(3)]
+    await asyncio.sleep(0)
+    leader.cancel()
+    # One of the waiters takes over the computation
+    for _ in range(100):
+        if len(calls) == 2:
+            break
+        await asyncio.sleep(0)
+    release.set()
+    assert await asyncio.gather(*waiters) == [2, 2, 2]
+    assert leader.cancelled()
+    assert calls == [0, 1]
+    assert flight.coalesced == 3
+
+
+@pytest.mark.asyncio
+async def test_async_waiter_cancelled():
+    flight = AsyncSingleFlight()
+    release = asyncio.Event()
+
+    async def compute():
+        await release.wait()
+        return 1
+
+    leader = asyncio.create_task(flight.do("key", compute))
+    await asyncio.sleep(0)
+    waiter = asyncio.create_task(flight.do("key", compute))
+    await asyncio.sleep(0)
+    waiter.cancel()
+    await asyncio.sleep(0)
+    release.set()
+    assert await leader == 1
+    assert waiter.cancelled()
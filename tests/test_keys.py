@@ -0,0 +1,177 @@
+from array import array
+
+import pytest
+
+from mr.keys import CallKey, hash_args, namespace, untyped
+
+
+def test_kwargs_order():
+    assert hash_args("f", (1,), {"a": 1, "b": 2}) == hash_args(
+        "f", (1,), {"b": 2, "a": 1}
+    )
+
+
+def test_kwargs_names():
+    assert hash_args("f", (), {"a": 1}) != hash_args("f", (), {"b": 1})
+
+
+def test_function_name():
+    assert hash_args("f", (1,), {}) != hash_args("g", (1,), {})
+
+
+@pytest.mark.parametrize(
+    "arg_a, arg_b",
+    [
+        (1, "1"),
+        (b"1", "1"),
+        ([1, 2], (1, 2)),
+        ([[1], 2], [1, [2]]),
+        (list(range(10_000)), list(range(10_000)) + [1]),
+        ({"a": 1}, {"a": 2}),
+        ({1, 2}, {1, 3}),
+        (array("i", [1, 2]), array("l", [1, 2])),
+    ],
+)
+def test_different_args(arg_a, arg_b):
+    assert hash_args("f", (arg_a,), {}) != hash_args("f", (arg_b,), {})
+
+
+@pytest.mark.parametrize(
+    "arg_a, arg_b",
+    [
+        ({"a": 1, "b": [1]}, {"b": [1], "a": 1}),
+        ({3, 2, 1}, {1, 2, 3}),
+        (b"x" * 10_000, b"x" * 10_000),
+        (bytearray(b"ab"), b"ab"),
+        (array("d", [1.5, 2.5]), array("d", [1.5, 2.5])),
+        (memoryview(b"abcdef")[::2], memoryview(b"ace")),
+    ],
+)
+def test_equal_args(arg_a, arg_b):
+    assert hash_args("f", (arg_a,), {}) == hash_args("f", (arg_b,), {})
+
+
+def test_fast_path_does_not_collide_with_structural_path():
+    assert hash_args("f", (1,), {}) != hash_args("f", ((1,),), {})
+    assert hash_args("f", tuple(range(9)), {}) == hash_args("f", tuple(range(9)), {})
+
+
+def test_digest_size():
+    assert len(hash_args("f", (1,), {}, digest_size=8)) == 16
+    assert len(hash_args("f", ([1],), {}, digest_size=32)) == 64
+
+
+def test_fallback_repr():
+    class Stub:
+        def __repr__(self):
+            return "stub"
+
+    assert hash_args("f", (Stub(),), {}) == hash_args("f", (Stub(),), {})
+
+
+def test_fallback_str():
+    class Stub:
+        def __init__(self, name):
+            self.name = name
+
+        def __str__(self):
+            return self.name
+
+    # The default repr() holds the id(), equal objects must still share a key
+    assert hash_args("f", (Stub("a"),), {}) == hash_args("f", (Stub("a"),), {})
+    assert hash_args("f", ([Stub("a")],), {"b": Stub("b")}) == hash_args(
+        "f", ([Stub("a")],), {"b": Stub("b")}
+    )
+    assert hash_args("f", (Stub("a"),), {}) != hash_args("f", (Stub("b"),), {})
+    assert hash_args("f", (Stub("a"),), {}) != hash_args("f", ("a",), {})
+
+
+@pytest.mark.parametrize(
+    "arg_a, arg_b",
+    [
+        ({}, set()),
+        ({"a": 1}, [("a", 1)]),
+        ([{"a": 1}], [(..., "dict", ["a"], [1])]),
+        ({1, 2}, (..., "set", [1, 2])),
+        (b"x" * 2000, b"x" * 2000 + b"y"),
+        ({1: "a", "b": 2}, {1: "a", "b": 3}),
+    ],
+)
+def test_plain_path_is_unambiguous(arg_a, arg_b):
+    assert hash_args("f", (arg_a,), {}) != hash_args("f", (arg_b,), {})
+
+
+def test_nested_containers_order():
+    arg_a = [{"id": 1, "tags": {"b", "a"}, "meta": {"y": 2, "x": 1}}]
+    arg_b = [{"meta": {"x": 1, "y": 2}, "tags": {"a", "b"}, "id": 1}]
+    assert hash_args("f", (arg_a,), {"c": arg_a}) == hash_args(
+        "f", (arg_b,), {"c": arg_b}
+    )
+
+
+def test_namespace():
+    assert namespace("module.func") == namespace("module.func")
+    assert namespace("module.func") != namespace("other.func")
+    assert namespace("module.func", version="2") != namespace("module.func")
+    assert len(namespace("module.func")) == 16
+
+
+def _signature(a, b=2, *args, c, d=4, **kwargs):
+    return a
+
+
+def test_call_key_normalizes_calls():
+    call_key = CallKey(_signature)
+    assert call_key((1,), {"c": 3}) == ((1, 2), {"c": 3, "d": 4})
+    assert call_key((), {"a": 1, "b": 2, "c": 3, "d": 4}) == call_key((1,), {"c": 3})
+    assert call_key((1, 2, 5), {"c": 3, "e": 6}) == (
+        (1, 2, 5),
+        {"c": 3, "d": 4, "e": 6},
+    )
+
+
+def test_call_key_positional_only():
+    def func(a, /, b):
+        return a
+
+    call_key = CallKey(func)
+    # A positional only parameter can't be given by keyword
+    assert call_key((), {"a": 1, "b": 2}) == ((), {"a": 1, "b": 2})
+    assert call_key((1,), {"b": 2}) == ((1, 2), {})
+
+
+def test_call_key_ignore():
+    call_key = CallKey(_signature, ignore=("b", "d"))
+    assert call_key((1, 5), {"c": 3, "d": 7}) == ((1,), {"c": 3})
+    with pytest.raises(ValueError):
+        CallKey(_signature, ignore=("missing",))
+
+
+def test_call_key_self_key():
+    class Stub:
+        def __init__(self, stub_id):
+            self.stub_id = stub_id
+
+        def method(self, a):
+            return a
+
+    call_key = CallKey(Stub.method, self_key="stub_id")
+    assert call_key((Stub(1), 2), {}) == ((1, 2), {})
+    assert call_key((Stub(1),), {"a": 2}) == ((1, 2), {})
+
+
+def test_untyped():
+    assert untyped((1.0, True, 1.5, [2.0], {"a": False}, {3.0})) == (
+        1,
+        1,
+        1.5,
+        [2],
+        {"a": 0},
+        {3},
+    )
+    call_key = CallKey(_signature, typed=False)
+    assert call_key((1.0,), {"c": True}) == call_key((1,), {"c": 1})
+    typed_key = CallKey(_signature)
+    assert hash_args("f", *typed_key((1.0,), {"c": 3})) != hash_args(
+        "f", *typed_key((1,), {"c": 3})
+    )
@@ -0,0 +1,122 @@
+import asyncio
+import threading
+
+import pytest
+
+from mr import Mime, Config
+from mr.metrics import Histogram, MetricsRegistry, registry
+from mr.states.implementations.memory import MemoryState
+
+
+@pytest.fixture()
+def mime_default():
+    Mime.set_config(config=Config(state=MemoryState))
+    registry.clear()
+    yield Mime
+    registry.clear()
+
+
+def test_histogram():
+    histogram = Histogram(bounds=(0.1, 1.0))
+    for seconds in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(seconds)
+    assert histogram.snapshot() == {
+        "count": 4,
+        "sum": 2.65,
+        "buckets": {0.1: 2, 1.0: 3, "+Inf": 4},
+    }
+
+
+def test_registry_export_hooks():
+    metrics_registry = MetricsRegistry()
+    metrics_registry.register(name="module.func").hits = 3
+    exported = []
+    metrics_registry.add_hook(exported.append)
+    snapshot = metrics_registry.export()
+    assert exported == [snapshot]
+    assert snapshot["module.func"]["hits"] == 3
+    metrics_registry.remove_hook(exported.append)
+    metrics_registry.export()
+    assert len(exported) == 1
+
+
+def test_metrics_disabled_by_default(mime_default):
+    @mime_default(ttl=10)
+    def cached_callback(param_a: int):
+        return param_a
+
+    cached_callback(1)
+    assert cached_callback.metrics is None
+    assert registry.snapshot() == {}
+
+
+def test_sync_mimic_metrics(mime_default):
+    @mime_default(ttl=10, metrics=True)
+    def cached_callback(param_a: int):
+        if param_a < 0:
+            raise ValueError(param_a)
+        return param_a
+
+    cached_callback(1)
+    cached_callback(1)
+    cached_callback(2)
+    with pytest.raises(ValueError):
+        cached_callback(-1)
+    name = f"{__name__}.test_sync_mimic_metrics.<locals>.cached_callback"
+    assert registry.get(name) is cached_callback.metrics
+    snapshot = registry.snapshot()[name]
+    assert (snapshot["hits"], snapshot["misses"], snapshot["sets"]) == (1, 3, 2)
+    assert snapshot["errors"] == 1
+    assert snapshot["key_hash"]["count"] == 4
+    assert snapshot["state_get"]["count"] == 4
+    assert snapshot["state_set"]["count"] == 2
+    assert snapshot["compute"]["count"] == 2
+
+
+def test_sync_mimic_map_metrics(mime_default):
+    @mime_default(ttl=10, metrics=True)
+    def cached_callback(param_a: int):
+        return param_a
+
+    cached_callback(1)
+    assert cached_callback.map([(1,), (2,), (3,)]) == [1, 2, 3]
+    metrics = cached_callback.metrics
+    assert (metrics.hits, metrics.misses, metrics.sets) == (1, 3, 3)
+    assert metrics.state_get.count == 2
+    assert metrics.compute.count == 3
+
+
+def test_sync_mimic_coalesced_metrics(mime_default):
+    release = threading.Event()
+
+    @mime_default(ttl=10, single_flight=True, metrics=True)
+    def cached_callback(param_a: int):
+        release.wait(1)
+        return param_a
+
+    threads = [threading.Thread(target=cached_callback, args=(1,)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    while cached_callback.single_flight.coalesced < 3:
+        pass
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert cached_callback.metrics.snapshot()["coalesced"] == 3
+    assert cached_callback.metrics.compute.count == 1
+
+
+@pytest.mark.asyncio
+async def test_async_mimic_metrics(mime_default):
+    @mime_default(ttl=10, single_flight=True, metrics=True)
+    async def cached_callback(param_a: int):
+        await asyncio.sleep(0.01)
+        return param_a
+
+    await asyncio.gather(*[cached_callback(1) for _ in range(3)])
+    await cached_callback(1)
+    assert await cached_callback.map([(1,), (2,)]) == [1, 2]
+    snapshot = cached_callback.metrics.snapshot()
+    assert (snapshot["hits"], snapshot["misses"], snapshot["sets"]) == (2, 4, 2)
+    assert snapshot["coalesced"] == 2
+    assert snapshot["compute"]["count"] == 2
@@ -1,3 +1,9 @@
+import asyncio
+import contextlib
+import math
+import pickle
+import threading
+import time
 from datetime import datetime, timedelta
 from typing import Type
 
@@ -6,7 +12,6 @@ from freezegun import freeze_time
 
 import mr
 from mr import Mime, Config
-from mr.mime import singleton_container
 from mr.states.implementations.memory import MemoryState
 from tests.config.test_config import StubState
 
@@ -19,7 +24,6 @@ def test_mime_singleton():
 
 @pytest.fixture()
 def mime_default() -> Type[Mime]:
-    singleton_container.clean_references()
     Mime.set_config(config=Config(state=MemoryState))
     return Mime
 
@@ -92,3 +96,791 @@ async def test_async_mimic_get_renew_return(mime_default):
     with freeze_time(datetime_now):
         return_a2 = await cached_callback(0)
     assert return_a1 != return_a2
+
+
+def test_mime_options_do_not_collide():
+    a1 = Mime(ttl=1, single_flight=True)
+    a2 = Mime(ttl=1)
+    assert a1._single_flight is True
+    assert a2._single_flight is False
+
+
+def test_sync_mimic_single_flight(mime_default):
+    calls = []
+    barrier = threading.Barrier(5)
+
+    @mime_default(ttl=10, single_flight=True)
+    def cached_callback(param_a: int):
+        calls.append(param_a)
+        time.sleep(0.1)
+        return param_a * 2
+
+    results = []
+
+    def worker():
+        barrier.wait()
+        results.append(cached_callback(2))
+
+    threads = [threading.Thread(target=worker) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [4] * 5
+    assert calls == [2]
+    assert cached_callback.single_flight.coalesced == 4
+
+
+def test_sync_mimic_single_flight_error(mime_default):
+    calls = []
+    barrier = threading.Barrier(3)
+
+    @mime_default(ttl=10, single_flight=True)
+    def cached_callback(param_a: int):
+        calls.append(param_a)
+        time.sleep(0.1)
+        raise ValueError(param_a)
+
+    errors = []
+
+    def worker():
+        barrier.wait()
+        try:
+            cached_callback(1)
+        except ValueError as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=worker) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 3
+    assert len(calls) == 1
+    with pytest.raises(ValueError):
+        cached_callback(1)
+    assert len(calls) == 2
+
+
+def test_sync_mimic_without_single_flight(mime_default):
+    @mime_default(ttl=10)
+    def cached_callback(param_a: int):
+        return param_a
+
+    assert cached_callback.single_flight is None
+
+
+@pytest.mark.asyncio
+async def test_async_mimic_single_flight(mime_default):
+    calls = []
+
+    @mime_default(ttl=10, single_flight=True)
+    async def cached_callback(param_a: int):
+        calls.append(param_a)
+        await asyncio.sleep(0.05)
+        return param_a * 2
+
+    results = await asyncio.gather(*[cached_callback(3) for _ in range(5)])
+    assert results == [6] * 5
+    assert calls == [3]
+    assert cached_callback.single_flight.coalesced == 4
+
+
+@pytest.mark.asyncio
+async def test_async_mimic_single_flight_error(mime_default):
+    calls = []
+
+    @mime_default(ttl=10, single_flight=True)
+    async def cached_callback(param_a: int):
+        calls.append(param_a)
+        await asyncio.sleep(0.05)
+        raise ValueError(param_a)
+
+    results = await asyncio.gather(
+        *[cached_callback(1) for _ in range(3)], return_exceptions=True
+    )
+    assert all(isinstance(result, ValueError) for result in results)
+    assert len(calls) == 1
+    with pytest.raises(ValueError):
+        await cached_callback(1)
+    assert len(calls) == 2
+
+
+def test_miss_sentinel():
+    assert not mr.MISS
+    assert repr(mr.MISS) == "MISS"
+    assert pickle.loads(pickle.dumps(mr.MISS)) is mr.MISS
+
+
+@pytest.mark.parametrize("value", [None, 0, "", [], False])
+def test_sync_mimic_caches_falsy_value(mime_default, value):
+    calls = []
+
+    @mime_default(ttl=10)
+    def cached_callback(param_a: int):
+        calls.append(param_a)
+        return value
+
+    assert cached_callback(1) == value
+    assert cached_callback(1) == value
+    assert calls == [1]
+
+
+@pytest.mark.asyncio
+async def test_async_mimic_caches_falsy_value(mime_default):
+    calls = []
+
+    @mime_default(ttl=10)
+    async def cached_callback(param_a: int):
+        calls.append(param_a)
+        return None
+
+    assert await cached_callback(1) is None
+    assert await cached_callback(1) is None
+    assert calls == [1]
+
+
+def test_sync_mimic_none_ttl(mime_default):
+    calls = []
+
+    @mime_default(ttl=100, none_ttl=1)
+    def cached_callback(param_a: int):
+        calls.append(param_a)
+        return None if param_a else param_a
+
+    datetime_now = datetime.utcnow()
+    with freeze_time(datetime_now):
+        cached_callback(0)
+        cached_callback(1)
+    with freeze_time(datetime_now + timedelta(seconds=2)):
+        cached_callback(0)
+        cached_callback(1)
+    assert calls == [0, 1, 1]
+
+
+@pytest.mark.asyncio
+async def test_async_mimic_none_ttl(mime_default):
+    calls = []
+
+    @mime_default(ttl=100, none_ttl=1)
+    async def cached_callback(param_a: int):
+        calls.append(param_a)
+        return None
+
+    datetime_now = datetime.utcnow()
+    with freeze_time(datetime_now):
+        await cached_callback(1)
+    with freeze_time(datetime_now + timedelta(seconds=2)):
+        await cached_callback(1)
+    assert calls == [1, 1]
+
+
+def test_sync_mimic_map(mime_default):
+    calls = []
+
+    @mime_default(ttl=10, none_ttl=5)
+    def cached_callback(param_a: int, param_b: int = 0):
+        calls.append(param_a)
+        return None if param_a == 3 else param_a + param_b
+
+    assert cached_callback(1) == 1
+    assert cached_callback.map([(1,), (2, 1), (3,), (2, 1)], concurrency=2) == [
+        1,
+        3,
+        None,
+        3,
+    ]
+    assert sorted(calls) == [1, 2, 3]
+    assert cached_callback(2, 1) == 3
+    assert cached_callback.map([]) == []
+    assert sorted(calls) == [1, 2, 3]
+
+
+@pytest.mark.asyncio
+async def test_async_mimic_map(mime_default):
+    calls = []
+
+    @mime_default(ttl=10)
+    async def cached_callback(param_a: int):
+        calls.append(param_a)
+        await asyncio.sleep(0.01)
+        return param_a * 2
+
+    assert await cached_callback(1) == 2
+    assert await cached_callback.map([(1,), (2,), (3,), (2,)], concurrency=2) == [
+        2,
+        4,
+        6,
+        4,
+    ]
+    assert sorted(calls) == [1, 2, 3]
+    assert await cached_callback(3) == 6
+    assert sorted(calls) == [1, 2, 3]
+
+
+def test_state_many_fallback():
+    class DictState(StubState):
+        def __init__(self, **kwargs):
+            super().__init__(**kwargs)
+            self.values = {}
+
+        def sync_get(self, key: str):
+            return self.values.get(key, mr.MISS)
+
+        def sync_set(self, key: str, value: any, ttl: int = None):
+            self.values[key] = value
+
+        async def async_get(self, key: str):
+            return self.sync_get(key)
+
+        async def async_set(self, key: str, value: any, ttl: int = None):
+            self.sync_set(key, value, ttl)
+
+    state = DictState()
+    state.sync_set_many({"a": 1, "b": 2}, ttl=None)
+    assert state.sync_get_many(["a", "c"]) == [1, mr.MISS]
+    asyncio.run(state.async_set_many({"c": 3}, ttl=None))
+    assert asyncio.run(state.async_get_many(["b", "c"])) == [2, 3]
+
+
+class LockedState(MemoryState):
+    """
+    Simulates another process filling the cache while the lock was awaited
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.locks = []
+
+    @contextlib.contextmanager
+    def sync_lock(self, key: str):
+        self.locks.append(key)
+        self.sync_set(key, "from other process")
+        yield self.sync_get(key)
+
+    @contextlib.asynccontextmanager
+    async def async_lock(self, key: str):
+        self.locks.append(key)
+        await self.async_set(key, "from other process")
+        yield await self.async_get(key)
+
+
+def test_sync_mimic_state_lock():
+    Mime.set_config(config=Config(state=LockedState))
+
+    @Mime(ttl=10, single_flight=True)
+    def cached_callback(param_a: int):
+        raise AssertionError("computed while the value was cached meanwhile")
+
+    @Mime(ttl=10)
+    def unlocked_callback(param_a: int):
+        return param_a
+
+    assert cached_callback(1) == "from other process"
+    assert unlocked_callback(1) == 1
+    assert len(Mime._config.initialized_state.locks) == 1
+
+
+@pytest.mark.asyncio
+async def test_async_mimic_state_lock():
+    Mime.set_config(config=Config(state=LockedState))
+
+    @Mime(ttl=10, single_flight=True)
+    async def cached_callback(param_a: int):
+        raise AssertionError("computed while the value was cached meanwhile")
+
+    assert await cached_callback(1) == "from other process"
+    assert len(Mime._config.initialized_state.locks) == 1
+
+
+def test_default_state_lock():
+    state = MemoryState()
+    with state.sync_lock("key") as value:
+        assert value is mr.MISS
+
+    async def async_lock():
+        async with state.async_lock("key") as async_value:
+            return async_value
+
+    assert asyncio.run(async_lock()) is mr.MISS
+
+
+def _wait_refreshes(refresher):
+    for _ in range(200):
+        if not refresher._keys:
+            return
+        time.sleep(0.005)
+    raise AssertionError("refresh did not finish")
+
+
+def test_stale_ttl_needs_ttl():
+    with pytest.raises(ValueError) as exception:
+        Mime(stale_ttl=10)
+    assert exception.value.args[0] == "The stale_ttl needs a ttl"
+    with pytest.raises(ValueError):
+        Mime(ttl=None, stale_ttl=10)
+
+
+def test_sync_mimic_stale_while_revalidate(mime_default):
+    calls = []
+
+    @mime_default(ttl=10, stale_ttl=20)
+    def cached_callback(param_a: int):
+        calls.append(param_a)
+        return len(calls)
+
+    with freeze_time("2023-01-14 12:00:00"):
+        assert cached_callback(1) == 1
+    with freeze_time("2023-01-14 12:00:05"):
+        assert cached_callback(1) == 1
+        assert cached_callback.refresher.refreshes == 0
+    with freeze_time("2023-01-14 12:00:15"):
+        assert cached_callback(1) == 1
+        _wait_refreshes(cached_callback.refresher)
+        assert cached_callback.refresher.refreshes == 1
+        assert cached_callback(1) == 2
+    with freeze_time("2023-01-14 12:01:00"):
+        # Out of the stale window the call waits for the computation
+        assert cached_callback(1) == 3
+    assert calls == [1, 1, 1]
+
+
+def _redis_config(async_mode: bool = False) -> Config:
+    fakeredis = pytest.importorskip("fakeredis")
+    # pylint: disable=C0415
+    import fakeredis.aioredis
+    from mr.states import RedisState
+
+    connection_class = (
+        fakeredis.aioredis.FakeConnection if async_mode else fakeredis.FakeConnection
+    )
+    return Config(
+        state=RedisState,
+        state_kwargs={
+            "REDIS_URL": "redis://localhost",
+            "CONNECTION_KWARGS": {
+                "connection_class": connection_class,
+                "server": fakeredis.FakeServer(),
+            },
+        },
+    )
+
+
+def test_sync_mimic_stale_refresh_on_redis(mime_default):
+    mime_default.set_config(config=_redis_config())
+    calls = []
+
+    @mime_default(ttl=1, stale_ttl=30)
+    def cached_callback(param_a: int):
+        calls.append(param_a)
+        return len(calls)
+
+    with freeze_time("2023-01-14 12:00:00") as frozen:
+        assert cached_callback(1) == 1
+        frozen.tick(2)
+        assert cached_callback(1) == 1
+        _wait_refreshes(cached_callback.refresher)
+        # The refresh replaced the stale value kept by redis
+        assert cached_callback(1) == 2
+        assert cached_callback(1) == 2
+    assert calls == [1, 1]
+
+
+def test_sync_mimic_stale_single_refresh(mime_default):
+    release = threading.Event()
+    calls = []
+
+    @mime_default(ttl=10, stale_ttl=20)
+    def cached_callback(param_a: int):
+        calls.append(param_a)
+        if len(calls) > 1:
+            release.wait(1)
+        return len(calls)
+
+    with freeze_time("2023-01-14 12:00:00"):
+        cached_callback(1)
+    with freeze_time("2023-01-14 12:00:15"):
+        assert [cached_callback(1) for _ in range(5)] == [1] * 5
+        release.set()
+        _wait_refreshes(cached_callback.refresher)
+    assert len(calls) == 2
+    assert cached_callback.refresher.refreshes == 1
+
+
+def test_sync_mimic_stale_refresh_error(mime_default):
+    calls = []
+
+    @mime_default(ttl=10, stale_ttl=20)
+    def cached_callback(param_a: int):
+        calls.append(param_a)
+        if len(calls) > 1:
+            raise ValueError("refresh failed")
+        return len(calls)
+
+    with freeze_time("2023-01-14 12:00:00"):
+        cached_callback(1)
+    with freeze_time("2023-01-14 12:00:15"):
+        assert cached_callback(1) == 1
+        _wait_refreshes(cached_callback.refresher)
+        assert cached_callback(1) == 1
+        _wait_refreshes(cached_callback.refresher)
+    assert len(calls) == 3
+
+
+def test_sync_mimic_stale_none_ttl(mime_default):
+    calls = []
+
+    @mime_default(ttl=100, none_ttl=1, stale_ttl=5)
+    def cached_callback(param_a: int):
+        calls.append(param_a)
+
+    with freeze_time("2023-01-14 12:00:00"):
+        cached_callback(1)
+    with freeze_time("2023-01-14 12:00:03"):
+        assert cached_callback(1) is None
+        _wait_refreshes(cached_callback.refresher)
+    assert len(calls) == 2
+
+
+def test_sync_mimic_map_stale(mime_default):
+    calls = []
+
+    @mime_default(ttl=10, stale_ttl=20)
+    def cached_callback(param_a: int):
+        calls.append(param_a)
+        return param_a * len(calls)
+
+    with freeze_time("2023-01-14 12:00:00"):
+        assert cached_callback.map([(1,), (2,)]) in ([1, 4], [2, 2])
+        first = cached_callback.map([(1,), (2,)])
+    with freeze_time("2023-01-14 12:00:15"):
+        assert cached_callback.map([(1,), (2,), (3,)])[:2] == first
+        _wait_refreshes(cached_callback.refresher)
+    assert sorted(calls) == [1, 1, 2, 2, 3]
+
+
+def test_without_stale_ttl_values_are_not_wrapped(mime_default):
+    @mime_default(ttl=10)
+    def cached_callback(param_a: int):
+        return param_a
+
+    cached_callback(1)
+    assert cached_callback.refresher is None
+    assert list(Mime._config.initialized_state._state.values())[0]["value"] == 1
+
+
+@pytest.mark.asyncio
+async def test_async_mimic_stale_while_revalidate(mime_default):
+    calls = []
+    release = asyncio.Event()
+
+    @mime_default(ttl=10, stale_ttl=20)
+    async def cached_callback(param_a: int):
+        calls.append(param_a)
+        if len(calls) > 1:
+            await release.wait()
+        return len(calls)
+
+    with freeze_time("2023-01-14 12:00:00"):
+        assert await cached_callback(1) == 1
+    with freeze_time("2023-01-14 12:00:15"):
+        assert await cached_callback(1) == 1
+        assert await cached_callback(1) == 1
+        assert cached_callback.refresher.refreshes == 1
+        release.set()
+        while cached_callback.refresher._keys:
+            await asyncio.sleep(0)
+        assert await cached_callback(1) == 2
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_async_mimic_map_stale(mime_default):
+    calls = []
+
+    @mime_default(ttl=10, stale_ttl=20)
+    async def cached_callback(param_a: int):
+        calls.append(param_a)
+        return param_a
+
+    with freeze_time("2023-01-14 12:00:00"):
+        assert await cached_callback.map([(1,), (2,)]) == [1, 2]
+    with freeze_time("2023-01-14 12:00:15"):
+        assert await cached_callback.map([(1,), (2,)]) == [1, 2]
+        while cached_callback.refresher._keys:
+            await asyncio.sleep(0)
+    assert sorted(calls) == [1, 1, 2, 2]
+
+
+def test_early_refresh_needs_ttl():
+    with pytest.raises(ValueError) as exception:
+        Mime(early_refresh=True)
+    assert exception.value.args[0] == "The early_refresh needs a ttl"
+
+
+def test_sync_mimic_early_refresh(mime_default, monkeypatch):
+    calls = []
+    # -log(1 - u) == 1
+    monkeypatch.setattr(mr.mime.random, "random", lambda: 1 - math.exp(-1))
+    with freeze_time("2023-01-14 12:00:00") as frozen:
+
+        @mime_default(ttl=10, early_refresh=True)
+        def cached_callback(param_a: int):
+            calls.append(param_a)
+            # Every computation takes 1 second
+            frozen.tick(1)
+            return len(calls)
+
+        assert cached_callback(1) == 1
+        frozen.tick(7)
+        # 7 + 1 second of compute < 10
+        assert cached_callback(1) == 1
+        assert cached_callback.refresher.refreshes == 0
+        frozen.tick(2.5)
+        assert cached_callback(1) == 1
+        _wait_refreshes(cached_callback.refresher)
+        assert cached_callback.refresher.refreshes == 1
+        assert cached_callback(1) == 2
+    assert calls == [1, 1]
+
+
+def test_early_refresh_weighted_by_compute_cost(mime_default, monkeypatch):
+    monkeypatch.setattr(mr.mime.random, "random", lambda: 1 - math.exp(-1))
+    mime = mime_default(ttl=10, early_refresh=True, early_refresh_beta=2.0)
+    with freeze_time("2023-01-14 12:00:00"):
+        cheap = mr.refresh.pack("value", datetime.utcnow().timestamp(), 0.1)
+        costly = mr.refresh.pack("value", datetime.utcnow().timestamp(), 3.0)
+    with freeze_time("2023-01-14 12:00:05"):
+        assert mime._unpack(cheap) == ("value", False)
+        assert mime._unpack(costly) == ("value", True)
+
+
+def test_early_refresh_spreads_expirations(mime_default):
+    mime = mime_default(ttl=10, early_refresh=True)
+    with freeze_time("2023-01-14 12:00:00"):
+        entry = mr.refresh.pack("value", datetime.utcnow().timestamp(), 1.0)
+    refreshes = []
+    for second in (1, 5, 9):
+        with freeze_time(f"2023-01-14 12:00:0{second}"):
+            refreshes.append(sum(mime._unpack(entry)[1] for _ in range(2000)))
+    assert refreshes[0] < refreshes[1] < refreshes[2] < 2000
+    assert refreshes[0] < 10
+
+
+def test_early_refresh_keeps_state_ttl(mime_default):
+    mime = mime_default(ttl=10, early_refresh=True)
+    assert mime._store_ttl("value") == 10
+
+
+@pytest.mark.asyncio
+async def test_async_mimic_early_refresh(mime_default, monkeypatch):
+    calls = []
+    monkeypatch.setattr(mr.mime.random, "random", lambda: 1 - math.exp(-1))
+    with freeze_time("2023-01-14 12:00:00") as frozen:
+
+        @mime_default(ttl=10, early_refresh=True)
+        async def cached_callback(param_a: int):
+            calls.append(param_a)
+            frozen.tick(1)
+            return len(calls)
+
+        assert await cached_callback(1) == 1
+        frozen.tick(9.5)
+        assert await cached_callback(1) == 1
+        while cached_callback.refresher._keys:
+            await asyncio.sleep(0)
+        assert cached_callback.refresher.refreshes == 1
+        assert await cached_callback(1) == 2
+    assert calls == [1, 1]
+
+
+@pytest.mark.asyncio
+async def test_async_mimic_early_refresh_on_redis(mime_default, monkeypatch):
+    mime_default.set_config(config=_redis_config(async_mode=True))
+    calls = []
+    monkeypatch.setattr(mr.mime.random, "random", lambda: 1 - math.exp(-1))
+    with freeze_time("2023-01-14 12:00:00") as frozen:
+
+        @mime_default(ttl=10, early_refresh=True)
+        async def cached_callback(param_a: int):
+            calls.append(param_a)
+            frozen.tick(1)
+            return len(calls)
+
+        assert await cached_callback(1) == 1
+        frozen.tick(9)
+        assert await cached_callback(1) == 1
+        while cached_callback.refresher._keys:
+            await asyncio.sleep(0)
+        # The early refresh replaced the live key before its ttl
+        assert await cached_callback(1) == 2
+        assert await cached_callback(1) == 2
+    assert calls == [1, 1]
+
+
+def _same_name(module: str):
+    def cached_callback(param_a: int):
+        return module
+
+    cached_callback.__module__ = module
+    return cached_callback
+
+
+def test_namespaced_keys(mime_default):
+    first = mime_default()(_same_name("module_a"))
+    second = mime_default()(_same_name("module_b"))
+    assert first.namespace != second.namespace
+    assert first(1) == "module_a"
+    assert second(1) == "module_b"
+
+
+def test_version_namespace(mime_default):
+    assert (
+        mime_default(version="2")(_same_name("module")).namespace
+        != mime_default()(_same_name("module")).namespace
+    )
+
+
+def test_sync_invalidate_and_clear(mime_default):
+    calls = []
+
+    @mime_default()
+    def cached_callback(param_a: int):
+        calls.append(param_a)
+        return param_a
+
+    @mime_default()
+    def other_callback(param_a: int):
+        calls.append(-param_a)
+        return param_a
+
+    for param_a in (1, 2, 1, 2):
+        cached_callback(param_a)
+    other_callback(1)
+    cached_callback.invalidate(1)
+    cached_callback(1)
+    cached_callback(2)
+    assert calls == [1, 2, -1, 1]
+    cached_callback.clear()
+    cached_callback(1)
+    cached_callback(2)
+    other_callback(1)
+    assert calls == [1, 2, -1, 1, 1, 2]
+
+
+def test_invalidate_tags(mime_default):
+    calls = []
+
+    @mime_default(tags=["users"])
+    def cached_callback(param_a: int):
+        calls.append(param_a)
+        return param_a
+
+    @mime_default(tags=["orders"])
+    def other_callback(param_a: int):
+        calls.append(-param_a)
+        return param_a
+
+    cached_callback(1)
+    other_callback(1)
+    assert cached_callback.tags == ("users",)
+    mime_default.invalidate_tags("users", "unknown")
+    cached_callback(1)
+    other_callback(1)
+    assert calls == [1, -1, 1]
+
+
+@pytest.mark.asyncio
+async def test_async_invalidate_and_clear(mime_default):
+    calls = []
+
+    @mime_default(tags=["async"])
+    async def cached_callback(param_a: int):
+        calls.append(param_a)
+        return param_a
+
+    await cached_callback(1)
+    await cached_callback(2)
+    await cached_callback.invalidate(1)
+    await cached_callback(1)
+    await cached_callback(2)
+    assert calls == [1, 2, 1]
+    await cached_callback.clear()
+    await cached_callback(2)
+    await mime_default.async_invalidate_tags("async")
+    await cached_callback(2)
+    assert calls == [1, 2, 1, 2, 2]
+
+
+def test_key_normalizes_positional_and_keyword_calls(mime_default):
+    calls = []
+
+    @mime_default()
+    def cached_callback(param_a: int, param_b: int = 2):
+        calls.append(param_a)
+        return param_a + param_b
+
+    assert cached_callback(1) == cached_callback(param_a=1) == cached_callback(1, 2)
+    assert cached_callback(param_b=2, param_a=1) == 3
+    assert calls == [1]
+    cached_callback.invalidate(param_a=1)
+    cached_callback(1)
+    assert calls == [1, 1]
+
+
+def test_key_ignore(mime_default):
+    calls = []
+
+    @mime_default(ignore=("request_id",))
+    def cached_callback(param_a: int, request_id: str):
+        calls.append(request_id)
+        return param_a
+
+    cached_callback(1, "first")
+    cached_callback(1, request_id="second")
+    assert calls == ["first"]
+
+
+def test_key_function(mime_default):
+    calls = []
+
+    @mime_default(key=lambda user, **_: user["id"])
+    def cached_callback(user: dict, verbose: bool = False):
+        calls.append(user)
+        return user["id"]
+
+    cached_callback({"id": 1, "name": "a"})
+    cached_callback({"id": 1, "name": "b"}, verbose=True)
+    assert len(calls) == 1
+    with pytest.raises(ValueError):
+        mime_default(key=str, ignore=("user",))
+
+
+def test_method_self_key(mime_default):
+    calls = []
+
+    class Repository:
+        def __init__(self, tenant: str):
+            self.tenant = tenant
+
+        @mime_default(self_key="tenant")
+        def count(self, table: str):
+            calls.append((self.tenant, table))
+            return len(calls)
+
+    assert Repository("a").count("users") == Repository("a").count("users") == 1
+    assert Repository("b").count("users") == 2
+
+
+@pytest.mark.asyncio
+async def test_async_untyped_key(mime_default):
+    calls = []
+
+    @mime_default(typed=False)
+    async def cached_callback(param_a: float):
+        calls.append(param_a)
+        return param_a
+
+    assert await cached_callback(1) == await cached_callback(1.0) == 1
+    await cached_callback(1.5)
+    assert calls == [1, 1.5]
@@ -0,0 +1,71 @@
+import asyncio
+import json
+import marshal
+import pickle
+import threading
+
+import pytest
+
+from mr.refresh import Refresher, pack, unpack
+
+
+@pytest.mark.parametrize(
+    "dumps, loads",
+    [(pickle.dumps, pickle.loads), (marshal.dumps, marshal.loads)],
+)
+def test_envelope_round_trip(dumps, loads):
+    entry = pack({"a": 1}, 10.0, 0.5)
+    assert unpack(loads(dumps(entry))) == ({"a": 1}, 10.0, 0.5)
+
+
+def test_envelope_json():
+    entry = json.loads(json.dumps(pack([1, 2], 10.0, 0.5)))
+    assert unpack(entry) == ([1, 2], 10.0, 0.5)
+
+
+@pytest.mark.parametrize("value", [None, 1, (1, 2, 3, 4), ["mr", 1, 2, 3], "mr.entry"])
+def test_not_an_envelope(value):
+    assert unpack(value) is None
+
+
+def test_sync_refresh_once_per_key():
+    refresher = Refresher()
+    release = threading.Event()
+    done = threading.Event()
+    calls = []
+
+    def func():
+        calls.append(1)
+        release.wait(1)
+        done.set()
+
+    assert refresher.sync_refresh("key", func) is True
+    assert refresher.sync_refresh("key", func) is False
+    release.set()
+    done.wait(1)
+    for _ in range(100):
+        if not refresher._keys:
+            break
+        threading.Event().wait(0.005)
+    assert refresher.sync_refresh("key", lambda: None) is True
+    assert calls == [1]
+    assert refresher.refreshes == 2
+
+
+@pytest.mark.asyncio
+async def test_async_refresh_once_per_key():
+    refresher = Refresher()
+    calls = []
+
+    async def func():
+        calls.append(1)
+        raise ValueError("ignored")
+
+    assert refresher.async_refresh("key", func) is True
+    assert refresher.async_refresh("key", func) is False
+    assert len(refresher._tasks) == 1
+    while refresher._keys:
+        await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    assert calls == [1]
+    assert not refresher._tasks
@@ -0,0 +1,215 @@
+import asyncio
+import threading
+from contextlib import contextmanager
+
+import pytest
+
+from mr import Mime, Config
+from mr.states.implementations.memory import MemoryState
+from mr.states.interface import MISS
+from mr.write_behind import WriteBehind, flush_all
+
+
+class GatedState(MemoryState):
+    """
+    MemoryState whose multi-sets wait for the gate
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.gate = threading.Event()
+        self.batches = []
+
+    def sync_set_many(self, values, ttl=None):
+        self.gate.wait(5)
+        self.batches.append((dict(values), ttl))
+        super().sync_set_many(values=values, ttl=ttl)
+
+
+@pytest.fixture()
+def gated_state():
+    state = GatedState()
+
+    @contextmanager
+    def acquire():
+        yield state
+
+    return state, acquire
+
+
+def test_policy_validation(gated_state):
+    with pytest.raises(ValueError):
+        WriteBehind(acquire=gated_state[1], policy="never")
+
+
+def test_batches_by_ttl(gated_state):
+    state, acquire = gated_state
+    writer = WriteBehind(acquire=acquire, batch_size=10)
+    assert writer.sync_put(key="a", value=1, ttl=10)
+    for key, ttl in (("b", 10), ("c", 20)):
+        assert writer.sync_put(key=key, value=key, ttl=ttl)
+    assert writer.pending(key="b") == "b"
+    assert state.sync_get(key="b") is MISS
+    state.gate.set()
+    assert writer.flush(timeout=5)
+    assert state.sync_get(key="b") == "b" and state.sync_get(key="c") == "c"
+    assert writer.pending(key="b") is MISS
+    assert (writer.queued, writer.written, writer.errors) == (3, 3, 0)
+    assert ({"c": "c"}, 20) in state.batches
+
+
+def test_discard(gated_state):
+    state, acquire = gated_state
+    writer = WriteBehind(acquire=acquire)
+    writer.sync_put(key="blocker", value=0, ttl=10)
+    writer.sync_put(key="ns:a", value=1, ttl=10)
+    writer.sync_put(key="ns:b", value=2, ttl=10)
+    writer.sync_put(key="other:a", value=3, ttl=10)
+    writer.discard(key="blocker")
+    writer.discard_namespace(namespace="ns")
+    state.gate.set()
+    assert writer.flush(timeout=5)
+    assert state.sync_get(key="ns:a") is MISS
+    assert state.sync_get(key="other:a") == 3
+
+
+def test_discard_in_flight(gated_state):
+    state, acquire = gated_state
+    writer = WriteBehind(acquire=acquire)
+    writer.sync_put(key="a", value=1, ttl=10)
+    while writer._queue.qsize():
+        pass
+    writer.discard(key="a")
+    state.gate.set()
+    assert writer.flush(timeout=5)
+    assert state.sync_get(key="a") is MISS
+
+
+@pytest.mark.parametrize(
+    "policy, queued, dropped", [("SYNC", False, 0), ("DROP", True, 1)]
+)
+def test_full_queue_policy(gated_state, policy, queued, dropped):
+    state, acquire = gated_state
+    writer = WriteBehind(acquire=acquire, max_queue=1, batch_size=1, policy=policy)
+    writer.sync_put(key="a", value=1, ttl=10)
+    # The drain thread holds "a" at the gate, "b" fills the queue
+    while writer._queue.qsize():
+        pass
+    writer.sync_put(key="b", value=2, ttl=10)
+    assert writer.sync_put(key="c", value=3, ttl=10) is queued
+    assert writer.dropped == dropped
+    assert writer.pending(key="c") is MISS
+    state.gate.set()
+    assert writer.flush(timeout=5)
+
+
+def test_flush_timeout(gated_state):
+    state, acquire = gated_state
+    writer = WriteBehind(acquire=acquire)
+    writer.sync_put(key="a", value=1, ttl=10)
+    assert not writer.flush(timeout=0.01)
+    state.gate.set()
+    assert flush_all(timeout=5)
+
+
+@pytest.mark.asyncio
+async def test_async_block_policy(gated_state):
+    state, acquire = gated_state
+    writer = WriteBehind(acquire=acquire, max_queue=1, batch_size=1, policy="BLOCK")
+    for key in ("a", "b"):
+        await writer.async_put(key=key, value=key, ttl=10)
+    put = asyncio.create_task(writer.async_put(key="c", value="c", ttl=10))
+    await asyncio.sleep(0.01)
+    assert not put.done()
+    state.gate.set()
+    assert await put
+    assert await writer.async_flush(timeout=5)
+    assert state.sync_get(key="c") == "c"
+
+
+def test_write_error_is_counted():
+    @contextmanager
+    def acquire():
+        raise ConnectionError()
+        yield  # pylint: disable=W0101
+
+    writer = WriteBehind(acquire=acquire)
+    writer.sync_put(key="a", value=1, ttl=10)
+    assert writer.flush(timeout=5)
+    assert writer.errors == 1
+    assert writer.pending(key="a") is MISS
+
+
+@pytest.fixture()
+def mime_gated():
+    config = Config(state=GatedState)
+    Mime.set_config(config=config)
+    yield Mime, config.initialized_state
+    config.initialized_state.gate.set()
+    Mime.set_config(config=Config(state=MemoryState))
+
+
+def test_sync_mimic_write_behind(mime_gated):
+    mime, state = mime_gated
+    calls = []
+
+    @mime(ttl=10, write_behind=True)
+    def cached_callback(param_a: int):
+        calls.append(param_a)
+        return param_a
+
+    assert cached_callback(1) == 1
+    # Served from the queue before it reaches the state
+    assert cached_callback(1) == 1
+    assert cached_callback.map([(1,), (2,)]) == [1, 2]
+    assert calls == [1, 2]
+    cached_callback.invalidate(2)
+    state.gate.set()
+    assert cached_callback.write_behind.flush(timeout=5)
+    assert state.batches
+    assert cached_callback(2) == 2
+    assert calls == [1, 2, 2]
+
+
+def test_write_behind_disabled_by_default(mime_gated):
+    mime, _ = mime_gated
+
+    @mime(ttl=10)
+    def cached_callback(param_a: int):
+        return param_a
+
+    assert cached_callback.write_behind is None
+
+
+@pytest.mark.asyncio
+async def test_async_mimic_write_behind(mime_gated):
+    mime, state = mime_gated
+    calls = []
+
+    @mime(ttl=10, write_behind=True, tags=("write-behind",))
+    async def cached_callback(param_a: int):
+        calls.append(param_a)
+        return param_a
+
+    assert await cached_callback(1) == 1
+    assert await cached_callback(1) == 1
+    assert await cached_callback.map([(1,), (2,)]) == [1, 2]
+    assert calls == [1, 2]
+    await mime.async_invalidate_tags("write-behind")
+    state.gate.set()
+    assert await cached_callback.write_behind.async_flush(timeout=5)
+    assert await cached_callback(1) == 1
+    assert calls == [1, 2, 1]
+
+
+def test_single_flight_writes_inline(mime_gated):
+    mime, state = mime_gated
+    state.gate.set()
+
+    @mime(ttl=10, write_behind=True, single_flight=True)
+    def cached_callback(param_a: int):
+        return param_a
+
+    assert cached_callback(1) == 1
+    assert cached_callback.write_behind.queued == 0
+    assert state.batches == []